@@ -5,10 +5,16 @@ Curtin University Masters of Geospatial Science candidate,
 Submitted June 2016"""
 
 # Standard python libraries.
+import base64
+import hashlib
 import json
-import math
 import random
 import cStringIO
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 
 from datetime import datetime
 from datetime import timedelta
@@ -30,6 +36,7 @@ import matplotlib.patheffects as path_effects
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import polymodel
 from google.appengine.api import taskqueue
+from google.appengine.api import memcache
 
 # Local model imports
 from landgateapitestmodel import TestCampaign
@@ -42,11 +49,82 @@ from landgateapitestmodel import PingResult
 from landgateapitestmodel import ReferenceObject
 from landgateapitestmodel import Vector
 from landgateapitestmodel import CampaignStats
+from landgateapitestmodel import CampaignStatsShard
+from landgateapitestmodel import ResponseBlob
+from landgateapitestmodel import UploadSession
+from landgateapitestmodel import UploadChunk
+from landgateapitestmodel import UploadChunkClaim
+from landgateapitestmodel import digestResponse
+
+# Local upload parsing imports
+from landgateapitestparser import iterUpload
+
+# Local snapshot imports
+from landgateapitestsnapshot import getVectorDataVersion
+from landgateapitestsnapshot import loadVectorSnapshot
+from landgateapitestsnapshot import recordVectorChangesAsync
+from landgateapitestsnapshot import getVectorCounts
+from landgateapitestsnapshot import getVectorSketches
+from landgateapitestsnapshot import sketchSeriesName
+from landgateapitestsnapshot import getVectorRegressions
+from landgateapitestsnapshot import regressionSeriesName
+
+# Local analysis imports
+from landgateapitestanalysis import TimeSeries
+from landgateapitestanalysis import measureChanges
+from landgateapitestanalysis import normaliseResponse
+from landgateapitestanalysis import prepareReference
+from landgateapitestanalysis import checkPreparedReference
+from landgateapitestanalysis import isReferenceCheckValid
+from landgateapitestanalysis import sketchSample
+from landgateapitestanalysis import fitRegression
 
 # Constants and helper classes and functions
 
 DEFAULT_CAMPAIGN_NAME = 'production_campaign'
 
+KEY_ALLOCATION_SIZE = 100  # TestMaster ids reserved per allocate_ids call.
+
+MAX_BATCH_ENTITIES = 500  # datastore limit on entities per put_multi.
+MAX_BATCH_BYTES = 4 * 1024 * 1024  # keeps each batch RPC well under the request size limit.
+MAX_BATCHES_IN_FLIGHT = 4
+ENTITY_OVERHEAD_BYTES = 512  # rough size of an entity's small properties.
+
+MAX_KNOWN_DIGESTS = 10000  # ResponseBlob digests remembered per instance.
+
+# Digests of response bodies this instance has seen safely stored.
+KNOWN_DIGESTS = set()
+
+CHUNK_CLAIM_SECONDS = 120  # after which a claimed upload chunk is abandoned, twice the request deadline.
+
+DEDUP_BATCH_SIZE = 50  # uploaded TestMasters checked per round of testID lookups.
+
+STATS_SHARD_COUNT = 20  # CampaignStatsShard entities per campaign.
+STATS_CACHE_SECONDS = 60  # how stale the summed stats shown by StatsPage may be.
+
+# Comma separated lists of distinct values, merged rather than summed.
+STATS_LIST_FIELDS = ('allDeviceTypes', 'allOSVersions')
+
+# Every counter and total on CampaignStats, summed across its shards.
+STATS_COUNTER_FIELDS = [name for name, prop in CampaignStats._properties.items()
+                        if isinstance(prop, (ndb.IntegerProperty, ndb.FloatProperty))]
+
+REFERENCE_CACHE_SIZE = 128  # ReferenceObjects kept per instance, there are about 70.
+REFERENCE_CACHE_SECONDS = 24 * 60 * 60  # memcache lifetime of a cached ReferenceObject.
+REFERENCE_GENERATION_CHECK_SECONDS = 30  # how long an instance may serve a replaced reference.
+REFERENCE_GENERATION_KEY = 'ReferenceObject-generation'
+
+ANALYSIS_QUEUE_NAME = 'default'
+DEFAULT_ANALYSE_BY = 'testmaster'  # or 'endpoint' for one task per TestEndpoint, or 'pull'.
+
+ANALYSIS_PULL_QUEUE_NAME = 'analysis-pull'
+PULL_LEASE_COUNT = 100  # most tasks leased at once, the taskqueue's own limit.
+PULL_LEASE_SECONDS = 300  # long enough to analyse a full lease.
+PULL_WORKER_SECONDS = 50  # each cron started worker stops leasing after this.
+
+GRAPH_CACHE_SIZE = 64  # rendered graphs kept per instance.
+GRAPH_CACHE_SECONDS = 7 * 24 * 60 * 60  # memcache lifetime of a rendered graph.
+
 def getCampaignKey(database_name=DEFAULT_CAMPAIGN_NAME):
     key = ndb.Key(TestCampaign, database_name)
     if key is None:
@@ -55,59 +133,136 @@ def getCampaignKey(database_name=DEFAULT_CAMPAIGN_NAME):
         return key
 
 
-def NetworkClass(connectionType):
-    """Classifies mobile broadband networks by their generation,
-    i.e. 3.5G, 4G etc as float values.
-    N.B. Assume 5 for wifi connections."""
-    generation = 0.0
-
-    if connectionType == 'CTRadioAccessTechnologyGPRS':
-        generation = 2.5
-    elif connectionType == 'CTRadioAccessTechnologyCDMA1x':
-        generation = 2.5
-    elif connectionType == 'CTRadioAccessTechnologyEdge':
-        generation = 2.75
-    elif connectionType == 'CTRadioAccessTechnologyWCDMA':
-        generation = 3.0
-    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORev0':
-        generation = 3.0
-    elif connectionType == 'CTRadioAccessTechnologyeHRPD':
-        generation = 3.0
-    elif connectionType == 'CTRadioAccessTechnologyHSDPA':
-        generation = 3.5
-    elif connectionType == 'CTRadioAccessTechnologyHSUPA':
-        generation = 3.5
-    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORevA':
-        generation = 3.5
-    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORevB':
-        generation = 3.75
-    elif connectionType == 'CTRadioAccessTechnologyLTE':
-        generation = 4.0
-    elif connectionType == 'Wifi':
-        generation = 5.0
-    return generation
+class KeyAllocator(object):
+    """Hands out keys for new entities of a model under a parent,
+    reserving ids from the datastore in blocks of KEY_ALLOCATION_SIZE
+    so allocation costs one RPC per block rather than one per entity."""
+    def __init__(self, modelClass, parent):
+        self.modelClass = modelClass
+        self.parent = parent
+        self.nextID = 0
+        self.lastID = -1
 
+    def nextKey(self):
+        if self.nextID > self.lastID:
+            self.nextID, self.lastID = self.modelClass.allocate_ids(size=KEY_ALLOCATION_SIZE, parent=self.parent)
 
-def HaversineDistance(location1, location2):
-    """Method to calculate Distance between two sets of Lat/Lon.
-    Modified from Amyth's StackOverflow answer of 22/5/2012;
-    http://stackoverflow.com/questions/10693699/calculate-distance-between-cities-find-surrounding-cities-based-on-geopt-in-p
-    """
-    lat1 = location1.lat
-    lon1 = location1.lon
+        key = ndb.Key(self.modelClass, self.nextID, parent=self.parent)
+        self.nextID += 1
+        return key
 
-    lat2 = location2.lat
-    lon2 = location2.lon
 
-    earth = 6378137 #Earth's equatorial radius in metres.
+class WritePipeline(object):
+    """Queues entities for storage and writes them with put_multi_async.
+    A batch is sent once it reaches the datastore's entity count limit or
+    our byte budget, and up to MAX_BATCHES_IN_FLIGHT batches overlap
+    before we block on the oldest. Upload latency therefore scales with
+    the number of batches rather than the number of entities."""
+    def __init__(self):
+        self.listPending = []
+        self.pendingBytes = 0
+        self.listFutures = []
+
+    def add(self, entity, size=0):
+        """Queues an entity, size being a rough count of the bytes in its
+        large unindexed properties, e.g. responseData."""
+        self.listPending.append(entity)
+        self.pendingBytes += size + ENTITY_OVERHEAD_BYTES
+
+        if len(self.listPending) >= MAX_BATCH_ENTITIES or self.pendingBytes >= MAX_BATCH_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Sends the pending entities as one batch."""
+        if self.listPending:
+            self.listFutures.append(ndb.put_multi_async(self.listPending))
+            self.listPending = []
+            self.pendingBytes = 0
+
+        while len(self.listFutures) > MAX_BATCHES_IN_FLIGHT:
+            self._wait(self.listFutures.pop(0))
+
+    def finish(self):
+        """Sends any remaining entities and waits for every batch.
+        Raises the first write error encountered."""
+        self.flush()
+        while self.listFutures:
+            self._wait(self.listFutures.pop(0))
+
+    def _wait(self, listFutures):
+        for future in listFutures:
+            future.get_result()
+
+
+class ResponseBlobWriter(object):
+    """Queues response bodies for the content addressed ResponseBlob store,
+    skipping bodies that are already stored so repeat responses cost no
+    datastore bytes. Unseen digests are collected until flush(), which
+    checks them all at once with concurrent keys only queries."""
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.dictPending = {}
+        self.setSeen = set()
+
+    def add(self, responseData):
+        """Returns the digest of responseData, holding the body for the
+        next flush() if this is the first time we have seen it."""
+        digest = digestResponse(responseData)
+        if digest not in KNOWN_DIGESTS and digest not in self.setSeen:
+            self.dictPending[digest] = responseData
+            self.setSeen.add(digest)
+        return digest
+
+    def flush(self):
+        """Queues every pending body not already in the datastore on the
+        write pipeline."""
+        listDigests = self.dictPending.keys()
+        listFutures = [ResponseBlob.query(ResponseBlob.key == ndb.Key(ResponseBlob, digest)).get_async(keys_only=True) for digest in listDigests]
+
+        for digest, future in zip(listDigests, listFutures):
+            if future.get_result() is None:
+                responseData = self.dictPending[digest]
+                self.pipeline.add(ResponseBlob(id=digest, data=responseData), len(responseData))
+
+        self.dictPending = {}
+
+    def commit(self):
+        """Remembers this upload's digests once the pipeline has finished,
+        so later uploads to this instance skip them without a query."""
+        if len(KNOWN_DIGESTS) + len(self.setSeen) > MAX_KNOWN_DIGESTS:
+            KNOWN_DIGESTS.clear()
+        KNOWN_DIGESTS.update(self.setSeen)
+
+
+def enqueueAnalysisTasks(campaignName, listAnalysisTargets, analyseBy=DEFAULT_ANALYSE_BY):
+    """Adds analysis tasks for newly stored tests to the analysis queue.
+    listAnalysisTargets holds a (masterKey, listEndpointIDs) pair for each
+    TestMaster. With analyseBy 'testmaster' each TestMaster gets one task
+    covering all of its endpoints, otherwise each endpoint gets its own.
+    With analyseBy 'pull' each endpoint gets a task on the pull queue,
+    leased in batches by AnalysePull rather than pushed one per request.
+    Tasks are added in bulk, MAX_TASKS_PER_ADD to a call."""
+    listTasks = []
+    for masterKey, listEndpointIDs in listAnalysisTargets:
+        if analyseBy == 'testmaster':
+            if listEndpointIDs:
+                listTasks.append(taskqueue.Task(url='/analyse', method='GET', params={'campaignName': campaignName, 'masterKey': masterKey.urlsafe()}))
+        elif analyseBy == 'pull':
+            for endpointID in listEndpointIDs:
+                payload = json.dumps({'campaignName': campaignName, 'masterKey': masterKey.urlsafe(), 'testID': endpointID})
+                listTasks.append(taskqueue.Task(payload=payload, method='PULL'))
+        else:
+            for endpointID in listEndpointIDs:
+                listTasks.append(taskqueue.Task(url='/analyse', method='GET', params={'campaignName': campaignName, 'testID': endpointID}))
 
-    #Calculate distance based on Haversine Formula
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    d = earth * c
-    return d
+    if analyseBy == 'pull':
+        queue = taskqueue.Queue(ANALYSIS_PULL_QUEUE_NAME)
+    else:
+        queue = taskqueue.Queue(ANALYSIS_QUEUE_NAME)
+    listRPCs = [queue.add_async(listTasks[index:index + taskqueue.MAX_TASKS_PER_ADD])
+                for index in range(0, len(listTasks), taskqueue.MAX_TASKS_PER_ADD)]
+    for rpc in listRPCs:
+        rpc.get_result()
 
 
 class AnalysisEnum:
@@ -146,326 +301,554 @@ class TestPage(webapp2.RequestHandler):
         self.response.write('Hello, World!\nService is up and running!\n\n')
 
 
+def findStoredTestMasters(campaignKey, listTestIDs):
+    """Returns a dict of the TestMaster key of each of listTestIDs already
+    stored in the campaign. Each testID is a keys only ancestor query,
+    strongly consistent and run concurrently, so no entity is ever read.
+    A TestMaster is only written once its children and its upload's stats
+    are, so one found here was stored in full."""
+    listTestIDs = sorted(set(testID for testID in listTestIDs if testID))
+    listFutures = [TestMaster.query(TestMaster.testID == testID, ancestor=campaignKey).get_async(keys_only=True)
+                   for testID in listTestIDs]
+
+    return dict((testID, future.get_result()) for testID, future in zip(listTestIDs, listFutures)
+                if future.get_result() is not None)
+
+
+def blankCampaignStats(campaignName, modelClass=CampaignStats, **kwds):
+    """Returns a CampaignStats, or CampaignStatsShard, with blank values.
+    Used for new shards, for the totals summed from them and for the
+    counts gathered during one upload before they are added to a shard."""
+    stats = modelClass(**kwds)
+    stats.campaignName = campaignName
+    stats.countTestMasters = 0
+    stats.allDeviceTypes = ""
+    stats.allOSVersions = ""
+    stats.countTestEndpoints = 0
+    stats.totalTestEndpointTime = 0.0
+    stats.countTestEndpointsSuccessful = 0
+    stats.countNetworkResults = 0
+    stats.countLocationResults = 0
+    stats.countPingResults = 0
+    stats.countPingResultsSuccessful = 0
+    stats.totalPingTime = 0
+    stats.ESRI_BusStops_AttributeFilter_GET_JSON = 0
+    stats.ESRI_BusStops_AttributeFilter_POST_JSON = 0
+    stats.ESRI_BusStops_Big_GET_JSON = 0
+    stats.ESRI_BusStops_Big_POST_JSON = 0
+    stats.ESRI_BusStops_FeatureByID_GET_JSON = 0
+    stats.ESRI_BusStops_FeatureByID_POST_JSON = 0
+    stats.ESRI_BusStops_GetCapabilities_GET_JSON = 0
+    stats.ESRI_BusStops_GetCapabilities_POST_JSON = 0
+    stats.ESRI_BusStops_IntersectFilter_GET_JSON = 0
+    stats.ESRI_BusStops_IntersectFilter_POST_JSON = 0
+    stats.ESRI_BusStops_Small_GET_JSON = 0
+    stats.ESRI_BusStops_Small_POST_JSON = 0
+    stats.ESRI_Topo_Big_POST_Image = 0
+    stats.ESRI_Topo_Small_GET_Image = 0
+    stats.ESRI_Topo_Small_POST_Image = 0
+    stats.GME_AerialPhoto_Big_GET_Image = 0
+    stats.GME_AerialPhoto_GetTileKVP_GET_Image = 0
+    stats.GME_AerialPhoto_GetTileKVP2_GET_Image = 0
+    stats.GME_AerialPhoto_GetTileKVP3_GET_Image = 0
+    stats.GME_AerialPhoto_GetTileKVP4_GET_Image = 0
+    stats.GME_AerialPhoto_Small_GET_Image = 0
+    stats.GME_AerialPhoto_WMSGetCapabilities_GET_XML = 0
+    stats.GME_AerialPhoto_WMTSGetCapabilities_GET_XML = 0
+    stats.GME_BusStops_AttributeFilter_GET_JSON = 0
+    stats.GME_BusStops_Big_GET_JSON = 0
+    stats.GME_BusStops_DistanceFilter_GET_JSON = 0
+    stats.GME_BusStops_FeatureByID_GET_JSON = 0
+    stats.GME_BusStops_IntersectFilter_GET_JSON = 0
+    stats.GME_BusStops_Small_GET_JSON = 0
+    stats.OGC_AerialPhoto_GetTileKVP_GET_Image = 0
+    stats.OGC_AerialPhoto_GetTileRestful_GET_Image = 0
+    stats.OGC_BusStops_AttributeFilter_GET_JSON = 0
+    stats.OGC_BusStops_AttributeFilter_GET_XML = 0
+    stats.OGC_BusStops_AttributeFilter_POST_JSON = 0
+    stats.OGC_BusStops_AttributeFilter_POST_XML = 0
+    stats.OGC_BusStops_Big_GET_JSON = 0
+    stats.OGC_BusStops_Big_GET_XML = 0
+    stats.OGC_BusStops_Big_POST_JSON = 0
+    stats.OGC_BusStops_Big_POST_XML = 0
+    stats.OGC_BusStops_FeatureByID_GET_JSON = 0
+    stats.OGC_BusStops_FeatureByID_GET_XML = 0
+    stats.OGC_BusStops_FeatureByID_POST_JSON = 0
+    stats.OGC_BusStops_FeatureByID_POST_XML = 0
+    stats.OGC_BusStops_GetCapabilities_GET_XML = 0
+    stats.OGC_BusStops_GetCapabilities_POST_XML = 0
+    stats.OGC_BusStops_IntersectFilter_GET_JSON = 0
+    stats.OGC_BusStops_IntersectFilter_GET_XML = 0
+    stats.OGC_BusStops_IntersectFilter_POST_JSON = 0
+    stats.OGC_BusStops_IntersectFilter_POST_XML = 0
+    stats.OGC_BusStops_Small_GET_JSON = 0
+    stats.OGC_BusStops_Small_GET_XML = 0
+    stats.OGC_BusStops_Small_POST_JSON = 0
+    stats.OGC_BusStops_Small_POST_XML = 0
+    stats.OGC_Topo_Big_GET_Image = 0
+    stats.OGC_Topo_Small_GET_Image = 0
+    stats.ESRI_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_AttributeFilter_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_Big_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_Big_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_FeatureByID_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_GetCapabilities_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_GetCapabilities_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_IntersectFilter_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_Small_GET_JSON_ReferenceSuccess = 0
+    stats.ESRI_BusStops_Small_POST_JSON_ReferenceSuccess = 0
+    stats.ESRI_Topo_Big_POST_Image_ReferenceSuccess = 0
+    stats.ESRI_Topo_Small_GET_Image_ReferenceSuccess = 0
+    stats.ESRI_Topo_Small_POST_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_Big_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_GetTileKVP_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_GetTileKVP2_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_GetTileKVP3_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_GetTileKVP4_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_Small_GET_Image_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_WMSGetCapabilities_GET_XML_ReferenceSuccess = 0
+    stats.GME_AerialPhoto_WMTSGetCapabilities_GET_XML_ReferenceSuccess = 0
+    stats.GME_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
+    stats.GME_BusStops_Big_GET_JSON_ReferenceSuccess = 0
+    stats.GME_BusStops_DistanceFilter_GET_JSON_ReferenceSuccess = 0
+    stats.GME_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
+    stats.GME_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
+    stats.GME_BusStops_Small_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_AerialPhoto_GetTileKVP_GET_Image_ReferenceSuccess = 0
+    stats.OGC_AerialPhoto_GetTileRestful_GET_Image_ReferenceSuccess = 0
+    stats.OGC_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_AttributeFilter_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_AttributeFilter_POST_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_AttributeFilter_POST_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_Big_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_Big_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_Big_POST_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_Big_POST_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_FeatureByID_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_FeatureByID_POST_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_FeatureByID_POST_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_GetCapabilities_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_GetCapabilities_POST_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_IntersectFilter_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_IntersectFilter_POST_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_IntersectFilter_POST_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_Small_GET_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_Small_GET_XML_ReferenceSuccess = 0
+    stats.OGC_BusStops_Small_POST_JSON_ReferenceSuccess = 0
+    stats.OGC_BusStops_Small_POST_XML_ReferenceSuccess = 0
+    stats.OGC_Topo_Big_GET_Image_ReferenceSuccess = 0
+    stats.OGC_Topo_Small_GET_Image_ReferenceSuccess = 0
+    return stats
+
+
+def getStatsShardKeys(campaignName):
+    """Shards are root entities, each in its own entity group, so their
+    writes are not limited by the rate of a single entity group."""
+    return [ndb.Key(CampaignStatsShard, campaignName + '-' + str(shard)) for shard in range(STATS_SHARD_COUNT)]
+
+
+def mergeStatsList(existing, additions):
+    """Appends the values of the comma separated list additions not
+    already in the comma separated list existing."""
+    listExisting = [value for value in (existing or '').split(', ') if value]
+    for value in (additions or '').split(', '):
+        if value and value not in listExisting:
+            listExisting.append(value)
+    return ''.join(value + ', ' for value in listExisting)
+
+
+def incrementCampaignStats(campaignName, dictDelta, listFinalEntities=None, precondition=None):
+    """Adds the counts in dictDelta to one CampaignStats shard, chosen at
+    random, in a transaction so that concurrent uploads and analyses never
+    lose each other's counts. Any listFinalEntities are written in the
+    same transaction. precondition, if given, is called first within the
+    transaction and may raise to roll it back."""
+    incrementCampaignStatsAsync(campaignName, dictDelta, listFinalEntities, precondition).get_result()
+
+
+def incrementCampaignStatsAsync(campaignName, dictDelta, listFinalEntities=None, precondition=None):
+    """As incrementCampaignStats but returns a future."""
+    def txn():
+        if precondition is not None:
+            precondition()
+        ndb.put_multi([addCampaignStats(campaignName, dictDelta)] + (listFinalEntities or []))
+
+    return ndb.transaction_async(txn, xg=True)
+
+
+def addCampaignStats(campaignName, dictDelta):
+    """Adds the counts in dictDelta to one CampaignStats shard, chosen at
+    random. Called within a transaction, returns the shard for the caller
+    to put."""
+    shardKey = random.choice(getStatsShardKeys(campaignName))
+    shard = shardKey.get()
+    if shard is None:
+        shard = blankCampaignStats(campaignName, CampaignStatsShard, key=shardKey)
+
+    for name, value in dictDelta.items():
+        if name in STATS_LIST_FIELDS:
+            setattr(shard, name, mergeStatsList(getattr(shard, name), value))
+        elif name in STATS_COUNTER_FIELDS:
+            setattr(shard, name, (getattr(shard, name) or 0) + value)
+
+    return shard
+
+
+def resetReferenceSuccessStats(campaignName):
+    """Zeroes the reference check success counts of every CampaignStats
+    shard of a campaign, and of its single record from before sharding,
+    so that re-analysing the campaign does not count successes twice."""
+    listFieldNames = [name for name in STATS_COUNTER_FIELDS if name.endswith('_ReferenceSuccess')]
+
+    def txn(key):
+        stats = key.get()
+        if stats is not None:
+            for name in listFieldNames:
+                setattr(stats, name, 0)
+            stats.put()
+
+    listKeys = getStatsShardKeys(campaignName)
+    legacyKey = CampaignStats.query(CampaignStats.campaignName == campaignName).get(keys_only=True)
+    if legacyKey is not None:
+        listKeys.append(legacyKey)
+
+    for key in listKeys:
+        ndb.transaction(lambda: txn(key))
+    memcache.delete('CampaignStats-' + campaignName)
+
+
+def getCampaignStats(campaignName):
+    """Returns the CampaignStats for a campaign summed across its shards,
+    and the single record written before the counters were sharded, or
+    None if the campaign has no stats at all. Cached in memcache for
+    STATS_CACHE_SECONDS as a read touches every shard."""
+    cacheKey = 'CampaignStats-' + campaignName
+    total = memcache.get(cacheKey)
+    if total is not None:
+        return total
+
+    listStats = ndb.get_multi(getStatsShardKeys(campaignName))
+    listStats.append(CampaignStats.query(CampaignStats.campaignName == campaignName).get())
+    listStats = [stats for stats in listStats if stats is not None]
+    if not listStats:
+        return None
+
+    total = blankCampaignStats(campaignName)
+    for stats in listStats:
+        for name in STATS_COUNTER_FIELDS:
+            setattr(total, name, getattr(total, name) + (getattr(stats, name) or 0))
+        for name in STATS_LIST_FIELDS:
+            setattr(total, name, mergeStatsList(getattr(total, name), getattr(stats, name)))
+
+    memcache.set(cacheKey, total, time=STATS_CACHE_SECONDS)
+    return total
+
+
+class UploadIngester(object):
+    """Builds the model objects for uploaded TestMasters and their children
+    and queues them on a WritePipeline, updating the campaign's stats as
+    it goes. Shared by Database.post and the upload session chunks.
+    The TestMasters themselves are held back until finish() and written
+    in the same transaction as the upload's stats, after every child has
+    landed, so a stored TestMaster is always a complete one and a retry
+    of a failed upload never skips one that is missing anything."""
+    def __init__(self, campaignName, masterKeyPrefix=None):
+        self.campaignName = campaignName
+        self.campaignKey = getCampaignKey(campaignName)
+        # Counts for this upload alone, added to a stats shard by finish().
+        self.stats = blankCampaignStats(campaignName)
+
+        # All entities from the upload go through one write pipeline,
+        # TestMaster keys are allocated in blocks so children can be
+        # parented without waiting on their TestMaster's put.
+        self.pipeline = WritePipeline()
+        self.blobWriter = ResponseBlobWriter(self.pipeline)
+        self.masterKeys = KeyAllocator(TestMaster, self.campaignKey)
+        self.masterKeyPrefix = masterKeyPrefix
+
+        # TestMasters waiting for finish(), and a (masterKey,
+        # listEndpointIDs) pair for each TestMaster to analyse.
+        self.listTestMasters = []
+        self.listAnalysisTargets = []
+
+        # Uploaded TestMasters wait here until a batch of their testIDs
+        # can be checked against the store together. Device retries after
+        # a timeout resend TestMasters we already hold, those and repeats
+        # within the upload itself are skipped. The analysis of one already
+        # held is queued again in case the upload that stored it failed
+        # before queueing it, analysis only ever touches unanalysed tests.
+        self.listPending = []
+        self.setTestIDs = set()
+        self.countSkipped = 0
+
+    def nextMasterKey(self):
+        """Returns the key for the next TestMaster. With a masterKeyPrefix
+        the keys are named after it, in order, so the TestMasters written
+        by an interrupted attempt can be found again and removed."""
+        if self.masterKeyPrefix is None:
+            return self.masterKeys.nextKey()
+
+        return ndb.Key(TestMaster, '%s-%06d' % (self.masterKeyPrefix, len(self.listTestMasters)), parent=self.campaignKey)
+
+    def addTestMaster(self, TM):
+        """Queues one uploaded TestMaster dict and all of its children,
+        unless its testID is already stored."""
+        self.listPending.append(TM)
+        if len(self.listPending) >= DEDUP_BATCH_SIZE:
+            self.flushPending()
+
+    def flushPending(self):
+        listPending, self.listPending = self.listPending, []
+        dictStored = findStoredTestMasters(self.campaignKey, [TM.get('testID') for TM in listPending])
+
+        for TM in listPending:
+            testID = TM.get('testID')
+            if testID in self.setTestIDs:
+                self.countSkipped += 1
+                continue
+
+            if testID in dictStored:
+                self.countSkipped += 1
+                self.setTestIDs.add(testID)
+                self.listAnalysisTargets.append((dictStored[testID], [TE.get('testID') for TE in TM.get('endpointResults', [])]))
+                continue
+
+            if testID:
+                self.setTestIDs.add(testID)
+            self.storeTestMaster(TM)
+
+    def storeTestMaster(self, TM):
+        stats = self.stats
+        pipeline = self.pipeline
+        blobWriter = self.blobWriter
+        listAnalysisTargets = self.listAnalysisTargets
+
+        masterKey = self.nextMasterKey()
+
+        testMaster = TestMaster(key=masterKey)
+        testMaster.testID = TM.get('testID')
+        testMaster.parentID = TM.get('parentID')
+        testMaster.startDatetime = datetime.utcfromtimestamp(float(TM.get('startDatetime')))
+        testMaster.finishDatetime = datetime.utcfromtimestamp(float(TM.get('finishDatetime')))
+        testMaster.success = bool(TM.get('success'))
+        testMaster.comment = TM.get('comment')
+        testMaster.deviceType = TM.get('deviceType')
+        testMaster.deviceID = TM.get('deviceID')
+        testMaster.iOSVersion = TM.get('iOSVersion')
+
+        stats.countTestMasters += 1
+
+        if testMaster.deviceType not in stats.allDeviceTypes:
+            stats.allDeviceTypes += testMaster.deviceType
+            stats.allDeviceTypes += ", "
+
+        if testMaster.iOSVersion not in stats.allOSVersions:
+            stats.allOSVersions += testMaster.iOSVersion
+            stats.allOSVersions += ", "
+
+        self.listTestMasters.append(testMaster)
+
+        listEndpointIDs = []
+        listAnalysisTargets.append((masterKey, listEndpointIDs))
+
+        for TE in TM.get('endpointResults', []):
+            # print TE
+            testEndpoint = TestEndpoint(parent=masterKey)
+
+            testEndpoint.testID = TE.get('testID')
+            testEndpoint.parentID = TE.get('parentID')
+            testEndpoint.startDatetime = datetime.utcfromtimestamp(float(TE.get('startDatetime')))
+            testEndpoint.finishDatetime = datetime.utcfromtimestamp(float(TE.get('finishDatetime')))
+            testEndpoint.success = bool(TE.get('success'))
+            testEndpoint.comment = TE.get('comment')
+            testEndpoint.server = TE.get('server')
+            testEndpoint.dataset = TE.get('dataset')
+            testEndpoint.returnType = TE.get('returnType')
+            testEndpoint.testName = TE.get('testName')
+            testEndpoint.httpMethod = TE.get('httpMethod')
+            testEndpoint.testedURL = TE.get('testedURL')
+            testEndpoint.responseCode = int(TE.get('responseCode'))
+
+            # Store only the digest of the response, the body itself
+            # goes to the ResponseBlob store if it is new to us.
+            responseData = TE.get('responseData') or ''
+
+            # MessagePack uploads carry images as raw bytes, we keep
+            # them as base64 text like the reference images.
+            if isinstance(responseData, bytearray):
+                responseData = base64.b64encode(responseData)
+
+            if responseData:
+                testEndpoint.responseDigest = blobWriter.add(responseData)
+            else:
+                testEndpoint.responseData = responseData
+
+            testEndpoint.errorResponse = TE.get('errorResponse')
+            testEndpoint.analysed = AnalysisEnum.UNANALYSED
+
+            stats.countTestEndpoints += 1
+            stats.totalTestEndpointTime += (TE.get('finishDatetime') - TE.get('startDatetime'))
+            stats.countTestEndpointsSuccessful += testEndpoint.success
+
+            testString = testEndpoint.server + "_" + testEndpoint.dataset + "_" + testEndpoint.testName + "_" + testEndpoint.httpMethod + "_" + testEndpoint.returnType
+            print testString
+
+            if hasattr(stats, testString):
+                newValue = getattr(stats, testString) + 1
+                setattr(stats, testString, newValue)
+
+            pipeline.add(testEndpoint)
+            listEndpointIDs.append(testEndpoint.testID)
+
+            """No longer need to make concrete subclasses of
+            TestEndpoint as all three types store their responseData
+            in TextProperty()'s nowadays.'"""
+            # testEndpoint = None
+            # keys = TE.keys()
+            # if 'imageResponse' in keys:
+            #     testEndpoint = ImageEndpoint(parent=masterKey)
+            #     testEndpoint.imageResponse = str(TE.get('imageResponse'))
+            # elif 'xmlResponse' in keys:
+            #     testEndpoint = XmlEndpoint(parent=masterKey)
+            #     testEndpoint.xmlResponse = TE.get('xmlResponse')
+            # elif 'jsonResponse' in keys:
+            #     testEndpoint = JsonEndpoint(parent=masterKey)
+            #     testEndpoint.jsonResponse = TE.get('jsonResponse')
+            # elif 'responseData' in keys:
+            #     # There was no response to the original request (likely no connectivity)
+            #     # Here we set to a null json response.
+            #     testEndpoint = JsonEndpoint(parent=masterKey)
+            #     testEndpoint.jsonResponse = None
+            #
+            # if any(['imageResponse' in keys, 'xmlResponse' in keys, 'jsonResponse' in keys, 'responseData' in keys]):
+            #     testEndpoint.testID = TE.get('testID')
+            #     testEndpoint.parentID = TE.get('parentID')
+            #     testEndpoint.startDatetime = datetime.utcfromtimestamp(float(TE.get('startDatetime')))
+            #     testEndpoint.finishDatetime = datetime.utcfromtimestamp(float(TE.get('finishDatetime')))
+            #     testEndpoint.success = bool(TE.get('success'))
+            #     testEndpoint.comment = TE.get('comment')
+            #     testEndpoint.server = TE.get('server')
+            #     testEndpoint.dataset = TE.get('dataset')
+            #     testEndpoint.returnType = TE.get('returnType')
+            #     testEndpoint.testName = TE.get('testName')
+            #     testEndpoint.httpMethod = TE.get('httpMethod')
+            #     testEndpoint.testedURL = TE.get('testedURL')
+            #     testEndpoint.responseCode = int(TE.get('responseCode'))
+            #     testEndpoint.errorResponse = TE.get('errorResponse')
+            #     testEndpoint.analysed = AnalysisEnum.UNANALYSED
+            #
+            #     stats.countTestEndpoints += 1
+            #     stats.totalTestEndpointTime += (TE.get('finishDatetime') - TE.get('startDatetime'))
+            #     if testEndpoint.success:
+            #         stats.countTestEndpointsSuccessful += 1
+            #
+            #     listTestEndpoints.append(testEndpoint)
+
+        for NR in TM.get('networkResults', []):
+            networkResult = NetworkResult(parent=masterKey)
+            networkResult.testID = NR.get('testID')
+            networkResult.parentID = NR.get('parentID')
+            networkResult.datetime = datetime.utcfromtimestamp(float(NR.get('datetime')))
+            networkResult.success = bool(NR.get('success'))
+            networkResult.comment = NR.get('comment')
+            networkResult.connectionType = NR.get('connectionType')
+            networkResult.carrierName = NR.get('carrierName')
+            networkResult.cellID = NR.get('cellID')
+
+            stats.countNetworkResults += 1
+
+            pipeline.add(networkResult)
+
+        for LR in TM.get('locationResults', []):
+            locationResult = LocationResult(parent=masterKey)
+            locationResult.testID = LR.get('testID')
+            locationResult.parentID = LR.get('parentID')
+            locationResult.datetime = datetime.utcfromtimestamp(float(LR.get('datetime')))
+            locationResult.success = bool(LR.get('success'))
+            locationResult.comment = LR.get('comment')
+            locationResult.location = ndb.GeoPt(str(LR.get('latitude')) + ', ' +
+                                                str(LR.get('longitude')))
+
+            stats.countLocationResults += 1
+
+            pipeline.add(locationResult)
+
+        for PR in TM.get('pingResults', []):
+            pingResult = PingResult(parent=masterKey)
+            pingResult.testID = PR.get('testID')
+            pingResult.parentID = PR.get('parentID')
+            pingResult.datetime = datetime.utcfromtimestamp(float(PR.get('datetime')))
+            pingResult.success = bool(PR.get('success'))
+            pingResult.comment = PR.get('comment')
+            pingResult.pingedURL = PR.get('pingedURL')
+            pingResult.pingTime = float(PR.get('pingTime'))
+
+            stats.countPingResults += 1
+            stats.countPingResultsSuccessful += pingResult.success
+            stats.totalPingTime += pingResult.pingTime
+
+            pipeline.add(pingResult)
+
+        blobWriter.flush()
+
+    def finish(self, listFinalEntities=None, precondition=None):
+        """Waits for every batch to land, then adds the upload's counts to
+        a CampaignStats shard once for the whole upload, together with its
+        TestMasters and any listFinalEntities in a single transaction.
+        The TestMasters all share the campaign's entity group, so this
+        spans only that group and the stats shard's. precondition is as
+        for incrementCampaignStats()."""
+        self.flushPending()
+        self.pipeline.finish()
+        self.blobWriter.commit()
+
+        dictDelta = dict((name, value) for name, value in self.stats.to_dict().items() if value)
+        incrementCampaignStats(self.campaignName, dictDelta, self.listTestMasters + (listFinalEntities or []), precondition)
+
+
 class Database(webapp2.RequestHandler):
     """The workhorse part of the web application.
-    Accepts properly formatted JSON in POST requests then builds
-    model objects for storage."""
+    Accepts properly formatted JSON, or the same structure encoded as
+    MessagePack, in POST requests then builds model objects for storage."""
     def post(self):
-        dictResults = {}
-
-        # Check for string request bodies, use either the "load" or "loads"
-        # functions depending.
-        if type(self.request.body) is str:
-            dictResults = json.loads(self.request.body, strict=False)
-        else:
-            dictResults = json.load(self.request.body)
-
         try:
-            campaignName = dictResults.get('campaignName')
-            campaignKey = getCampaignKey(campaignName)
-
-            # Get the CampaignStats record for this campaign.
-            stats_query = CampaignStats.query(CampaignStats.campaignName == campaignName)
-            stats = stats_query.get()
-
-            # There is no extant CampaignStats record for this campaign.
-            # Instantiate one with blank values.
-            if stats is None:
-                stats = CampaignStats(parent=campaignKey)
-                stats.campaignName = campaignName
-                stats.countTestMasters = 0
-                stats.allDeviceTypes = ""
-                stats.allOSVersions = ""
-                stats.countTestEndpoints = 0
-                stats.totalTestEndpointTime = 0.0
-                stats.countTestEndpointsSuccessful = 0
-                stats.countNetworkResults = 0
-                stats.countLocationResults = 0
-                stats.countPingResults = 0
-                stats.countPingResultsSuccessful = 0
-                stats.totalPingTime = 0
-                stats.ESRI_BusStops_AttributeFilter_GET_JSON = 0
-                stats.ESRI_BusStops_AttributeFilter_POST_JSON = 0
-                stats.ESRI_BusStops_Big_GET_JSON = 0
-                stats.ESRI_BusStops_Big_POST_JSON = 0
-                stats.ESRI_BusStops_FeatureByID_GET_JSON = 0
-                stats.ESRI_BusStops_FeatureByID_POST_JSON = 0
-                stats.ESRI_BusStops_GetCapabilities_GET_JSON = 0
-                stats.ESRI_BusStops_GetCapabilities_POST_JSON = 0
-                stats.ESRI_BusStops_IntersectFilter_GET_JSON = 0
-                stats.ESRI_BusStops_IntersectFilter_POST_JSON = 0
-                stats.ESRI_BusStops_Small_GET_JSON = 0
-                stats.ESRI_BusStops_Small_POST_JSON = 0
-                stats.ESRI_Topo_Big_POST_Image = 0
-                stats.ESRI_Topo_Small_GET_Image = 0
-                stats.ESRI_Topo_Small_POST_Image = 0
-                stats.GME_AerialPhoto_Big_GET_Image = 0
-                stats.GME_AerialPhoto_GetTileKVP_GET_Image = 0
-                stats.GME_AerialPhoto_GetTileKVP2_GET_Image = 0
-                stats.GME_AerialPhoto_GetTileKVP3_GET_Image = 0
-                stats.GME_AerialPhoto_GetTileKVP4_GET_Image = 0
-                stats.GME_AerialPhoto_Small_GET_Image = 0
-                stats.GME_AerialPhoto_WMSGetCapabilities_GET_XML = 0
-                stats.GME_AerialPhoto_WMTSGetCapabilities_GET_XML = 0
-                stats.GME_BusStops_AttributeFilter_GET_JSON = 0
-                stats.GME_BusStops_Big_GET_JSON = 0
-                stats.GME_BusStops_DistanceFilter_GET_JSON = 0
-                stats.GME_BusStops_FeatureByID_GET_JSON = 0
-                stats.GME_BusStops_IntersectFilter_GET_JSON = 0
-                stats.GME_BusStops_Small_GET_JSON = 0
-                stats.OGC_AerialPhoto_GetTileKVP_GET_Image = 0
-                stats.OGC_AerialPhoto_GetTileRestful_GET_Image = 0
-                stats.OGC_BusStops_AttributeFilter_GET_JSON = 0
-                stats.OGC_BusStops_AttributeFilter_GET_XML = 0
-                stats.OGC_BusStops_AttributeFilter_POST_JSON = 0
-                stats.OGC_BusStops_AttributeFilter_POST_XML = 0
-                stats.OGC_BusStops_Big_GET_JSON = 0
-                stats.OGC_BusStops_Big_GET_XML = 0
-                stats.OGC_BusStops_Big_POST_JSON = 0
-                stats.OGC_BusStops_Big_POST_XML = 0
-                stats.OGC_BusStops_FeatureByID_GET_JSON = 0
-                stats.OGC_BusStops_FeatureByID_GET_XML = 0
-                stats.OGC_BusStops_FeatureByID_POST_JSON = 0
-                stats.OGC_BusStops_FeatureByID_POST_XML = 0
-                stats.OGC_BusStops_GetCapabilities_GET_XML = 0
-                stats.OGC_BusStops_GetCapabilities_POST_XML = 0
-                stats.OGC_BusStops_IntersectFilter_GET_JSON = 0
-                stats.OGC_BusStops_IntersectFilter_GET_XML = 0
-                stats.OGC_BusStops_IntersectFilter_POST_JSON = 0
-                stats.OGC_BusStops_IntersectFilter_POST_XML = 0
-                stats.OGC_BusStops_Small_GET_JSON = 0
-                stats.OGC_BusStops_Small_GET_XML = 0
-                stats.OGC_BusStops_Small_POST_JSON = 0
-                stats.OGC_BusStops_Small_POST_XML = 0
-                stats.OGC_Topo_Big_GET_Image = 0
-                stats.OGC_Topo_Small_GET_Image = 0
-                stats.ESRI_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_AttributeFilter_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_Big_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_Big_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_FeatureByID_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_GetCapabilities_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_GetCapabilities_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_IntersectFilter_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_Small_GET_JSON_ReferenceSuccess = 0
-                stats.ESRI_BusStops_Small_POST_JSON_ReferenceSuccess = 0
-                stats.ESRI_Topo_Big_POST_Image_ReferenceSuccess = 0
-                stats.ESRI_Topo_Small_GET_Image_ReferenceSuccess = 0
-                stats.ESRI_Topo_Small_POST_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_Big_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_GetTileKVP_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_GetTileKVP2_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_GetTileKVP3_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_GetTileKVP4_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_Small_GET_Image_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_WMSGetCapabilities_GET_XML_ReferenceSuccess = 0
-                stats.GME_AerialPhoto_WMTSGetCapabilities_GET_XML_ReferenceSuccess = 0
-                stats.GME_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
-                stats.GME_BusStops_Big_GET_JSON_ReferenceSuccess = 0
-                stats.GME_BusStops_DistanceFilter_GET_JSON_ReferenceSuccess = 0
-                stats.GME_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
-                stats.GME_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
-                stats.GME_BusStops_Small_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_AerialPhoto_GetTileKVP_GET_Image_ReferenceSuccess = 0
-                stats.OGC_AerialPhoto_GetTileRestful_GET_Image_ReferenceSuccess = 0
-                stats.OGC_BusStops_AttributeFilter_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_AttributeFilter_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_AttributeFilter_POST_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_AttributeFilter_POST_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_Big_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_Big_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_Big_POST_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_Big_POST_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_FeatureByID_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_FeatureByID_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_FeatureByID_POST_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_FeatureByID_POST_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_GetCapabilities_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_GetCapabilities_POST_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_IntersectFilter_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_IntersectFilter_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_IntersectFilter_POST_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_IntersectFilter_POST_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_Small_GET_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_Small_GET_XML_ReferenceSuccess = 0
-                stats.OGC_BusStops_Small_POST_JSON_ReferenceSuccess = 0
-                stats.OGC_BusStops_Small_POST_XML_ReferenceSuccess = 0
-                stats.OGC_Topo_Big_GET_Image_ReferenceSuccess = 0
-                stats.OGC_Topo_Small_GET_Image_ReferenceSuccess = 0
+            # Stream the upload one TestMaster at a time rather than
+            # decoding the whole body, uploads carry dozens of base64 map
+            # tiles per TestMaster and can run to tens of megabytes.
+            # The Content-Type chooses between JSON and MessagePack, and
+            # gzip or deflate Content-Encodings are inflated as we go.
+            dictHeader, TestMasters = iterUpload(self.request.body_file_seekable,
+                                                 self.request.headers.get('Content-Type'),
+                                                 self.request.headers.get('Content-Encoding'))
+
+            campaignName = dictHeader.get('campaignName')
+            ingester = UploadIngester(campaignName)
 
             # Loop through all the TestMasters and their children
             # creating database records and updating stats as we go.
-            for TM in dictResults.get('TestMasters', []):
-                # print TM
-                testMaster = TestMaster(parent=campaignKey)
-                testMaster.testID = TM.get('testID')
-                testMaster.parentID = TM.get('parentID')
-                testMaster.startDatetime = datetime.utcfromtimestamp(float(TM.get('startDatetime')))
-                testMaster.finishDatetime = datetime.utcfromtimestamp(float(TM.get('finishDatetime')))
-                testMaster.success = bool(TM.get('success'))
-                testMaster.comment = TM.get('comment')
-                testMaster.deviceType = TM.get('deviceType')
-                testMaster.deviceID = TM.get('deviceID')
-                testMaster.iOSVersion = TM.get('iOSVersion')
-
-                stats.countTestMasters += 1
-
-                if testMaster.deviceType not in stats.allDeviceTypes:
-                    stats.allDeviceTypes += testMaster.deviceType
-                    stats.allDeviceTypes += ", "
-
-                if testMaster.iOSVersion not in stats.allOSVersions:
-                    stats.allOSVersions += testMaster.iOSVersion
-                    stats.allOSVersions += ", "
-
-                masterKey = testMaster.put()
-
-                listTestEndpoints = []
-                for TE in TM.get('endpointResults', []):
-                    # print TE
-                    testEndpoint = TestEndpoint(parent=masterKey)
-
-                    testEndpoint.testID = TE.get('testID')
-                    testEndpoint.parentID = TE.get('parentID')
-                    testEndpoint.startDatetime = datetime.utcfromtimestamp(float(TE.get('startDatetime')))
-                    testEndpoint.finishDatetime = datetime.utcfromtimestamp(float(TE.get('finishDatetime')))
-                    testEndpoint.success = bool(TE.get('success'))
-                    testEndpoint.comment = TE.get('comment')
-                    testEndpoint.server = TE.get('server')
-                    testEndpoint.dataset = TE.get('dataset')
-                    testEndpoint.returnType = TE.get('returnType')
-                    testEndpoint.testName = TE.get('testName')
-                    testEndpoint.httpMethod = TE.get('httpMethod')
-                    testEndpoint.testedURL = TE.get('testedURL')
-                    testEndpoint.responseCode = int(TE.get('responseCode'))
-                    testEndpoint.responseData = TE.get('responseData', '')
-                    testEndpoint.errorResponse = TE.get('errorResponse')
-                    testEndpoint.analysed = AnalysisEnum.UNANALYSED
-
-                    stats.countTestEndpoints += 1
-                    stats.totalTestEndpointTime += (TE.get('finishDatetime') - TE.get('startDatetime'))
-                    stats.countTestEndpointsSuccessful += testEndpoint.success
-
-                    testString = testEndpoint.server + "_" + testEndpoint.dataset + "_" + testEndpoint.testName + "_" + testEndpoint.httpMethod + "_" + testEndpoint.returnType
-                    print testString
-
-                    if hasattr(stats, testString):
-                        newValue = getattr(stats, testString) + 1
-                        setattr(stats, testString, newValue)
-
-                    listTestEndpoints.append(testEndpoint)
-
-                    """No longer need to make concrete subclasses of
-                    TestEndpoint as all three types store their responseData
-                    in TextProperty()'s nowadays.'"""
-                    # testEndpoint = None
-                    # keys = TE.keys()
-                    # if 'imageResponse' in keys:
-                    #     testEndpoint = ImageEndpoint(parent=masterKey)
-                    #     testEndpoint.imageResponse = str(TE.get('imageResponse'))
-                    # elif 'xmlResponse' in keys:
-                    #     testEndpoint = XmlEndpoint(parent=masterKey)
-                    #     testEndpoint.xmlResponse = TE.get('xmlResponse')
-                    # elif 'jsonResponse' in keys:
-                    #     testEndpoint = JsonEndpoint(parent=masterKey)
-                    #     testEndpoint.jsonResponse = TE.get('jsonResponse')
-                    # elif 'responseData' in keys:
-                    #     # There was no response to the original request (likely no connectivity)
-                    #     # Here we set to a null json response.
-                    #     testEndpoint = JsonEndpoint(parent=masterKey)
-                    #     testEndpoint.jsonResponse = None
-                    #
-                    # if any(['imageResponse' in keys, 'xmlResponse' in keys, 'jsonResponse' in keys, 'responseData' in keys]):
-                    #     testEndpoint.testID = TE.get('testID')
-                    #     testEndpoint.parentID = TE.get('parentID')
-                    #     testEndpoint.startDatetime = datetime.utcfromtimestamp(float(TE.get('startDatetime')))
-                    #     testEndpoint.finishDatetime = datetime.utcfromtimestamp(float(TE.get('finishDatetime')))
-                    #     testEndpoint.success = bool(TE.get('success'))
-                    #     testEndpoint.comment = TE.get('comment')
-                    #     testEndpoint.server = TE.get('server')
-                    #     testEndpoint.dataset = TE.get('dataset')
-                    #     testEndpoint.returnType = TE.get('returnType')
-                    #     testEndpoint.testName = TE.get('testName')
-                    #     testEndpoint.httpMethod = TE.get('httpMethod')
-                    #     testEndpoint.testedURL = TE.get('testedURL')
-                    #     testEndpoint.responseCode = int(TE.get('responseCode'))
-                    #     testEndpoint.errorResponse = TE.get('errorResponse')
-                    #     testEndpoint.analysed = AnalysisEnum.UNANALYSED
-                    #
-                    #     stats.countTestEndpoints += 1
-                    #     stats.totalTestEndpointTime += (TE.get('finishDatetime') - TE.get('startDatetime'))
-                    #     if testEndpoint.success:
-                    #         stats.countTestEndpointsSuccessful += 1
-                    #
-                    #     listTestEndpoints.append(testEndpoint)
-
-                listNetworkResults = []
-                for NR in TM.get('networkResults', []):
-                    networkResult = NetworkResult(parent=masterKey)
-                    networkResult.testID = NR.get('testID')
-                    networkResult.parentID = NR.get('parentID')
-                    networkResult.datetime = datetime.utcfromtimestamp(float(NR.get('datetime')))
-                    networkResult.success = bool(NR.get('success'))
-                    networkResult.comment = NR.get('comment')
-                    networkResult.connectionType = NR.get('connectionType')
-                    networkResult.carrierName = NR.get('carrierName')
-                    networkResult.cellID = NR.get('cellID')
-
-                    stats.countNetworkResults += 1
-
-                    listNetworkResults.append(networkResult)
-
-                listLocationResults = []
-                for LR in TM.get('locationResults', []):
-                    locationResult = LocationResult(parent=masterKey)
-                    locationResult.testID = LR.get('testID')
-                    locationResult.parentID = LR.get('parentID')
-                    locationResult.datetime = datetime.utcfromtimestamp(float(LR.get('datetime')))
-                    locationResult.success = bool(LR.get('success'))
-                    locationResult.comment = LR.get('comment')
-                    locationResult.location = ndb.GeoPt(str(LR.get('latitude')) + ', ' +
-                                                        str(LR.get('longitude')))
-
-                    stats.countLocationResults += 1
-
-                    listLocationResults.append(locationResult)
-
-                listPingResults = []
-                for PR in TM.get('pingResults', []):
-                    pingResult = PingResult(parent=masterKey)
-                    pingResult.testID = PR.get('testID')
-                    pingResult.parentID = PR.get('parentID')
-                    pingResult.datetime = datetime.utcfromtimestamp(float(PR.get('datetime')))
-                    pingResult.success = bool(PR.get('success'))
-                    pingResult.comment = PR.get('comment')
-                    pingResult.pingedURL = PR.get('pingedURL')
-                    pingResult.pingTime = float(PR.get('pingTime'))
-
-                    stats.countPingResults += 1
-                    stats.countPingResultsSuccessful += pingResult.success
-                    stats.totalPingTime += pingResult.pingTime
-
-                    listPingResults.append(pingResult)
-
-                # Push everything to database.
-                # This is done at the end to help prevent orphaned objects
-                # if the function hits an exception partway through.
-                listTestEndpointKeys = ndb.put_multi(listTestEndpoints)
-                listNetworkKeys = ndb.put_multi(listNetworkResults)
-                listLocationKeys = ndb.put_multi(listLocationResults)
-                listPingKeys = ndb.put_multi(listPingResults)
-                stats.put()
-
-                # Add an analysis task to the default queue for each
-                # endpoint test completed.
-                for endpoint in listTestEndpoints:
-                    taskqueue.add(url='/analyse', method='GET', params={'campaignName': campaignName, 'testID': endpoint.testID})
+            # Each TestMaster is parsed, queued for storage and dropped in
+            # turn so peak memory depends on the largest TestMaster only.
+            for TM in TestMasters:
+                ingester.addTestMaster(TM)
+
+            # We wait for every batch to land before queueing analysis
+            # so no task can run ahead of the entities it analyses.
+            ingester.finish()
+
+            # Add analysis tasks to the default queue, either one per
+            # TestMaster or one per endpoint test completed.
+            analyseBy = self.request.get('analyseBy', DEFAULT_ANALYSE_BY)
+            enqueueAnalysisTasks(campaignName, ingester.listAnalysisTargets, analyseBy)
 
             self.response.headers['Content-Type'] = 'text/plain'
             self.response.write('Results successfully uploaded.\n' +
                                 'Thank you for contributing!\n\n')
+            if ingester.countSkipped:
+                self.response.write(str(ingester.countSkipped) + ' TestMasters were already stored and skipped.\n\n')
 
         except Exception as e:
             self.response.set_status(555, message="Custom error response code.")
@@ -503,9 +886,17 @@ class Database(webapp2.RequestHandler):
 
                     testEndpoint_query = TestEndpoint.query(ancestor=masterKey).order(TestEndpoint.startDatetime)
                     listTestEndpoints = testEndpoint_query.fetch()
+
+                    # Fetch the distinct response bodies in one batch, the
+                    # context cache then serves each getResponseData().
+                    setDigests = set(TE.responseDigest for TE in listTestEndpoints if TE.responseDigest)
+                    ndb.get_multi([ndb.Key(ResponseBlob, digest) for digest in setDigests])
+
                     listOutputTestEndpoints = []
                     for TE in listTestEndpoints:
-                        listOutputTestEndpoints.append(TE.to_dict())
+                        dictEndpoint = TE.to_dict()
+                        dictEndpoint['responseData'] = TE.getResponseData()
+                        listOutputTestEndpoints.append(dictEndpoint)
 
                     dictMaster['TestEndpoints'] = listOutputTestEndpoints
 
@@ -565,6 +956,203 @@ class Database(webapp2.RequestHandler):
             self.response.write('Deleted TestCampaign; ' + campaignName)
 
 
+class Manifest(webapp2.RequestHandler):
+    """A cheap pre-flight check for uploads. POST a JSON object with a
+    campaignName and a list of testIDs and get back those testIDs already
+    stored, so a device retrying after a timeout need only send the rest."""
+    def post(self):
+        try:
+            dictManifest = json.loads(self.request.body)
+            campaignName = dictManifest.get('campaignName')
+            listTestIDs = dictManifest.get('testIDs', [])
+            dictStored = findStoredTestMasters(getCampaignKey(campaignName), listTestIDs)
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Improperly formatted JSON manifest.\n' +
+                                'Please provide {"campaignName": ..., "testIDs": [...]}\n\n' +
+                                e.message + '\n\n')
+        else:
+            dictOutput = {}
+            dictOutput['campaignName'] = campaignName
+            dictOutput['storedTestIDs'] = [testID for testID in listTestIDs if testID in dictStored]
+
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(dictOutput, indent=4))
+
+
+def deleteTestMastersByPrefix(campaignKey, prefix):
+    """Deletes the TestMasters whose key names start with prefix, and all
+    of their children. These are what an interrupted upload session chunk
+    leaves behind, found with a keys only key range query. The query is
+    kindless so it also finds the children of a TestMaster that was never
+    written, which sort between its key and the next."""
+    query = ndb.Query(ancestor=campaignKey,
+                      filters=ndb.AND(ndb.FilterNode('__key__', '>=', ndb.Key(TestMaster, prefix + '-', parent=campaignKey)),
+                                      ndb.FilterNode('__key__', '<', ndb.Key(TestMaster, prefix + '.', parent=campaignKey))))
+
+    ndb.delete_multi(query.fetch(keys_only=True))
+
+
+class UploadSessions(webapp2.RequestHandler):
+    """Resumable uploads for large campaign dumps over flaky links.
+    A device opens a session, sends its TestMasters as numbered chunks,
+    each in any format Database.post accepts, then commits. Each chunk is
+    durable once acknowledged so a retry need only resend missing chunks.
+    POST ?action=open&campaignName=&chunkCount= opens a session.
+    POST ?sessionID=&chunk= stores one chunk.
+    POST ?sessionID=&action=commit queues analysis once all chunks are in.
+    GET ?sessionID= reports the chunks received and missing."""
+    def get(self):
+        try:
+            session = ndb.Key(urlsafe=self.request.get('sessionID')).get()
+            if session is None:
+                raise ValueError('No such upload session.')
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Missing or invalid parameter in request.\n' +
+                                'Please provide ?sessionID=\n\n' +
+                                e.message + '\n\n')
+        else:
+            self.writeStatus(session)
+
+    def post(self):
+        action = self.request.get('action', 'chunk')
+
+        try:
+            if action == 'open':
+                campaignName = self.request.get('campaignName')
+                session = UploadSession(parent=getCampaignKey(campaignName))
+                session.campaignName = campaignName
+                session.chunkCount = int(self.request.get('chunkCount'))
+                session.analyseBy = self.request.get('analyseBy', DEFAULT_ANALYSE_BY)
+                session.put()
+
+            else:
+                session = ndb.Key(urlsafe=self.request.get('sessionID')).get()
+                if session is None:
+                    raise ValueError('No such upload session.')
+
+                if action == 'commit':
+                    self.commitSession(session)
+                else:
+                    self.storeChunk(session, int(self.request.get('chunk')))
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Sorry, your upload session request was not successful.\n' +
+                                'Please check the session status and retry.\n\n' +
+                                e.message + '\n\n')
+        else:
+            self.writeStatus(session)
+
+    def storeChunk(self, session, chunkNumber):
+        """Stores one chunk of TestMasters unless it is already durable.
+        A chunk's TestMasters are named after the session and chunk so any
+        left by an interrupted attempt are deleted before we start again.
+        The chunk is claimed in a transaction before anything is written,
+        so a retry overlapping the original request is refused rather than
+        deleting and rewriting its entities, and the claim is checked again
+        in the transaction that makes the chunk durable."""
+        if session.committed:
+            raise ValueError('Upload session is already committed.')
+        if not 0 <= chunkNumber < session.chunkCount:
+            raise ValueError('No such chunk as ' + str(chunkNumber) + '.')
+
+        chunkKey = ndb.Key(UploadChunk, str(chunkNumber), parent=session.key)
+        claimKey = ndb.Key(UploadChunkClaim, str(chunkNumber), parent=session.key)
+        token = uuid.uuid4().hex
+        if not ndb.transaction(lambda: self.claimChunk(chunkKey, claimKey, token)):
+            return
+
+        def checkClaim():
+            claim = claimKey.get()
+            if chunkKey.get() is not None or claim is None or claim.token != token:
+                raise ValueError('Chunk ' + str(chunkNumber) + ' was stored by another request.')
+
+        try:
+            prefix = 'session' + str(session.key.id()) + '-chunk' + str(chunkNumber)
+            ingester = UploadIngester(session.campaignName, masterKeyPrefix=prefix)
+            deleteTestMastersByPrefix(ingester.campaignKey, prefix)
+
+            dictHeader, TestMasters = iterUpload(self.request.body_file_seekable,
+                                                 self.request.headers.get('Content-Type'),
+                                                 self.request.headers.get('Content-Encoding'))
+            for TM in TestMasters:
+                ingester.addTestMaster(TM)
+
+            chunk = UploadChunk(key=chunkKey)
+            chunk.analysisTargets = [[masterKey.urlsafe(), listEndpointIDs] for masterKey, listEndpointIDs in ingester.listAnalysisTargets]
+            ingester.finish([chunk], checkClaim)
+
+        except Exception:
+            # Let a retry start again at once rather than wait out the claim.
+            ndb.transaction(lambda: self.releaseChunk(claimKey, token))
+            raise
+
+    def claimChunk(self, chunkKey, claimKey, token):
+        """Claims a chunk for the request named token, within a transaction.
+        Returns False if the chunk is already durable, raises if another
+        request holds a claim younger than CHUNK_CLAIM_SECONDS."""
+        if chunkKey.get() is not None:
+            return False
+
+        now = datetime.utcnow()
+        claim = claimKey.get()
+        if claim is not None and now - claim.claimed < timedelta(seconds=CHUNK_CLAIM_SECONDS):
+            raise ValueError('Chunk ' + claimKey.id() + ' is already being stored, please retry shortly.')
+
+        UploadChunkClaim(key=claimKey, token=token, claimed=now).put()
+        return True
+
+    def releaseChunk(self, claimKey, token):
+        claim = claimKey.get()
+        if claim is not None and claim.token == token:
+            claim.key.delete()
+
+    def commitSession(self, session):
+        """Queues analysis of every chunk once all of them are durable.
+        Committing twice is harmless."""
+        if session.committed:
+            return
+
+        listMissing = self.missingChunks(session, self.receivedChunks(session))
+        if listMissing:
+            raise ValueError('Upload session is missing chunks ' + str(listMissing) + '.')
+
+        listChunks = ndb.get_multi([ndb.Key(UploadChunk, str(chunkNumber), parent=session.key) for chunkNumber in range(session.chunkCount)])
+        listAnalysisTargets = [(ndb.Key(urlsafe=masterKey), listEndpointIDs) for chunk in listChunks for masterKey, listEndpointIDs in chunk.analysisTargets]
+        enqueueAnalysisTasks(session.campaignName, listAnalysisTargets, session.analyseBy)
+
+        session.committed = True
+        session.put()
+
+    def receivedChunks(self, session):
+        return sorted(int(key.id()) for key in UploadChunk.query(ancestor=session.key).fetch(keys_only=True))
+
+    def missingChunks(self, session, listReceived):
+        setReceived = set(listReceived)
+        return [chunkNumber for chunkNumber in range(session.chunkCount) if chunkNumber not in setReceived]
+
+    def writeStatus(self, session):
+        listReceived = self.receivedChunks(session)
+
+        dictStatus = {}
+        dictStatus['sessionID'] = session.key.urlsafe()
+        dictStatus['campaignName'] = session.campaignName
+        dictStatus['chunkCount'] = session.chunkCount
+        dictStatus['receivedChunks'] = listReceived
+        dictStatus['missingChunks'] = self.missingChunks(session, listReceived)
+        dictStatus['committed'] = session.committed
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(dictStatus, indent=4, cls=CustomEncoder))
+
+
 class StoreReferences(webapp2.RequestHandler):
     """A very simple class to add a task to the default task queue
     to store the referenceObjects in the folder.
@@ -606,6 +1194,7 @@ class StoreReferencesWorker(webapp2.RequestHandler):
             # appending the extra folder path component.
             appPath = os.path.split(__file__)[0]
             referenceFolderPath = os.path.join(appPath, 'ReferenceObjects')
+            referenceImagesPath = os.path.join(appPath, 'ReferenceImages')
 
             for root, directories, filenames in os.walk(referenceFolderPath):
                 for filename in filenames:
@@ -641,15 +1230,390 @@ class StoreReferencesWorker(webapp2.RequestHandler):
                         with open(referenceFilePath, 'r') as referenceText:
                             referenceObject.reference = referenceText.read()
 
+                        referenceObject.referenceDigest = digestResponse(referenceObject.reference)
+
+                        # Fingerprint image references from the PNG in
+                        # ReferenceImages if there is one.
+                        imageData = None
+                        referenceImagePath = os.path.join(referenceImagesPath, filenameParts[0] + '.png')
+                        if referenceObject.returnType == 'Image' and os.path.exists(referenceImagePath):
+                            with open(referenceImagePath, 'rb') as referenceImage:
+                                imageData = referenceImage.read()
+
+                        # Normalise, fingerprint and index the reference
+                        # once here rather than on every analysis.
+                        dictReference = prepareReference(referenceObject.reference, referenceObject.returnType, imageData)
+
+                        # A second, normalised copy of the largest references
+                        # would take the entity over the datastore's 1 MB
+                        # limit. Keep it only where it differs from the
+                        # reference, and never for images, which are matched
+                        # by fingerprint.
+                        if referenceObject.returnType == 'Image' or dictReference['normalisedReference'] == referenceObject.reference:
+                            dictReference['normalisedReference'] = None
+                        referenceObject.populate(**dictReference)
+
                         # Store the new data.
                         key = referenceObject.put()
 
+            # Analyses must not keep matching against the old references.
+            invalidateReferenceCache()
+
             # Complete success, write output.
             self.response.headers['Content-Type'] = 'text/plain'
             self.response.write('Stored referenceObjects for ' + campaignName)
 
 
 
+def getVectorKey(campaignKey, endpointKey):
+    """Returns the key of the Vector for a TestEndpoint. Named after the
+    endpoint so analysing it again overwrites its Vector."""
+    return ndb.Key(Vector, str(endpointKey.parent().id()) + '-' + str(endpointKey.id()), parent=campaignKey)
+
+
+class ReferenceCache(object):
+    """A least recently used cache of ReferenceObjects in instance memory,
+    keyed by the five part test signature. Entries are only valid for the
+    generation they were cached under, a counter in memcache bumped by
+    invalidateReferenceCache() whenever the references are rewritten.
+    The counter is read at most every REFERENCE_GENERATION_CHECK_SECONDS,
+    so the steady state costs no RPCs at all."""
+    def __init__(self, size=REFERENCE_CACHE_SIZE):
+        self.size = size
+        self.dictEntries = OrderedDict()
+        self.generation = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def currentGeneration(self):
+        """Returns the generation, clearing the cache if it has moved on."""
+        now = time.time()
+        if now - self.checked > REFERENCE_GENERATION_CHECK_SECONDS:
+            generation = getReferenceGeneration()
+            with self.lock:
+                if generation != self.generation:
+                    self.dictEntries.clear()
+                    self.generation = generation
+                self.checked = now
+        return self.generation
+
+    def get(self, signature):
+        """Returns (True, referenceObject) on a hit, (False, None) otherwise.
+        A cached referenceObject of None records a test with no reference."""
+        with self.lock:
+            if signature not in self.dictEntries:
+                return False, None
+            referenceObject = self.dictEntries.pop(signature)
+            self.dictEntries[signature] = referenceObject
+            return True, referenceObject
+
+    def put(self, signature, referenceObject, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.dictEntries.pop(signature, None)
+            self.dictEntries[signature] = referenceObject
+            while len(self.dictEntries) > self.size:
+                self.dictEntries.popitem(last=False)
+
+
+REFERENCE_CACHE = ReferenceCache()
+
+
+def getReferenceGeneration():
+    """Returns the generation of the cached ReferenceObjects, a memcache
+    counter bumped by invalidateReferenceCache(). A missing counter, never
+    set or evicted, starts again from the time in milliseconds so it never
+    repeats a generation whose entries may still be in memcache."""
+    generation = memcache.get(REFERENCE_GENERATION_KEY)
+    if generation is None:
+        memcache.add(REFERENCE_GENERATION_KEY, int(time.time() * 1000))
+        generation = memcache.get(REFERENCE_GENERATION_KEY) or 0
+    return generation
+
+
+def invalidateReferenceCache():
+    """Retires every cached ReferenceObject, in memcache immediately and
+    in each instance's memory within REFERENCE_GENERATION_CHECK_SECONDS."""
+    memcache.incr(REFERENCE_GENERATION_KEY, initial_value=int(time.time() * 1000))
+
+
+@ndb.tasklet
+def getReferenceObjectAsync(server, dataset, name, httpMethod, returnType):
+    """Returns a future for the 'True' ReferenceObject of a test, from
+    instance memory, then memcache, then the datastore."""
+    signature = (server, dataset, name, httpMethod, returnType)
+    generation = REFERENCE_CACHE.currentGeneration()
+
+    found, referenceObject = REFERENCE_CACHE.get(signature)
+    if found:
+        raise ndb.Return(referenceObject)
+
+    # Keys name the generation so a bump retires every memcache entry.
+    cacheKey = 'ReferenceObject-' + str(generation) + '-' + '_'.join(part or '' for part in signature)
+    context = ndb.get_context()
+    referenceObject = yield context.memcache_get(cacheKey)
+
+    if referenceObject is None:
+        referenceObject = yield ReferenceObject.query(ReferenceObject.server == server, ReferenceObject.dataset == dataset, ReferenceObject.name == name, ReferenceObject.httpMethod == httpMethod, ReferenceObject.returnType == returnType).get_async()
+        if referenceObject is not None:
+            yield context.memcache_set(cacheKey, referenceObject, time=REFERENCE_CACHE_SECONDS)
+
+    REFERENCE_CACHE.put(signature, referenceObject, generation)
+    raise ndb.Return(referenceObject)
+
+
+def checkReference(responseData, referenceObject, vector):
+    """Returns whether responseData passes the reference check against
+    referenceObject, see checkPreparedReference(). The matched and missing
+    feature counts of JSON and GML responses are recorded on the vector."""
+    if referenceObject.normalisedReference is None:
+        # Stored before references were normalised on the way in, or an
+        # image or already normalised reference kept only the one copy.
+        normalisedReference = normaliseResponse(referenceObject.reference)
+        normalisedDigest = referenceObject.normalisedDigest or digestResponse(normalisedReference)
+    else:
+        normalisedReference = referenceObject.normalisedReference.encode('ascii')
+        normalisedDigest = referenceObject.normalisedDigest
+
+    success, matched, missing = checkPreparedReference(responseData, referenceObject.returnType, normalisedReference, normalisedDigest,
+                                                       referenceObject.fingerprint, referenceObject.featureIndex)
+    if matched is not None:
+        vector.referenceMatchedFeatures = matched
+        vector.referenceMissingFeatures = missing
+    return success
+
+
+def buildVector(campaignKey, testEndpoint, testMaster, neighbours, referenceObject):
+    """Builds the Vector for a single TestEndpoint from its six neighbours,
+    (preTestLocation, postTestLocation, preTestNetwork, postTestNetwork,
+    preTestPing, postTestPing), and its ReferenceObject, then marks the
+    endpoint with the outcome. Returns the Vector or None if the analysis
+    is impossible. Nothing is stored, the caller puts both."""
+    preTestLocation, postTestLocation, preTestNetwork, postTestNetwork, preTestPing, postTestPing = neighbours
+
+    # Each TestEndpoint should have a LocationTest, NetworkTest and
+    # PingTest before AND afterwards, if all six are present proceed
+    if not (preTestLocation and postTestLocation and preTestNetwork and postTestNetwork and preTestPing and postTestPing):
+        """If we don't have all six supporting tests (as is possible
+        where a TestMaster may have been cancelled) the analysis
+        is IMPOSSIBLE, mark the testEndpoint with the enum so we
+        may ignore it in the future."""
+        testEndpoint.analysed = AnalysisEnum.IMPOSSIBLE
+        print "Analysis IMPOSSIBLE"
+        return None
+
+    # Create a new Vector analysis data structure.
+    vector = Vector(key=getVectorKey(campaignKey, testEndpoint.key))
+
+    # Assign all the TestEndpoint's relevant attributes to Vector
+    vector.testKey = testEndpoint.key
+    vector.name = testEndpoint.testName
+    vector.startDateTime = testEndpoint.startDatetime
+    vector.finishDateTime = testEndpoint.finishDatetime
+    vector.responseTime = (testEndpoint.finishDatetime - testEndpoint.startDatetime).total_seconds()
+    vector.server = testEndpoint.server
+    vector.dataset = testEndpoint.dataset
+    vector.httpMethod = testEndpoint.httpMethod
+    vector.returnType = testEndpoint.returnType
+    vector.responseCode = testEndpoint.responseCode
+    vector.onDeviceSuccess = testEndpoint.success
+    vector.referenceCheckValid = isReferenceCheckValid(vector.server, vector.dataset, vector.name, vector.httpMethod, vector.returnType)
+
+    # Default to false for reference check truthiness.
+    vector.referenceCheckSuccess = False
+
+    # Check whether the referenceObject's text can
+    # be found in the testEndpoint's response.
+    # Identical digests match without touching either body.
+    if referenceObject is not None and testEndpoint.responseDigest is not None and testEndpoint.responseDigest == referenceObject.referenceDigest:
+        vector.referenceCheckSuccess = True
+        if referenceObject.featureIndex is not None:
+            vector.referenceMatchedFeatures = len(referenceObject.featureIndex)
+            vector.referenceMissingFeatures = 0
+    elif referenceObject is not None:
+        vector.referenceCheckSuccess = checkReference(testEndpoint.getResponseData(), referenceObject, vector)
+
+    print vector.referenceCheckSuccess
+
+    # Assign the TestMaster's attributes
+    vector.deviceType = testMaster.deviceType
+    vector.deviceID = testMaster.deviceID
+    vector.iOSVersion = testMaster.iOSVersion
+
+    # Refer to all the supporting tests from the Vector
+    vector.preTestLocationKey = preTestLocation.key
+    vector.postTestLocationKey = postTestLocation.key
+    vector.preTestNetworkKey = preTestNetwork.key
+    vector.postTestNetworkKey = postTestNetwork.key
+    vector.preTestPingKey = preTestPing.key
+    vector.postTestPingKey = postTestPing.key
+    vector.location = preTestLocation.location
+
+    # Calculate the change in environment during the test
+    vector.distance, vector.speed, vector.pingChange, vector.networkChange = measureChanges(
+        preTestLocation.location, postTestLocation.location,
+        (postTestLocation.datetime - preTestLocation.datetime).total_seconds(),
+        preTestPing.pingTime, postTestPing.pingTime,
+        preTestNetwork.connectionType, postTestNetwork.connectionType)
+
+    # All being well, we mark the testEndpoint object with
+    # the analysis SUCCESSFUL enum.
+    testEndpoint.analysed = AnalysisEnum.SUCCESSFUL
+    print "Analysis SUCCESSFUL"
+    return vector
+
+
+def referenceSuccessDelta(listVectors):
+    """Returns the CampaignStats increments for the reference checks
+    passed by listVectors."""
+    dictDelta = {}
+    for vector in listVectors:
+        vectorString = vector.server + "_" + vector.dataset + "_" + vector.name + "_" + vector.httpMethod + "_" + vector.returnType + "_ReferenceSuccess"
+        if vectorString in STATS_COUNTER_FIELDS and vector.referenceCheckSuccess:
+            dictDelta[vectorString] = dictDelta.get(vectorString, 0) + 1
+    return dictDelta
+
+
+def analysisBatchName(listTestEndpoints):
+    """Returns the name of the batch analysing listTestEndpoints, the same
+    for every retry of their analysis."""
+    listKeys = sorted(testEndpoint.key.urlsafe() for testEndpoint in listTestEndpoints)
+    return 'analyse-' + hashlib.sha1(','.join(listKeys)).hexdigest()
+
+
+def recordAnalysedVectorsAsync(campaignName, listVectors, batchName=None):
+    """Records newly analysed Vectors everywhere other than the Vectors
+    themselves. Appends them to the campaign's snapshot, then adds their
+    reference check successes to the campaign stats and counts, sketches
+    and sums the valid ones, all in one transaction marking batchName
+    done, and bumps the data version that retires its cached graphs.
+    Returns a future."""
+    listValid = [vector for vector in listVectors if vector.referenceCheckValid]
+    dictDelta = referenceSuccessDelta(listVectors)
+
+    addStats = None
+    if dictDelta:
+        addStats = lambda: addCampaignStats(campaignName, dictDelta)
+
+    return recordVectorChangesAsync(campaignName, listVectors, listValid, batchName=batchName, addStats=addStats)
+
+
+def analyseEndpoint(campaignName, campaignKey, testEndpoint, testMaster=None):
+    """Builds and stores the Vector for a single TestEndpoint and marks the
+    endpoint with the outcome. Returns the AnalysisEnum value assigned."""
+    return analyseEndpointAsync(campaignName, campaignKey, testEndpoint, testMaster).get_result()
+
+
+@ndb.tasklet
+def analyseEndpointAsync(campaignName, campaignKey, testEndpoint, testMaster=None):
+    """The tasklet behind analyseEndpoint. Every lookup it needs is
+    independent so all of them are in flight together, and the writes go
+    out together too, the whole costing about two round trips.
+    The TestMaster is fetched by the endpoint's parent key if not given."""
+    masterKey = testEndpoint.key.parent()
+
+    """Get the supporting tests either side of the EndpointTest
+    The query object filters by those tests with the same TestMaster
+    parent and a time greater than the EndpointTest's time. It sorts
+    all the returns by time (ascending or descending depending)
+    and the .get_async() function returns the first."""
+    listFutures = [
+        LocationResult.query(ancestor=masterKey).filter(LocationResult.datetime < testEndpoint.startDatetime).order(-LocationResult.datetime).get_async(),
+        LocationResult.query(ancestor=masterKey).filter(LocationResult.datetime > testEndpoint.finishDatetime).order(LocationResult.datetime).get_async(),
+        NetworkResult.query(ancestor=masterKey).filter(NetworkResult.datetime < testEndpoint.startDatetime).order(-NetworkResult.datetime).get_async(),
+        NetworkResult.query(ancestor=masterKey).filter(NetworkResult.datetime > testEndpoint.finishDatetime).order(NetworkResult.datetime).get_async(),
+        PingResult.query(ancestor=masterKey).filter(PingResult.datetime < testEndpoint.startDatetime).order(-PingResult.datetime).get_async(),
+        PingResult.query(ancestor=masterKey).filter(PingResult.datetime > testEndpoint.finishDatetime).order(PingResult.datetime).get_async(),
+        # Get the 'True' referenceObject from the store
+        getReferenceObjectAsync(testEndpoint.server, testEndpoint.dataset, testEndpoint.testName, testEndpoint.httpMethod, testEndpoint.returnType),
+    ]
+    # The response body too, leaving it in the context cache for
+    # getResponseData() in buildVector().
+    if testEndpoint.responseDigest:
+        listFutures.append(ndb.Key(ResponseBlob, testEndpoint.responseDigest).get_async())
+    if testMaster is None:
+        listFutures.append(masterKey.get_async())
+
+    listResults = yield listFutures
+    neighbours = listResults[:6]
+    referenceObject = listResults[6]
+    if testMaster is None:
+        testMaster = listResults[-1]
+
+    vector = buildVector(campaignKey, testEndpoint, testMaster, neighbours, referenceObject)
+
+    # The endpoint is marked analysed only once its Vector is recorded,
+    # as analyseTestMaster() explains.
+    if vector is not None:
+        yield vector.put_async(), recordAnalysedVectorsAsync(campaignName, [vector], analysisBatchName([testEndpoint]))
+    yield testEndpoint.put_async()
+
+    raise ndb.Return(testEndpoint.analysed)
+
+
+def analyseTestMaster(campaignName, campaignKey, testMaster, listTestEndpoints, batchName=None):
+    """Builds and stores the Vectors for many TestEndpoints of one
+    TestMaster at once. The TestMaster's location, network and ping
+    results are each fetched by one ancestor query, run concurrently, and
+    every endpoint's neighbours found among them by binary search.
+    Each distinct ReferenceObject and response body is fetched once,
+    alongside those queries, the Vectors stored in one put_multi and
+    recorded once, as the batch batchName, by default analysisBatchName(),
+    then the endpoints stored in another. Returns the list of AnalysisEnum
+    values assigned."""
+    locationFuture = LocationResult.query(ancestor=testMaster.key).fetch_async()
+    networkFuture = NetworkResult.query(ancestor=testMaster.key).fetch_async()
+    pingFuture = PingResult.query(ancestor=testMaster.key).fetch_async()
+
+    # Fetch each distinct ReferenceObject once, all concurrently
+    # with the series queries.
+    dictReferences = {}
+    for testEndpoint in listTestEndpoints:
+        signature = (testEndpoint.server, testEndpoint.dataset, testEndpoint.testName, testEndpoint.httpMethod, testEndpoint.returnType)
+        if signature not in dictReferences:
+            dictReferences[signature] = getReferenceObjectAsync(*signature)
+
+    # Likewise the distinct response bodies, the context cache then
+    # serves each getResponseData() in buildVector().
+    setDigests = set(testEndpoint.responseDigest for testEndpoint in listTestEndpoints if testEndpoint.responseDigest)
+    listBlobFutures = ndb.get_multi_async([ndb.Key(ResponseBlob, digest) for digest in setDigests])
+
+    locations = TimeSeries(locationFuture.get_result())
+    networks = TimeSeries(networkFuture.get_result())
+    pings = TimeSeries(pingFuture.get_result())
+    ndb.Future.wait_all(listBlobFutures)
+
+    listVectors = []
+
+    for testEndpoint in listTestEndpoints:
+        start = testEndpoint.startDatetime
+        finish = testEndpoint.finishDatetime
+        neighbours = (locations.before(start), locations.after(finish),
+                      networks.before(start), networks.after(finish),
+                      pings.before(start), pings.after(finish))
+
+        signature = (testEndpoint.server, testEndpoint.dataset, testEndpoint.testName, testEndpoint.httpMethod, testEndpoint.returnType)
+        vector = buildVector(campaignKey, testEndpoint, testMaster, neighbours, dictReferences[signature].get_result())
+        if vector is not None:
+            listVectors.append(vector)
+
+    # The endpoints are marked analysed last, so a task retried after any
+    # failure finds them unanalysed again, and the batch's AggregateBatch
+    # stops their Vectors being counted twice.
+    if batchName is None:
+        batchName = analysisBatchName(listTestEndpoints)
+    listWrites = ndb.put_multi_async(listVectors)
+    listWrites.append(recordAnalysedVectorsAsync(campaignName, listVectors, batchName))
+    ndb.Future.wait_all(listWrites)
+    for future in listWrites:
+        future.check_success()
+
+    ndb.put_multi(listTestEndpoints)
+
+    return [testEndpoint.analysed for testEndpoint in listTestEndpoints]
+
+
 class Analyse(webapp2.RequestHandler):
     """A class that takes the point based information in each of the
     EndpointTests, LocationTests, NetworkTests and PingTests and
@@ -676,11 +1640,36 @@ class Analyse(webapp2.RequestHandler):
                                 e.message + '\n\n')
         else:
             try:
+                """If the request includes a masterKey attribute analyse
+                every unanalysed TestEndpoint of that TestMaster in one go.
+                The Database POST method creates one such task per
+                TestMaster when analysing by TestMaster."""
+                masterKeyString = self.request.get('masterKey')
+
+                if masterKeyString:
+                    testMaster = ndb.Key(urlsafe=masterKeyString).get()
+                    if testMaster is None:
+                        # Deleted since the task was queued, retrying
+                        # cannot help so the task succeeds.
+                        self.response.headers['Content-Type'] = 'text/plain'
+                        self.response.write('No such TestMaster, nothing to analyse.\n\n')
+                        return
+
+                    listTestEndpoints = TestEndpoint.query(ancestor=testMaster.key).filter(TestEndpoint.analysed == AnalysisEnum.UNANALYSED).fetch()
+
+                    listOutcomes = analyseTestMaster(campaignName, campaignKey, testMaster, listTestEndpoints)
+
+                    self.response.headers['Content-Type'] = 'text/plain'
+                    self.response.write('Analysis complete!\n' +
+                                        str(listOutcomes.count(AnalysisEnum.SUCCESSFUL)) + ' of ' +
+                                        str(len(listOutcomes)) + ' endpoint tests analysed.\n\n')
+                    return
+
                 """Fetch a single TestEndpoint object which has not yet been
                 analysed.
                 It doesn't matter which one, we'll get them all
                 eventually. The Database POST method creates a task for each new
-                testEndpoint added to the database.
+                testEndpoint added to the database when analysing by endpoint.
                 If the request includes a testID attribute fetch that specific
                 test."""
                 testID = self.request.get('testID')
@@ -691,124 +1680,14 @@ class Analyse(webapp2.RequestHandler):
                     testEndpoint = TestEndpoint.query(TestEndpoint.analysed == 0).get()
 
                 if testEndpoint is not None:
-                    # Grab the parent TestMaster
-                    testMaster = TestMaster.query(TestMaster.testID == testEndpoint.parentID).get()
-
-                    """Get the supporting tests either side of the EndpointTest
-                    The query object filters by those tests with the same TestMaster
-                    parent and a time greater than the EndpointTest's time. It sorts
-                    all the returns by time (ascending or descending depending)
-                    and the .get() function returns the first."""
-                    preTestLocation = LocationResult.query(ancestor=testMaster.key).filter(LocationResult.datetime < testEndpoint.startDatetime).order(-LocationResult.datetime).get()
-                    # print preTestLocation
-
-                    postTestLocation = LocationResult.query(ancestor=testMaster.key).filter(LocationResult.datetime > testEndpoint.finishDatetime).order(LocationResult.datetime).get()
-                    # print postTestLocation
-
-                    preTestNetwork = NetworkResult.query(ancestor=testMaster.key).filter(NetworkResult.datetime < testEndpoint.startDatetime).order(-NetworkResult.datetime).get()
-                    # print preTestNetwork
-
-                    postTestNetwork = NetworkResult.query(ancestor=testMaster.key).filter(NetworkResult.datetime > testEndpoint.finishDatetime).order(NetworkResult.datetime).get()
-                    # print postTestNetwork
-
-                    preTestPing = PingResult.query(ancestor=testMaster.key).filter(PingResult.datetime < testEndpoint.startDatetime).order(-PingResult.datetime).get()
-                    # print preTestPing
-
-                    postTestPing = PingResult.query(ancestor=testMaster.key).filter(PingResult.datetime > testEndpoint.finishDatetime).order(PingResult.datetime).get()
-                    # print postTestPing
-
-                    # Each TestEndpoint should have a LocationTest, NetworkTest and
-                    # PingTest before AND afterwards, if all six are present proceed
-                    if preTestLocation and postTestLocation and preTestNetwork and postTestNetwork and preTestPing and postTestPing:
-                        # Create a new Vector analysis data structure.
-                        vector = Vector(parent=campaignKey)
-
-                        # Assign all the TestEndpoint's relevant attributes to Vector
-                        vector.test = testEndpoint
-                        vector.name = testEndpoint.testName
-                        vector.startDateTime = testEndpoint.startDatetime
-                        vector.finishDateTime = testEndpoint.finishDatetime
-                        vector.responseTime = (testEndpoint.finishDatetime - testEndpoint.startDatetime).total_seconds()
-                        vector.server = testEndpoint.server
-                        vector.dataset = testEndpoint.dataset
-                        vector.httpMethod = testEndpoint.httpMethod
-                        vector.returnType = testEndpoint.returnType
-                        vector.responseCode = testEndpoint.responseCode
-                        vector.onDeviceSuccess = testEndpoint.success
-
-                        # Get the 'True' referenceObject from the store
-                        referenceObject = ReferenceObject.query(ReferenceObject.server == vector.server, ReferenceObject.dataset == vector.dataset, ReferenceObject.name == vector.name, ReferenceObject.httpMethod == vector.httpMethod, ReferenceObject.returnType == vector.returnType).get()
-
-                        vectorString = vector.server + "_" + vector.dataset + "_" + vector.name + "_" + vector.httpMethod + "_" + vector.returnType + "_ReferenceSuccess"
-
-                        # Default to false for reference check truthiness.
-                        vector.referenceCheckSuccess = False
-
-                        # Check whether the referenceObject's text can
-                        # be found in the testEndpoint's response.
-                        if referenceObject is not None:
-                            responseData = testEndpoint.responseData.encode('ascii', 'ignore').replace('\r\n', '').replace('\n', '').replace(' ', '').replace('   ', '')
-                            reference = referenceObject.reference.encode('ascii', 'ignore').replace('\r\n', '').replace('\n', '').replace(' ', '').replace('   ', '')
-                            if responseData in reference:
-                                vector.referenceCheckSuccess = True
-
-                        print vector.referenceCheckSuccess
-
-                        stats_query = CampaignStats.query(CampaignStats.campaignName == campaignName)
-                        stats = stats_query.get()
-
-                        if hasattr(stats, vectorString):
-                            newValue = getattr(stats, vectorString) +  vector.referenceCheckSuccess
-                            print 'Setting referenceCheckSuccess on Stats; ' + str(newValue)
-                            setattr(stats, vectorString, newValue)
-                            stats.put()
-
-                        # Assign the TestMaster's attributes
-                        vector.deviceType = testMaster.deviceType
-                        vector.deviceID = testMaster.deviceID
-                        vector.iOSVersion = testMaster.iOSVersion
-
-                        # Assign all the supporting tests to the Vector
-                        vector.preTestLocation = preTestLocation
-                        vector.postTestLocation = postTestLocation
-                        vector.preTestNetwork = preTestNetwork
-                        vector.postTestNetwork = postTestNetwork
-                        vector.preTestPing = preTestPing
-                        vector.postTestPing = postTestPing
-
-                        # Calculate the change in environment during the test
-                        location1 = vector.preTestLocation.location
-                        location2 = vector.postTestLocation.location
-                        vector.distance = HaversineDistance(location1, location2)
-
-                        vector.speed = vector.distance / (postTestLocation.datetime - preTestLocation.datetime).total_seconds()
-
-                        vector.pingChange = vector.preTestPing.pingTime - vector.postTestPing.pingTime
-
-                        vector.networkChange = (NetworkClass(vector.postTestNetwork.connectionType) - NetworkClass(vector.preTestNetwork.connectionType))
-
-                        # All being well, we mark the testEndpoint object with
-                        # the analysis SUCCESSFUL enum and put it back.
-                        testEndpoint.analysed = AnalysisEnum.SUCCESSFUL
-                        endpointKey = testEndpoint.put()
-
-                        # Store the Vector object.
-                        vectorKey = vector.put()
-                        print "Analysis SUCCESSFUL"
-
+                    # The parent TestMaster is fetched by key alongside
+                    # the neighbour queries rather than by a global query.
+                    if analyseEndpoint(campaignName, campaignKey, testEndpoint) == AnalysisEnum.SUCCESSFUL:
                         self.response.headers['Content-Type'] = 'text/plain'
                         self.response.write('Analysis complete!\n' +
                                             'Thank you and have an educational day!\n\n')
 
                     else:
-                        """If we don't have all six supporting tests (as is possible
-                        where a TestMaster may have been cancelled) the analysis
-                        is IMPOSSIBLE, mark the testEndpoint with the enum so we
-                        may ignore it in the future."""
-                        testEndpoint.analysed = AnalysisEnum.IMPOSSIBLE
-                        endpointKey = testEndpoint.put()
-                        print "Analysis IMPOSSIBLE"
-
                         self.response.headers['Content-Type'] = 'text/plain'
                         self.response.write('Sorry, analysis is impossible ' +
                                             'for this endpoint test!\n\n')
@@ -821,6 +1700,53 @@ class Analyse(webapp2.RequestHandler):
                                     e.message + '\n\n')
 
 
+class AnalysePull(webapp2.RequestHandler):
+    """Drains the analysis pull queue, started every minute by cron.
+    Leases up to PULL_LEASE_COUNT endpoint tasks at a time, groups them by
+    TestMaster, analyses each group in one pass with the batch analyser
+    and deletes the leased tasks in bulk. Tasks of a group whose analysis
+    fails are left to be leased again once their lease expires."""
+    def get(self):
+        queue = taskqueue.Queue(ANALYSIS_PULL_QUEUE_NAME)
+        deadline = time.time() + PULL_WORKER_SECONDS
+        countAnalysed = 0
+
+        while time.time() < deadline:
+            listTasks = queue.lease_tasks(PULL_LEASE_SECONDS, PULL_LEASE_COUNT)
+            if not listTasks:
+                break
+
+            dictGroups = {}
+            for task in listTasks:
+                dictPayload = json.loads(task.payload)
+                group = dictGroups.setdefault((dictPayload['campaignName'], dictPayload['masterKey']), ([], set()))
+                group[0].append(task)
+                group[1].add(dictPayload['testID'])
+
+            listDone = []
+            for (campaignName, masterKeyString), (listGroupTasks, setTestIDs) in dictGroups.items():
+                try:
+                    masterKey = ndb.Key(urlsafe=masterKeyString)
+                    testMaster = masterKey.get()
+                    listTestEndpoints = TestEndpoint.query(ancestor=masterKey).filter(TestEndpoint.analysed == AnalysisEnum.UNANALYSED).fetch()
+                    listTestEndpoints = [testEndpoint for testEndpoint in listTestEndpoints if testEndpoint.testID in setTestIDs]
+
+                    if testMaster is not None and listTestEndpoints:
+                        analyseTestMaster(campaignName, getCampaignKey(campaignName), testMaster, listTestEndpoints)
+                        countAnalysed += len(listTestEndpoints)
+
+                    listDone.extend(listGroupTasks)
+
+                except Exception as e:
+                    print 'Analysis of ' + masterKeyString + ' failed; ' + e.message
+
+            if listDone:
+                queue.delete_tasks(listDone)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(str(countAnalysed) + ' endpoint tests analysed.\n\n')
+
+
 def percentCalculator(stats, key):
     """Calculates the percentage successful for reference checks.
     The intention being to completely disregard test types with
@@ -919,7 +1845,7 @@ class StatsPage(webapp2.RequestHandler):
 
                 print campaignName
 
-                stats = CampaignStats.query(CampaignStats.campaignName == campaignName).get()
+                stats = getCampaignStats(campaignName)
 
                 print stats
 
@@ -1007,12 +1933,12 @@ class StatsPage(webapp2.RequestHandler):
                                     e.message + '\n\n')
 
 
-"""Creates a pie chart with the supplied property."""
-def pieCharter(figureArg, colourMap, campaign, chartProperty):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector._properties[chartProperty], Vector.referenceCheckValid]).fetch()
-    listProperty = [getattr(vector, chartProperty) for vector in listVectors if vector.referenceCheckValid]
-    listNames = list(set(listProperty))
-    listCounts = [listProperty.count(server) for server in listNames]
+"""Creates a pie chart with the supplied property, from the campaign's
+Vector counts rather than the Vectors themselves."""
+def pieCharter(figureArg, colourMap, dictCounts, chartProperty):
+    listValues = [(name, count) for name, count in dictCounts[chartProperty].items() if count > 0]
+    listNames = [name for name, count in listValues]
+    listCounts = [count for name, count in listValues]
     listColours = colourMap(numpy.linspace(0., 1., len(listNames)))
 
     ax = figureArg.add_subplot(1, 1, 1)
@@ -1025,60 +1951,69 @@ def pieCharter(figureArg, colourMap, campaign, chartProperty):
 
     return ax
 
-"""Calculates R Squared value for a set of coefficients."""
-def calculateRSquared(coeffs, x, y):
-    """Adapted from leif's answer on StackOverflow, found here;
-    http://stackoverflow.com/questions/893657/how-do-i-calculate-r-squared-using-python-and-numpy"""
-    p = numpy.poly1d(coeffs)
-    # fit values, and mean
-    yhat = p(x)
-    ybar = numpy.sum(y)/len(y)
-    ssreg = numpy.sum((yhat-ybar)**2)
-    sstot = numpy.sum((y - ybar)**2)
-    return ssreg / sstot
+"""Returns the points of a fitted line, (slope, intercept, rSquared),
+over the x values of its series. A log space fit is a power law, drawn
+straight on log scaled axes, over the positive x values."""
+def fitLine(fit, x, fitSpace='linear'):
+    slope, intercept, rSquared = fit
+    if fitSpace == 'log':
+        x = x[x > 0]
+        return x, 10 ** intercept * x ** slope
+    return x, slope * x + intercept
 
 """Creates a scatter plot for two supplied properties.
 Divides them up by succeeded and failed tests (failures being those
 that either failed on device or failed their reference check).
-Then Performs OLS linear regression on each set of scatters and overlays
-the line of best fit on the chart."""
-def scatterCharter(figureArg, campaign, chartXProperty, chartYProperty):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector._properties[chartXProperty], Vector._properties[chartYProperty], Vector.onDeviceSuccess, Vector.referenceCheckSuccess, Vector.referenceCheckValid]).fetch()
-
-    listAll = [(getattr(vector, chartXProperty), getattr(vector, chartYProperty), vector.onDeviceSuccess, vector.referenceCheckSuccess) for vector in listVectors if vector.referenceCheckValid]
-    listSuccesses = [vector for vector in listAll if vector[2] and vector[3]]
-    listDeviceFailures = [vector for vector in listAll if not vector[2]]
-    listReferenceFailures = [vector for vector in listAll if vector[2] and not vector[3]]
+Then overlays each set of scatters' OLS line of best fit, fitted from
+the campaign's running sums in fitSpace, 'linear' or 'log', rather than
+from the scatters themselves."""
+def scatterCharter(figureArg, snapshot, campaignName, chartXProperty, chartYProperty, fitSpace='linear'):
+    listOutcomes = ['success', 'deviceFailure', 'referenceFailure']
+    listSeries = [regressionSeriesName(chartXProperty, chartYProperty, 'outcome', outcome) for outcome in listOutcomes]
+    dictRegressions = getVectorRegressions(campaignName, listSeries)
+    dictFits = dict((outcome, fitRegression(dictRegressions[series], fitSpace)) for outcome, series in zip(listOutcomes, listSeries))
+
+    x = snapshot.columns[chartXProperty]
+    y = snapshot.columns[chartYProperty]
+    valid = snapshot.columns['referenceCheckValid']
+    onDeviceSuccess = snapshot.columns['onDeviceSuccess']
+    referenceCheckSuccess = snapshot.columns['referenceCheckSuccess']
+    maskSuccesses = valid & onDeviceSuccess & referenceCheckSuccess
+    maskDeviceFailures = valid & ~onDeviceSuccess
+    maskReferenceFailures = valid & onDeviceSuccess & ~referenceCheckSuccess
 
     ax = figureArg.add_subplot(1, 1, 1)
 
-    xSuccess = numpy.array([vector[0] for vector in listSuccesses])
-    ySuccess = numpy.array([vector[1] for vector in listSuccesses])
+    xSuccess = x[maskSuccesses]
+    ySuccess = y[maskSuccesses]
     scatterSuccess = ax.scatter(xSuccess, ySuccess, facecolors='lightgreen', edgecolors='none', alpha=0.7, label='Successful Test')
-    fitSuccess = numpy.polyfit(xSuccess, ySuccess, deg=1)
-    rSquaredSuccess = calculateRSquared(fitSuccess, xSuccess, ySuccess)
-    labelSuccess = 'Success, r squared = ' + str(round(rSquaredSuccess, 2))
-    lineSuccess = ax.plot(xSuccess, fitSuccess[0] * xSuccess + fitSuccess[1], color='darkgreen', linestyle='--', linewidth=3, label=labelSuccess)
+    fitSuccess = dictFits['success']
+    if fitSuccess is not None:
+        labelSuccess = 'Success, r squared = ' + str(round(fitSuccess[2], 2))
+        xLine, yLine = fitLine(fitSuccess, xSuccess, fitSpace)
+        lineSuccess = ax.plot(xLine, yLine, color='darkgreen', linestyle='--', linewidth=3, label=labelSuccess)
     # lineSuccess.set_path_effects([path_effects.Stroke(linewidth=3, foreground='white'), path_effects.Normal()])
 
-    xDeviceFailure = numpy.array([vector[0] for vector in listDeviceFailures])
-    yDeviceFailure = numpy.array([vector[1] for vector in listDeviceFailures])
+    xDeviceFailure = x[maskDeviceFailures]
+    yDeviceFailure = y[maskDeviceFailures]
     # xDeviceFailure = numpy.array([1,2,3,4,5,6,7,8,9,10,11,12,13,14,15])
     # yDeviceFailure = numpy.array([1,2,3,4,5,6,7,8,9,10,11,12,13,14,15])
     scatterDeviceFailure = ax.scatter(xDeviceFailure, yDeviceFailure,  facecolors='darkorange', edgecolors='darkorange', marker='^', label='Failed On Device')
-    fitDeviceFailure = numpy.polyfit(xDeviceFailure, yDeviceFailure, deg=1)
-    rSquaredDeviceFailure = calculateRSquared(fitDeviceFailure, xDeviceFailure, yDeviceFailure)
-    labelDeviceFailure = 'On Device Failure, r squared = ' + str(round(rSquaredDeviceFailure, 2))
-    lineDeviceFailure = ax.plot(xDeviceFailure, fitDeviceFailure[0] * xDeviceFailure + fitDeviceFailure[1], color='darkorange', linestyle='--', linewidth=3, label=labelDeviceFailure)
+    fitDeviceFailure = dictFits['deviceFailure']
+    if fitDeviceFailure is not None:
+        labelDeviceFailure = 'On Device Failure, r squared = ' + str(round(fitDeviceFailure[2], 2))
+        xLine, yLine = fitLine(fitDeviceFailure, xDeviceFailure, fitSpace)
+        lineDeviceFailure = ax.plot(xLine, yLine, color='darkorange', linestyle='--', linewidth=3, label=labelDeviceFailure)
     # lineDeviceFailure.set_path_effects([path_effects.Stroke(linewidth=3, foreground='white'), path_effects.Normal()])
 
-    xReferenceFailure = numpy.array([vector[0] for vector in listReferenceFailures])
-    yReferenceFailure = numpy.array([vector[1] for vector in listReferenceFailures])
+    xReferenceFailure = x[maskReferenceFailures]
+    yReferenceFailure = y[maskReferenceFailures]
     scatterReferenceFailure = ax.scatter(xReferenceFailure, yReferenceFailure,  facecolors='red', edgecolors='red', marker='D', label='Failed Reference Check')
-    fitReferenceFailure = numpy.polyfit(xReferenceFailure, yReferenceFailure, deg=1)
-    rSquaredReferenceFailure = calculateRSquared(fitReferenceFailure, xReferenceFailure, yReferenceFailure)
-    labelReferenceFailure = 'Reference Check Failure, r squared = ' + str(round(rSquaredReferenceFailure, 2))
-    lineReferenceFailure = ax.plot(xReferenceFailure, fitReferenceFailure[0] * xReferenceFailure + fitReferenceFailure[1], color='red', linestyle='--', linewidth=3, label=labelReferenceFailure)
+    fitReferenceFailure = dictFits['referenceFailure']
+    if fitReferenceFailure is not None:
+        labelReferenceFailure = 'Reference Check Failure, r squared = ' + str(round(fitReferenceFailure[2], 2))
+        xLine, yLine = fitLine(fitReferenceFailure, xReferenceFailure, fitSpace)
+        lineReferenceFailure = ax.plot(xLine, yLine, color='red', linestyle='--', linewidth=3, label=labelReferenceFailure)
     # lineReferenceFailure.set_path_effects([path_effects.Stroke(linewidth=3, foreground='white'), path_effects.Normal()])
 
     # Shrink current axis's height by 10% on the bottom
@@ -1093,12 +2028,13 @@ def scatterCharter(figureArg, campaign, chartXProperty, chartYProperty):
 """Creates a scatter plot for two supplied properties.
 Differs from the main scatterCharter() function in that it only graphs successful
 tests, and divides them into categories based on a supplied list.
-Then Performs OLS linear regression on each set of scatters and overlays
-the line of best fit on the chart."""
-def scatterComparer(figureArg, campaign, chartXProperty, chartYProperty, categoryProperty, categories, colourMap, colourMapDark):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector._properties[chartXProperty], Vector._properties[chartYProperty], Vector._properties[categoryProperty], Vector.onDeviceSuccess, Vector.referenceCheckSuccess, Vector.referenceCheckValid]).fetch()
+Then overlays each set of scatters' OLS line of best fit, fitted from
+the campaign's running sums in fitSpace, as scatterCharter() does."""
+def scatterComparer(figureArg, snapshot, campaignName, chartXProperty, chartYProperty, categoryProperty, categories, colourMap, colourMapDark, fitSpace='linear'):
+    listSeries = [regressionSeriesName(chartXProperty, chartYProperty, categoryProperty, category) for category in categories]
+    dictRegressions = getVectorRegressions(campaignName, listSeries)
 
-    listAll = [(getattr(vector, chartXProperty), getattr(vector, chartYProperty), getattr(vector, categoryProperty)) for vector in listVectors if vector.referenceCheckValid and vector.onDeviceSuccess and vector.referenceCheckSuccess]
+    maskSuccesses = snapshot.columns['referenceCheckValid'] & snapshot.columns['onDeviceSuccess'] & snapshot.columns['referenceCheckSuccess']
 
     # listColours = ['teal', 'coral', 'sage', 'royalblue', 'orchid']
     # listDarkColours = ['darkslategrey', 'chocolate', 'darksage', 'navy', 'darkorchid']
@@ -1106,22 +2042,23 @@ def scatterComparer(figureArg, campaign, chartXProperty, chartYProperty, categor
     listColours = colourMap(numpy.linspace(0., 1., len(categories)))
     listDarkColours = colourMapDark(numpy.linspace(0., 1., len(categories)))
 
-    listLists = []
+    listMasks = []
     for category in categories:
-        listLists.append([vector for vector in listAll if vector[2] == category])
+        listMasks.append(maskSuccesses & snapshot.isCategory(categoryProperty, category))
 
     ax = figureArg.add_subplot(1, 1, 1)
 
-    for index, listScatters in enumerate(listLists):
+    for index, mask in enumerate(listMasks):
         # print index
-        x = numpy.array([vector[0] for vector in listScatters])
-        y = numpy.array([vector[1] for vector in listScatters])
+        x = snapshot.columns[chartXProperty][mask]
+        y = snapshot.columns[chartYProperty][mask]
         strLabel = categories[index]
         paths = ax.scatter(x, y, label=strLabel, c=listColours[index], edgecolors='none')
-        fit = numpy.polyfit(x, y, deg=1)
-        rSquared = calculateRSquared(fit, x, y)
-        rLabel = strLabel + ', r squared = ' + str(round(rSquared, 2))
-        line = ax.plot(x, fit[0] * x + fit[1], color=listDarkColours[index], linestyle='--', linewidth=3, label=rLabel)
+        fit = fitRegression(dictRegressions[listSeries[index]], fitSpace)
+        if fit is not None:
+            rLabel = strLabel + ', r squared = ' + str(round(fit[2], 2))
+            xLine, yLine = fitLine(fit, x, fitSpace)
+            line = ax.plot(xLine, yLine, color=listDarkColours[index], linestyle='--', linewidth=3, label=rLabel)
 
     # Shrink current axis's height by 10% on the bottom
     box = ax.get_position()
@@ -1132,13 +2069,14 @@ def scatterComparer(figureArg, campaign, chartXProperty, chartYProperty, categor
     return ax
 
 
-def histogramCharter(figureArg, campaign, chartXProperty):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector._properties[chartXProperty], Vector.onDeviceSuccess, Vector.referenceCheckSuccess, Vector.referenceCheckValid]).fetch()
-
-    listAll = [(getattr(vector, chartXProperty), vector.onDeviceSuccess, vector.referenceCheckSuccess) for vector in listVectors if vector.referenceCheckValid]
-    arraySuccesses = numpy.array([vector[0] for vector in listAll if vector[1] and vector[2]])
-    arrayDeviceFailures = numpy.array([vector[0] for vector in listAll if not vector[1]])
-    arrayReferenceFailures = numpy.array([vector[0] for vector in listAll if vector[1] and not vector[2]])
+def histogramCharter(figureArg, snapshot, chartXProperty):
+    x = snapshot.columns[chartXProperty]
+    valid = snapshot.columns['referenceCheckValid']
+    onDeviceSuccess = snapshot.columns['onDeviceSuccess']
+    referenceCheckSuccess = snapshot.columns['referenceCheckSuccess']
+    arraySuccesses = x[valid & onDeviceSuccess & referenceCheckSuccess]
+    arrayDeviceFailures = x[valid & ~onDeviceSuccess]
+    arrayReferenceFailures = x[valid & onDeviceSuccess & ~referenceCheckSuccess]
 
     ax = figureArg.add_subplot(1, 1, 1)
 
@@ -1151,14 +2089,16 @@ def histogramCharter(figureArg, campaign, chartXProperty):
     return ax
 
 
-def boxAndWhiskersCharter(figureArg, campaign, chartXProperty, categoryProperty, categories):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector._properties[chartXProperty], Vector._properties[categoryProperty], Vector.onDeviceSuccess, Vector.referenceCheckSuccess, Vector.referenceCheckValid, Vector.distance]).fetch()
-
-    listAll = [(getattr(vector, chartXProperty), getattr(vector, categoryProperty)) for vector in listVectors if vector.referenceCheckValid and vector.onDeviceSuccess and vector.referenceCheckSuccess]
+"""The box plots are drawn from the campaign's quantile sketches of each
+series, each series stood in for by sketchSample() values with the same
+median, quartiles and extremes, to within SKETCH_RELATIVE_ACCURACY."""
+def boxAndWhiskersCharter(figureArg, campaignName, chartXProperty, categoryProperty, categories):
+    listSeries = [sketchSeriesName(chartXProperty, categoryProperty, category) for category in categories]
+    dictSketches = getVectorSketches(campaignName, listSeries)
 
     listLists = []
-    for category in categories:
-        listLists.append([vector[0] for vector in listAll if vector[1] == category])
+    for series in listSeries:
+        listLists.append(sketchSample(dictSketches[series]))
 
     ax = figureArg.add_subplot(1, 1, 1)
 
@@ -1185,16 +2125,14 @@ def boxAndWhiskersCharter(figureArg, campaign, chartXProperty, categoryProperty,
     return ax
 
 
-def boxAndWhiskersCharterDistance(figureArg, campaign):
-    listVectors = Vector.query(ancestor=campaign, projection=[Vector.onDeviceSuccess, Vector.referenceCheckSuccess, Vector.referenceCheckValid, Vector.distance]).fetch()
-
-    listAll = [(vector.distance, vector.onDeviceSuccess, vector.referenceCheckSuccess) for vector in listVectors if vector.referenceCheckValid]
+def boxAndWhiskersCharterDistance(figureArg, campaignName):
+    listSeries = [sketchSeriesName('distance', 'outcome', outcome) for outcome in ('success', 'deviceFailure', 'referenceFailure')]
+    dictSketches = getVectorSketches(campaignName, listSeries)
 
     listLists = []
 
-    listLists.append([vector[0] for vector in listAll if vector[1] is True and vector[2] is True])
-    listLists.append([vector[0] for vector in listAll if vector[1] is False])
-    listLists.append([vector[0] for vector in listAll if vector[2] is False])
+    for series in listSeries:
+        listLists.append(sketchSample(dictSketches[series]))
 
     ax = figureArg.add_subplot(1, 1, 1)
 
@@ -1221,11 +2159,58 @@ def boxAndWhiskersCharterDistance(figureArg, campaign):
     return ax
 
 
+class GraphCache(object):
+    """A least recently used cache of rendered graphs in instance memory,
+    in front of memcache. Keyed by campaign, graph and data version, so a
+    new version simply stops old entries being asked for."""
+    def __init__(self, size=GRAPH_CACHE_SIZE):
+        self.size = size
+        self.dictEntries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, graphKey):
+        """Returns the rendered graph, or None."""
+        with self.lock:
+            graphImage = self.dictEntries.pop(graphKey, None)
+            if graphImage is not None:
+                self.dictEntries[graphKey] = graphImage
+                return graphImage
+
+        compressedImage = memcache.get(graphKey)
+        if compressedImage is None:
+            return None
+        graphImage = zlib.decompress(compressedImage)
+        self.putLocal(graphKey, graphImage)
+        return graphImage
+
+    def put(self, graphKey, graphImage):
+        self.putLocal(graphKey, graphImage)
+        try:
+            # SVG compresses well, keeping big scatter plots under
+            # memcache's value size limit.
+            memcache.set(graphKey, zlib.compress(graphImage), time=GRAPH_CACHE_SECONDS)
+        except ValueError as e:
+            print 'Graph not cached in memcache; ' + e.message
+
+    def putLocal(self, graphKey, graphImage):
+        with self.lock:
+            self.dictEntries.pop(graphKey, None)
+            self.dictEntries[graphKey] = graphImage
+            while len(self.dictEntries) > self.size:
+                self.dictEntries.popitem(last=False)
+
+
+GRAPH_CACHE = GraphCache()
+
+
 class GraphsPage(webapp2.RequestHandler):
     """"A page that produces a graph for a given campaign.
     The request must specify which of the graph types they want returned.
     Graphs generated from latest available data using the Python
-    matplotlib library."""
+    matplotlib library.
+    Rendered graphs are cached against the campaign's data version, and
+    the version serves as the graph's ETag, so a repeat request costs
+    no query or render and an unchanged graph is answered with a 304."""
     def get(self):
         try:
             campaignName = self.request.get('campaignName')
@@ -1250,6 +2235,33 @@ class GraphsPage(webapp2.RequestHandler):
                                 e.message + '\n\n')
         else:
             try:
+                version = getVectorDataVersion(campaignName)
+                graphKey = 'Graph-' + campaignName + '-' + graphName + '-' + str(version)
+                graphEtag = graphName + '-' + str(version)
+
+                # Browsers revalidate every time, at the cost of a 304.
+                self.response.headers['Cache-Control'] = 'no-cache'
+                if graphEtag in self.request.if_none_match:
+                    self.response.etag = graphEtag
+                    self.response.status = 304
+                    return
+
+                graphImage = GRAPH_CACHE.get(graphKey)
+                if graphImage is not None:
+                    self.response.etag = graphEtag
+                    self.response.headers['Content-Type'] = 'text/html'
+                    self.response.write(graphImage)
+                    return
+
+                # The pie charts need only the campaign's Vector counts,
+                # the box plots its sketches and every other graph is drawn
+                # from its columnar snapshot, none queries the Vectors.
+                graphNumber = int(graphName[len('graph'):])
+                if graphNumber <= 10:
+                    dictCounts = getVectorCounts(campaignName)
+                elif graphNumber <= 21:
+                    snapshot = loadVectorSnapshot(campaignName, version)
+
                 fig = Figure()
                 canvas = FigureCanvas(fig)
                 cmap = cm.Pastel2
@@ -1257,37 +2269,37 @@ class GraphsPage(webapp2.RequestHandler):
                 cmapDark = cm.Dark2
 
                 if graphName == 'graph1':
-                    ax = pieCharter(fig, cmap, campaignKey, 'server')
+                    ax = pieCharter(fig, cmap, dictCounts, 'server')
 
                 elif graphName == 'graph2':
-                    ax = pieCharter(fig, cmap, campaignKey, 'httpMethod')
+                    ax = pieCharter(fig, cmap, dictCounts, 'httpMethod')
 
                 elif graphName == 'graph3':
-                    ax = pieCharter(fig, cmap, campaignKey, 'name')
+                    ax = pieCharter(fig, cmap, dictCounts, 'name')
 
                 elif graphName == 'graph4':
-                    ax = pieCharter(fig, cmap, campaignKey, 'returnType')
+                    ax = pieCharter(fig, cmap, dictCounts, 'returnType')
 
                 elif graphName == 'graph5':
-                    ax = pieCharter(fig, cmap, campaignKey, 'responseCode')
+                    ax = pieCharter(fig, cmap, dictCounts, 'responseCode')
 
                 elif graphName == 'graph6':
-                    ax = pieCharter(fig, cmap, campaignKey, 'onDeviceSuccess')
+                    ax = pieCharter(fig, cmap, dictCounts, 'onDeviceSuccess')
 
                 elif graphName == 'graph7':
-                    ax = pieCharter(fig, cmap, campaignKey, 'referenceCheckSuccess')
+                    ax = pieCharter(fig, cmap, dictCounts, 'referenceCheckSuccess')
 
                 elif graphName == 'graph8':
-                    ax = pieCharter(fig, cmap, campaignKey, 'deviceType')
+                    ax = pieCharter(fig, cmap, dictCounts, 'deviceType')
 
                 elif graphName == 'graph9':
-                    ax = pieCharter(fig, cmap, campaignKey, 'iOSVersion')
+                    ax = pieCharter(fig, cmap, dictCounts, 'iOSVersion')
 
                 elif graphName == 'graph10':
-                    ax = pieCharter(fig, cmap, campaignKey, 'deviceID')
+                    ax = pieCharter(fig, cmap, dictCounts, 'deviceID')
 
                 elif graphName == 'graph11':
-                    ax = scatterCharter(fig, campaignKey, 'speed', 'responseTime')
+                    ax = scatterCharter(fig, snapshot, campaignName, 'speed', 'responseTime', 'log')
 
                     ax.set_xlim(0.01, 100.0)
                     ax.set_ylim(0.001, 100.0)
@@ -1299,7 +2311,7 @@ class GraphsPage(webapp2.RequestHandler):
                     # ax.legend()
 
                 elif graphName == 'graph12':
-                    ax = scatterCharter(fig, campaignKey, 'distance', 'responseTime')
+                    ax = scatterCharter(fig, snapshot, campaignName, 'distance', 'responseTime', 'log')
 
                     ax.set_xlim(0.01, 1000.0)
                     ax.set_ylim(0.001, 100.0)
@@ -1311,7 +2323,7 @@ class GraphsPage(webapp2.RequestHandler):
                     # ax.legend()
 
                 elif graphName == 'graph13':
-                    ax = scatterCharter(fig, campaignKey, 'networkChange', 'responseTime')
+                    ax = scatterCharter(fig, snapshot, campaignName, 'networkChange', 'responseTime')
 
                     # ax.set_xlim(0.01, 100.0)
                     # ax.set_ylim(0.01, 100.0)
@@ -1323,7 +2335,7 @@ class GraphsPage(webapp2.RequestHandler):
                     # ax.legend()
 
                 elif graphName == 'graph14':
-                    ax = scatterCharter(fig, campaignKey, 'pingChange', 'responseTime')
+                    ax = scatterCharter(fig, snapshot, campaignName, 'pingChange', 'responseTime')
 
                     # ax.set_xlim(0.01, 100.0)
                     ax.set_ylim(0.001, 100.0)
@@ -1334,19 +2346,19 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Ping Response Time Change versus Response Time")
 
                 elif graphName == 'graph15':
-                    ax = histogramCharter(fig, campaignKey, 'distance')
+                    ax = histogramCharter(fig, snapshot, 'distance')
                     ax.set_xlabel("Distance (m)")
                     ax.set_ylabel("Count")
                     ax.set_title("Frequency of Tests by Distance Device Travelled")
 
                 elif graphName == 'graph16':
-                    ax = histogramCharter(fig, campaignKey, 'networkChange')
+                    ax = histogramCharter(fig, snapshot, 'networkChange')
                     ax.set_xlabel("Network Class Change")
                     ax.set_ylabel("Count")
                     ax.set_title("Frequency of Tests by Network Class Change")
 
                 elif graphName == 'graph17':
-                    ax = scatterComparer(fig, campaignKey, 'distance', 'responseTime', 'server', ['ESRI', 'OGC', 'GME'], cmap, cmapDark)
+                    ax = scatterComparer(fig, snapshot, campaignName, 'distance', 'responseTime', 'server', ['ESRI', 'OGC', 'GME'], cmap, cmapDark, 'log')
 
                     ax.set_xlim(0.01, 10000.0)
                     ax.set_ylim(0.1, 100.0)
@@ -1357,7 +2369,7 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Device Distance Travelled versus Response Time by Server Type")
 
                 elif graphName == 'graph18':
-                    ax = scatterComparer(fig, campaignKey, 'distance', 'responseTime', 'httpMethod', ['GET', 'POST'], cmap, cmapDark)
+                    ax = scatterComparer(fig, snapshot, campaignName, 'distance', 'responseTime', 'httpMethod', ['GET', 'POST'], cmap, cmapDark, 'log')
 
                     ax.set_xlim(0.01, 10000.0)
                     ax.set_ylim(0.1, 100.0)
@@ -1368,7 +2380,7 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Device Distance Travelled versus Response Time by HTTP Method")
 
                 elif graphName == 'graph19':
-                    ax = scatterComparer(fig, campaignKey, 'distance', 'responseTime', 'returnType', ['JSON', 'XML', 'Image'], cmap, cmapDark)
+                    ax = scatterComparer(fig, snapshot, campaignName, 'distance', 'responseTime', 'returnType', ['JSON', 'XML', 'Image'], cmap, cmapDark, 'log')
 
                     ax.set_xlim(0.01, 10000.0)
                     ax.set_ylim(0.1, 100.0)
@@ -1379,7 +2391,7 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Device Distance Travelled versus Response Time by Response Data Type")
 
                 elif graphName == 'graph20':
-                    ax = scatterComparer(fig, campaignKey, 'distance', 'responseTime', 'name', ['Small', 'Big'], cmap, cmapDark)
+                    ax = scatterComparer(fig, snapshot, campaignName, 'distance', 'responseTime', 'name', ['Small', 'Big'], cmap, cmapDark, 'log')
 
                     ax.set_xlim(0.01, 10000.0)
                     ax.set_ylim(0.1, 100.0)
@@ -1390,7 +2402,7 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Device Distance Travelled versus Response Time by Response Data Size Category")
 
                 elif graphName == 'graph21':
-                    ax = scatterComparer(fig, campaignKey, 'distance', 'responseTime', 'name', ['FeatureByID', 'AttributeFilter', 'IntersectFilter', 'DistanceFilter'], cmap, cmapDark)
+                    ax = scatterComparer(fig, snapshot, campaignName, 'distance', 'responseTime', 'name', ['FeatureByID', 'AttributeFilter', 'IntersectFilter', 'DistanceFilter'], cmap, cmapDark, 'log')
 
                     ax.set_xlim(0.01, 10000.0)
                     ax.set_ylim(0.1, 100.0)
@@ -1401,43 +2413,43 @@ class GraphsPage(webapp2.RequestHandler):
                     ax.set_title("Device Distance Travelled versus Response Time by Server-side Operation Type")
 
                 elif graphName == 'graph22':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'server', ['ESRI', 'OGC', 'GME'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'server', ['ESRI', 'OGC', 'GME'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range byServer Type")
 
                 elif graphName == 'graph23':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'httpMethod', ['GET', 'POST'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'httpMethod', ['GET', 'POST'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range byHTTP Method")
 
                 elif graphName == 'graph24':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'returnType', ['JSON', 'XML', 'Image'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'returnType', ['JSON', 'XML', 'Image'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range byResponse Data Type")
 
                 elif graphName == 'graph25':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'name', ['Small', 'Big'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'name', ['Small', 'Big'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range byResponse Data Size Category")
 
                 elif graphName == 'graph26':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'name', ['FeatureByID', 'AttributeFilter', 'IntersectFilter', 'DistanceFilter'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'name', ['FeatureByID', 'AttributeFilter', 'IntersectFilter', 'DistanceFilter'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range byServer-side Operation Type")
 
                 elif graphName == 'graph27':
-                    ax = boxAndWhiskersCharter(fig, campaignKey, 'responseTime', 'name', ['GetTileKVP', 'GetTileRestful'])
+                    ax = boxAndWhiskersCharter(fig, campaignName, 'responseTime', 'name', ['GetTileKVP', 'GetTileRestful'])
                     ax.set_yscale('log')
                     ax.set_ylabel("Response Time (seconds)")
                     ax.set_title("Interquartile Range by Image Request Type")
 
                 elif graphName == 'graph28':
-                    ax = boxAndWhiskersCharterDistance(fig, campaignKey)
+                    ax = boxAndWhiskersCharterDistance(fig, campaignName)
                     ax.set_yscale('log')
                     ax.set_ylim(0.001, 10000.0)
                     ax.set_ylabel("Device Distance Travelled (m)")
@@ -1446,7 +2458,9 @@ class GraphsPage(webapp2.RequestHandler):
                 strOutput = cStringIO.StringIO()
                 fig.savefig(strOutput, format="svg")
                 graphImage = strOutput.getvalue()
+                GRAPH_CACHE.put(graphKey, graphImage)
 
+                self.response.etag = graphEtag
                 self.response.headers['Content-Type'] = 'text/html'
                 # self.response.write("""<html><head/><body>""")
                 self.response.write(graphImage)
@@ -1467,9 +2481,12 @@ class GraphsPage(webapp2.RequestHandler):
 app = webapp2.WSGIApplication([
     ('/servicetest', TestPage),
     ('/database', Database),
+    ('/uploadsession', UploadSessions),
+    ('/manifest', Manifest),
     ('/storereferences', StoreReferences),
     ('/storereferencesworker', StoreReferencesWorker),
     ('/analyse', Analyse),
+    ('/analysepull', AnalysePull),
     ('/stats', StatsPage),
     ('/graphs', GraphsPage)
 ], debug=True)
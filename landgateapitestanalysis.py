@@ -0,0 +1,513 @@
+""" LandgateAPITest Web App
+
+Analysis module
+
+Created by Aiden Price,
+Curtin University Masters of Geospatial Science candidate,
+Submitted June 2016"""
+
+# Standard python libraries.
+import base64
+import bisect
+import cStringIO
+import hashlib
+import math
+from operator import attrgetter
+from xml.etree.cElementTree import iterparse
+
+# Third party libraries.
+import numpy
+
+# Local upload parsing imports
+from landgateapitestparser import JsonStreamReader
+
+# PIL is optional, without it image responses are checked as text.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Constants and helper classes and functions
+
+# Rolling hash arithmetic is modulo 2**64, numpy's uint64 wrap around.
+# An odd base has a multiplicative inverse there, found by Newton's method.
+# Responses up to DIRECT_SEARCH_LENGTH characters are searched for with
+# str's own search, whose worst case is bounded by that length.
+DIRECT_SEARCH_LENGTH = 256
+
+# Images are fingerprinted from a FINGERPRINT_ROWS by FINGERPRINT_ROWS + 1
+# grid of their mean brightness, one bit per horizontal gradient.
+FINGERPRINT_ROWS = 8
+
+IMAGE_MATCH_DISTANCE = 10  # most bits an image fingerprint may differ from its reference's.
+
+# Attributes identifying a feature, in order of preference, compared in
+# lower case. Features with none of them are identified by all their
+# attributes together.
+FEATURE_ID_FIELDS = ('stopid', 'objectid', 'id', 'fid')
+
+# Quantile sketches count values in logarithmic buckets, each SKETCH_GAMMA
+# times wider than the last, so any quantile is found to within
+# SKETCH_RELATIVE_ACCURACY of its value. Zero and below share one bucket.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_ZERO_BUCKET = 'z'
+SKETCH_SAMPLE_POINTS = 1001  # quantiles standing in for a sketched series when plotted.
+
+# The tests whose reference checks are not trusted, as (server, dataset,
+# name, httpMethod, returnType). Their Vectors are stored with
+# referenceCheckValid False and left out of the counts and graphs.
+INVALID_REFERENCE_CHECKS = frozenset([
+    ('OGC', 'BusStops', 'GetCapabilities', 'GET', 'XML'),
+    ('OGC', 'BusStops', 'AttributeFilter', 'GET', 'JSON'),
+    ('OGC', 'BusStops', 'GetCapabilities', 'POST', 'XML'),
+    ('OGC', 'Topo', 'Big', 'GET', 'Image'),
+    ('OGC', 'Topo', 'Small', 'GET', 'Image'),
+    ('GME', 'BusStops', 'Small', 'GET', 'JSON'),
+    ('GME', 'AerialPhoto', 'WMSGetCapabilities', 'GET', 'XML'),
+    ('GME', 'AerialPhoto', 'WMTSGetCapabilities', 'GET', 'XML'),
+])
+
+HASH_BASE = 1000003
+HASH_MODULUS = 2 ** 64
+HASH_BASE_INVERSE = HASH_BASE
+for iteration in range(6):
+    HASH_BASE_INVERSE = (HASH_BASE_INVERSE * (2 - HASH_BASE * HASH_BASE_INVERSE)) % HASH_MODULUS
+
+
+class TimeSeries(object):
+    """A TestMaster's LocationResults, NetworkResults or PingResults
+    sorted by datetime once, so the results either side of each of its
+    TestEndpoints are found by binary search rather than by a datastore
+    query per endpoint. key gives a result's datetime, or anything else
+    ordered in the same way, its datetime attribute by default."""
+    def __init__(self, listResults, key=attrgetter('datetime')):
+        self.listResults = sorted(listResults, key=key)
+        self.listDatetimes = [key(result) for result in self.listResults]
+
+    def before(self, moment):
+        """Returns the latest result strictly before moment, or None."""
+        index = bisect.bisect_left(self.listDatetimes, moment) - 1
+        if index < 0:
+            return None
+        return self.listResults[index]
+
+    def after(self, moment):
+        """Returns the earliest result strictly after moment, or None."""
+        index = bisect.bisect_right(self.listDatetimes, moment)
+        if index >= len(self.listResults):
+            return None
+        return self.listResults[index]
+
+
+def isReferenceCheckValid(server, dataset, name, httpMethod, returnType):
+    """Returns whether the reference check of a test is trusted, see
+    INVALID_REFERENCE_CHECKS."""
+    return (server, dataset, name, httpMethod, returnType) not in INVALID_REFERENCE_CHECKS
+
+
+def NetworkClass(connectionType):
+    """Classifies mobile broadband networks by their generation,
+    i.e. 3.5G, 4G etc as float values.
+    N.B. Assume 5 for wifi connections."""
+    generation = 0.0
+
+    if connectionType == 'CTRadioAccessTechnologyGPRS':
+        generation = 2.5
+    elif connectionType == 'CTRadioAccessTechnologyCDMA1x':
+        generation = 2.5
+    elif connectionType == 'CTRadioAccessTechnologyEdge':
+        generation = 2.75
+    elif connectionType == 'CTRadioAccessTechnologyWCDMA':
+        generation = 3.0
+    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORev0':
+        generation = 3.0
+    elif connectionType == 'CTRadioAccessTechnologyeHRPD':
+        generation = 3.0
+    elif connectionType == 'CTRadioAccessTechnologyHSDPA':
+        generation = 3.5
+    elif connectionType == 'CTRadioAccessTechnologyHSUPA':
+        generation = 3.5
+    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORevA':
+        generation = 3.5
+    elif connectionType == 'CTRadioAccessTechnologyCDMAEVDORevB':
+        generation = 3.75
+    elif connectionType == 'CTRadioAccessTechnologyLTE':
+        generation = 4.0
+    elif connectionType == 'Wifi':
+        generation = 5.0
+    return generation
+
+
+def measureChanges(location1, location2, elapsedSeconds, prePingTime, postPingTime, preConnectionType, postConnectionType):
+    """Returns the (distance, speed, pingChange, networkChange) of a Vector,
+    the change in environment during a test, from its supporting tests.
+    elapsedSeconds is the time between the two locations."""
+    distance = HaversineDistance(location1, location2)
+    speed = distance / elapsedSeconds
+    pingChange = prePingTime - postPingTime
+    networkChange = NetworkClass(postConnectionType) - NetworkClass(preConnectionType)
+    return distance, speed, pingChange, networkChange
+
+
+def HaversineDistance(location1, location2):
+    """Method to calculate Distance between two sets of Lat/Lon.
+    Modified from Amyth's StackOverflow answer of 22/5/2012;
+    http://stackoverflow.com/questions/10693699/calculate-distance-between-cities-find-surrounding-cities-based-on-geopt-in-p
+    """
+    lat1 = location1.lat
+    lon1 = location1.lon
+
+    lat2 = location2.lat
+    lon2 = location2.lon
+
+    earth = 6378137 #Earth's equatorial radius in metres.
+
+    #Calculate distance based on Haversine Formula
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    d = earth * c
+    return d
+
+
+def normaliseResponse(text):
+    """Returns text as ASCII with its line breaks and spaces removed, the
+    form in which responses are compared to references. Non ASCII
+    characters are dropped."""
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'ignore')
+    else:
+        text = (text or '').decode('ascii', 'ignore').encode('ascii')
+    return text.replace('\r\n', '').translate(None, '\n ')
+
+
+def _hashPowers(base, length):
+    """Returns base ** i modulo 2 ** 64 for i in range(length)."""
+    powers = numpy.empty(length, dtype=numpy.uint64)
+    powers[:1] = 1
+    powers[1:] = base
+    return numpy.cumprod(powers, out=powers)
+
+
+def containsNormalised(response, reference):
+    """Returns whether the string response occurs within the string
+    reference, in time linear in their lengths.
+    Short responses use str's search. For the rest a Rabin-Karp polynomial
+    hash of every window of reference is computed at once from numpy
+    prefix sums, then only the windows whose hash matches that of
+    response are compared character by character."""
+    lengthResponse = len(response)
+    lengthReference = len(reference)
+    if lengthResponse == 0:
+        return True
+    if lengthResponse > lengthReference:
+        return False
+    if lengthResponse <= DIRECT_SEARCH_LENGTH:
+        return response in reference
+
+    text = numpy.frombuffer(reference, dtype=numpy.uint8).astype(numpy.uint64)
+    pattern = numpy.frombuffer(response, dtype=numpy.uint8).astype(numpy.uint64)
+    powers = _hashPowers(HASH_BASE, lengthReference)
+    countWindows = lengthReference - lengthResponse + 1
+
+    # prefix[i] is the hash of reference[:i], the hash of each window
+    # is the difference of two prefixes shifted back to power zero.
+    prefix = numpy.zeros(lengthReference + 1, dtype=numpy.uint64)
+    numpy.cumsum(text * powers, out=prefix[1:])
+    windows = (prefix[lengthResponse:] - prefix[:countWindows]) * _hashPowers(HASH_BASE_INVERSE, countWindows)
+
+    patternHash = numpy.cumsum(pattern * powers[:lengthResponse])[-1]
+
+    for start in numpy.flatnonzero(windows == patternHash):
+        if reference[start:start + lengthResponse] == response:
+            return True
+    return False
+
+
+def imageFingerprint(imageData):
+    """Returns a 64 bit perceptual difference hash of an encoded image as a
+    hex string, or None if PIL is unavailable or the data is not an image.
+    Transparent pixels are laid over white and the image reduced to the
+    mean brightness of each cell of a grid, each bit of the hash being
+    whether a cell is brighter than its left neighbour. Re-encoding or
+    recompressing an image leaves it almost unchanged."""
+    if Image is None:
+        return None
+
+    try:
+        pixels = numpy.asarray(Image.open(cStringIO.StringIO(imageData)).convert('RGBA'), dtype=numpy.float64)
+    except Exception:
+        return None
+
+    rows = FINGERPRINT_ROWS
+    columns = FINGERPRINT_ROWS + 1
+    height, width = pixels.shape[:2]
+    if height < rows or width < columns:
+        return None
+
+    alpha = pixels[:, :, 3] / 255.0
+    brightness = numpy.dot(pixels[:, :, :3], [0.299, 0.587, 0.114]) * alpha + 255.0 * (1.0 - alpha)
+
+    # Sum the brightness over each cell of the grid, then take the mean.
+    rowEdges = numpy.linspace(0, height, rows + 1).astype(int)
+    columnEdges = numpy.linspace(0, width, columns + 1).astype(int)
+    cells = numpy.add.reduceat(numpy.add.reduceat(brightness, rowEdges[:-1], axis=0), columnEdges[:-1], axis=1)
+    cells /= numpy.outer(numpy.diff(rowEdges), numpy.diff(columnEdges))
+
+    bits = (cells[:, 1:] > cells[:, :-1]).ravel()
+    return ''.join('%02x' % byte for byte in numpy.packbits(bits))
+
+
+def base64Fingerprint(imageText):
+    """Returns the imageFingerprint of a base64 encoded image, or None."""
+    try:
+        return imageFingerprint(base64.b64decode(imageText or ''))
+    except (TypeError, ValueError):
+        return None
+
+
+def hammingDistance(fingerprint1, fingerprint2):
+    """Returns the number of bits differing between two hex fingerprints."""
+    return bin(int(fingerprint1, 16) ^ int(fingerprint2, 16)).count('1')
+
+
+def _localName(tag):
+    """Returns an XML tag without its {namespace} prefix."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def iterJsonFeatures(fileObj):
+    """Yields the attributes of each feature in an ESRI JSON or GeoJSON
+    document as a dict, decoding one feature at a time."""
+    reader = JsonStreamReader(fileObj)
+    for key, reader in reader.iterObject():
+        if key != 'features':
+            reader.decodeValue()
+            continue
+
+        for feature in reader.iterArray():
+            if not isinstance(feature, dict):
+                continue
+            attributes = dict(feature.get('attributes') or feature.get('properties') or {})
+            if feature.get('id') is not None:
+                attributes.setdefault('id', feature.get('id'))
+            yield attributes
+
+
+def iterGmlFeatures(fileObj):
+    """Yields the attributes of each feature in a GML document as a dict,
+    the text of the feature's simple child elements plus its fid. Each
+    featureMember is discarded once read."""
+    for event, element in iterparse(fileObj):
+        if _localName(element.tag) not in ('featureMember', 'featureMembers'):
+            continue
+
+        for feature in element:
+            attributes = dict((_localName(child.tag), child.text) for child in feature if len(child) == 0 and child.text is not None)
+            fid = feature.get('fid') or feature.get('{http://www.opengis.net/gml}id')
+            if fid is not None:
+                attributes['fid'] = fid
+            yield attributes
+
+        element.clear()
+
+
+def featureSignature(attributes):
+    """Returns (featureID, digest) for a feature's attributes, the digest
+    covering every attribute with a value, so two features with the same
+    identifier but different attributes are told apart."""
+    dictAttributes = dict((key.lower(), unicode(value)) for key, value in attributes.items() if value is not None)
+    digest = hashlib.sha1(repr(sorted(dictAttributes.items()))).hexdigest()
+
+    for field in FEATURE_ID_FIELDS:
+        if field in dictAttributes:
+            return dictAttributes[field], digest
+    return digest, digest
+
+
+def iterFeatureSignatures(text, returnType):
+    """Yields the featureSignature of each feature in a JSON or XML
+    response, streaming through it. A truncated or malformed response
+    yields the features before the fault."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    if returnType == 'XML':
+        features = iterGmlFeatures(cStringIO.StringIO(text))
+    else:
+        features = iterJsonFeatures(cStringIO.StringIO(text))
+
+    try:
+        for attributes in features:
+            yield featureSignature(attributes)
+    except (ValueError, SyntaxError, EOFError, IndexError):
+        return
+
+
+def buildFeatureIndex(text, returnType):
+    """Returns a dict of featureID to attribute digest for every feature
+    in a reference, or None if it has no features to compare."""
+    featureIndex = dict(iterFeatureSignatures(text, returnType))
+    return featureIndex or None
+
+
+def compareFeatures(text, returnType, featureIndex):
+    """Returns (matched, missing) counts for the features of a response
+    checked against a reference's featureIndex, matched being those found
+    in the reference with the same attributes and missing those not, or
+    None if the response has no features to compare."""
+    matched = 0
+    missing = 0
+    for featureID, digest in iterFeatureSignatures(text, returnType):
+        if featureIndex.get(featureID) == digest:
+            matched += 1
+        else:
+            missing += 1
+
+    if matched + missing == 0:
+        return None
+    return matched, missing
+
+
+def prepareReference(reference, returnType, imageData=None):
+    """Returns everything the reference checks need from a reference as a
+    dict, worked out once when it is stored. The normalised reference and
+    its digest, then the imageFingerprint of Image references, from
+    imageData if given otherwise their base64 text, and the featureIndex
+    of JSON and XML references."""
+    normalisedReference = normaliseResponse(reference)
+
+    dictReference = {}
+    dictReference['normalisedReference'] = normalisedReference
+    dictReference['normalisedDigest'] = hashlib.sha1(normalisedReference).hexdigest()
+    dictReference['fingerprint'] = None
+    dictReference['featureIndex'] = None
+
+    if returnType == 'Image':
+        if imageData is not None:
+            dictReference['fingerprint'] = imageFingerprint(imageData)
+        else:
+            dictReference['fingerprint'] = base64Fingerprint(reference)
+    elif returnType in ('JSON', 'XML'):
+        dictReference['featureIndex'] = buildFeatureIndex(reference, returnType)
+
+    return dictReference
+
+
+def checkPreparedReference(responseData, returnType, normalisedReference, normalisedDigest, fingerprint=None, featureIndex=None):
+    """Returns (success, matched, missing) for a response checked against
+    a reference prepared by prepareReference().
+    Images with a fingerprinted reference match if their fingerprints
+    are within IMAGE_MATCH_DISTANCE bits, however they were encoded.
+    JSON and GML responses are compared feature by feature against the
+    reference's featureIndex, and match if every feature is found
+    unchanged, matched and missing being the counts, None otherwise.
+    Responses with no decodable image or features, such as truncated
+    tiles or error messages, fall back to the text checks. A response
+    identical to the reference after normalisation is caught by its
+    digest, otherwise it must be found within the reference."""
+    if fingerprint is not None:
+        responseFingerprint = base64Fingerprint(responseData)
+        if responseFingerprint is not None:
+            return hammingDistance(responseFingerprint, fingerprint) <= IMAGE_MATCH_DISTANCE, None, None
+
+    if featureIndex is not None:
+        counts = compareFeatures(responseData, returnType, featureIndex)
+        if counts is not None:
+            matched, missing = counts
+            return missing == 0, matched, missing
+
+    responseData = normaliseResponse(responseData)
+    if hashlib.sha1(responseData).hexdigest() == normalisedDigest:
+        return True, None, None
+
+    return containsNormalised(responseData, normalisedReference), None, None
+
+
+def sketchBucket(value):
+    """Returns the name of the quantile sketch bucket counting value.
+    Sketches are dicts of bucket name to count, so are merged, or values
+    taken back out of them, by adding or subtracting counts."""
+    if value <= 0:
+        return SKETCH_ZERO_BUCKET
+    return str(int(math.ceil(math.log(value) / SKETCH_LOG_GAMMA)))
+
+
+def bucketValue(bucket):
+    """Returns the value standing for every value counted in bucket, the
+    one within SKETCH_RELATIVE_ACCURACY of all of them."""
+    if bucket == SKETCH_ZERO_BUCKET:
+        return 0.0
+    return 2 * SKETCH_GAMMA ** int(bucket) / (SKETCH_GAMMA + 1)
+
+
+def sketchQuantiles(dictSketch, quantiles):
+    """Returns a numpy array of the values of a sketch at each of
+    quantiles, from 0 to 1, or an empty array for an empty sketch.
+    Quantiles falling between two ranks are interpolated, as numpy's
+    percentile() does."""
+    listBuckets = sorted((bucketValue(bucket), count) for bucket, count in dictSketch.items() if count > 0)
+    if not listBuckets:
+        return numpy.zeros(0)
+
+    arrayValues = numpy.array([value for value, count in listBuckets])
+    arrayCumulative = numpy.cumsum([count for value, count in listBuckets])
+    ranks = numpy.asarray(quantiles, dtype=float) * (arrayCumulative[-1] - 1)
+    lower = arrayValues[numpy.searchsorted(arrayCumulative, numpy.floor(ranks), side='right')]
+    upper = arrayValues[numpy.searchsorted(arrayCumulative, numpy.ceil(ranks), side='right')]
+    return lower + (upper - lower) * (ranks - numpy.floor(ranks))
+
+
+def sketchSample(dictSketch, count=SKETCH_SAMPLE_POINTS):
+    """Returns count values evenly spaced in rank through a sketch, its
+    smallest and largest included, which have the sketch's median,
+    quartiles and extremes and so stand in for the whole series in a box
+    plot, however many values it counts."""
+    return sketchQuantiles(dictSketch, numpy.linspace(0., 1., count))
+
+
+def regressionSums(x, y, weight=1):
+    """Returns the sums a least squares line is fitted from, for one point,
+    each weight times over, as a dict to be added to the series' totals.
+    n, x, y, xx, xy and yy for the line through the values themselves and
+    the same prefixed log for the line through their base 10 logarithms,
+    for log scaled charts, which only counts points with both positive.
+    Points missing either value count in neither."""
+    if x is None or y is None or math.isnan(x) or math.isnan(y) or math.isinf(x) or math.isinf(y):
+        return {}
+
+    dictSums = {'n': weight, 'x': weight * x, 'y': weight * y,
+                'xx': weight * x * x, 'xy': weight * x * y, 'yy': weight * y * y}
+    if x > 0 and y > 0:
+        logX = math.log10(x)
+        logY = math.log10(y)
+        dictSums.update({'logn': weight, 'logx': weight * logX, 'logy': weight * logY,
+                         'logxx': weight * logX * logX, 'logxy': weight * logX * logY, 'logyy': weight * logY * logY})
+    return dictSums
+
+
+def fitRegression(dictSums, space='linear'):
+    """Returns (slope, intercept, rSquared) of the least squares line of a
+    series from its regressionSums() totals, through the values themselves
+    or, for space 'log', their logarithms. None if there are fewer than two
+    distinct x values to fit."""
+    prefix = 'log' if space == 'log' else ''
+    n = float(dictSums.get(prefix + 'n', 0))
+    if n < 2:
+        return None
+
+    sumX = dictSums[prefix + 'x']
+    sumY = dictSums[prefix + 'y']
+    sxx = dictSums[prefix + 'xx'] - sumX * sumX / n
+    sxy = dictSums[prefix + 'xy'] - sumX * sumY / n
+    syy = dictSums[prefix + 'yy'] - sumY * sumY / n
+    if sxx <= 0:
+        return None
+
+    slope = sxy / sxx
+    intercept = (sumY - slope * sumX) / n
+    rSquared = sxy * sxy / (sxx * syy) if syy > 0 else 1.0
+    return slope, intercept, rSquared
@@ -0,0 +1,165 @@
+import collections
+import random
+import unittest
+
+import numpy
+
+from landgateapitestanalysis import DIRECT_SEARCH_LENGTH, SKETCH_RELATIVE_ACCURACY
+from landgateapitestanalysis import containsNormalised, sketchBucket, bucketValue, sketchQuantiles, sketchSample
+from landgateapitestanalysis import regressionSums, fitRegression
+
+
+class ContainsNormalisedTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1234)
+
+    def randomText(self, length, alphabet='ab'):
+        return ''.join(self.random.choice(alphabet) for i in range(length))
+
+    def testShort(self):
+        for reference in ('', 'a', 'abc', 'the quick brown fox'):
+            for response in ('', 'a', 'bc', 'quick', 'fox!', 'the quick brown fox jumps'):
+                self.assertEqual(containsNormalised(response, reference), response in reference)
+
+    def testLong(self):
+        reference = self.randomText(5000)
+        for length in (DIRECT_SEARCH_LENGTH + 1, 300, 1000, 5000):
+            for start in (0, 17, 5000 - length):
+                response = reference[start:start + length]
+                self.assertTrue(containsNormalised(response, reference))
+
+                # Flipping one character almost never leaves a match elsewhere
+                # in the reference, but compare with str's search to be sure.
+                changed = response[:length // 2] + ('a' if response[length // 2] == 'b' else 'b') + response[length // 2 + 1:]
+                self.assertEqual(containsNormalised(changed, reference), changed in reference)
+
+    def testLongRandom(self):
+        for i in range(50):
+            reference = self.randomText(self.random.randint(0, 2000), 'abc')
+            response = self.randomText(self.random.randint(DIRECT_SEARCH_LENGTH + 1, 600), 'abc')
+            self.assertEqual(containsNormalised(response, reference), response in reference)
+
+    def testLongPeriodic(self):
+        # Periodic text gives many overlapping windows with the same hash.
+        reference = 'ab' * 2000
+        self.assertTrue(containsNormalised('ba' * 400, reference))
+        self.assertFalse(containsNormalised('ba' * 400 + 'c', reference))
+        self.assertFalse(containsNormalised('ab' * 2001, reference))
+
+    def testAllBytes(self):
+        reference = ''.join(chr(i) for i in range(256)) * 4
+        self.assertTrue(containsNormalised(reference[100:700], reference))
+        self.assertFalse(containsNormalised(reference[100:700] + '\x00', reference[:700]))
+
+
+class SketchTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1234)
+
+    def sketch(self, values):
+        return dict(collections.Counter(sketchBucket(value) for value in values))
+
+    def assertWithinAccuracy(self, actual, expected):
+        tolerance = SKETCH_RELATIVE_ACCURACY * numpy.abs(expected) + 1e-12
+        self.assertTrue(numpy.all(numpy.abs(actual - expected) <= tolerance), (actual, expected))
+
+    def testBucketValue(self):
+        for value in (1e-6, 0.001, 0.5, 1, 2.5, 123.456, 1e9):
+            self.assertWithinAccuracy(bucketValue(sketchBucket(value)), value)
+        self.assertEqual(bucketValue(sketchBucket(0)), 0)
+        self.assertEqual(bucketValue(sketchBucket(-3)), 0)
+
+    def testQuantiles(self):
+        quantiles = numpy.linspace(0., 1., 101)
+        for values in ([self.random.lognormvariate(5, 1) for i in range(2000)],
+                       [self.random.uniform(0, 10) for i in range(7)],
+                       [0] * 10 + [self.random.expovariate(0.01) for i in range(500)],
+                       [42.]):
+            self.assertWithinAccuracy(sketchQuantiles(self.sketch(values), quantiles),
+                                      numpy.percentile(values, quantiles * 100))
+
+    def testMergeAndRemove(self):
+        values1 = [self.random.lognormvariate(2, 2) for i in range(300)]
+        values2 = [self.random.lognormvariate(4, 1) for i in range(700)]
+        merged = collections.Counter(self.sketch(values1)) + collections.Counter(self.sketch(values2))
+        self.assertWithinAccuracy(sketchQuantiles(merged, [0.1, 0.5, 0.9]),
+                                  numpy.percentile(values1 + values2, [10, 50, 90]))
+
+        # Taking values back out leaves zero counts that must be ignored.
+        removed = dict(merged)
+        for bucket, count in self.sketch(values2).items():
+            removed[bucket] -= count
+        self.assertWithinAccuracy(sketchQuantiles(removed, [0, 0.25, 0.5, 1]),
+                                  numpy.percentile(values1, [0, 25, 50, 100]))
+
+    def testEmpty(self):
+        self.assertEqual(len(sketchQuantiles({}, [0.5])), 0)
+        self.assertEqual(len(sketchSample({'3': 0})), 0)
+
+    def testSample(self):
+        values = [self.random.uniform(1, 100) for i in range(5000)]
+        sample = sketchSample(self.sketch(values), 11)
+        self.assertEqual(len(sample), 11)
+        self.assertWithinAccuracy(sample, numpy.percentile(values, numpy.linspace(0, 100, 11)))
+
+
+class RegressionTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1234)
+
+    def totals(self, points):
+        dictTotals = collections.Counter()
+        for point in points:
+            dictTotals.update(regressionSums(*point))
+        return dict(dictTotals)
+
+    def assertFit(self, fit, x, y):
+        slope, intercept = numpy.polyfit(x, y, 1)
+        rSquared = numpy.corrcoef(x, y)[0, 1] ** 2
+        numpy.testing.assert_allclose(fit, (slope, intercept, rSquared), rtol=1e-7, atol=1e-9)
+
+    def testLinear(self):
+        x = [self.random.uniform(-50, 50) for i in range(200)]
+        y = [3.5 * value - 12 + self.random.gauss(0, 10) for value in x]
+        self.assertFit(fitRegression(self.totals(zip(x, y))), x, y)
+
+    def testIntegers(self):
+        x = [1, 2, 3, 4, 5]
+        y = [2, 4, 5, 4, 5]
+        self.assertFit(fitRegression(self.totals(zip(x, y))), x, y)
+        self.assertFit(fitRegression(self.totals(zip(x, y)), 'log'), numpy.log10(x), numpy.log10(y))
+
+    def testLog(self):
+        # Points with either value not positive only count in linear space.
+        x = [self.random.uniform(0.1, 1000) for i in range(200)]
+        y = [2 * value ** 0.5 * self.random.lognormvariate(0, 0.2) for value in x]
+        points = zip(x, y) + [(0, 5), (5, -1), (-2, -2)]
+        self.assertFit(fitRegression(self.totals(points), 'log'), numpy.log10(x), numpy.log10(y))
+        self.assertFit(fitRegression(self.totals(points)), [p[0] for p in points], [p[1] for p in points])
+
+    def testWeight(self):
+        x = [1., 2., 3., 4.]
+        y = [1., 3., 2., 5.]
+        weighted = self.totals([(1., 1., 3), (2., 3.), (3., 2.), (4., 5., 2)])
+        self.assertFit(fitRegression(weighted), [1., 1., 1., 2., 3., 4., 4.], [1., 1., 1., 3., 2., 5., 5.])
+
+        # Subtracting a point's sums takes it back out of the totals.
+        removed = collections.Counter(self.totals(zip(x, y)))
+        removed.subtract(regressionSums(4., 5.))
+        self.assertFit(fitRegression(dict(removed)), x[:3], y[:3])
+
+    def testMissing(self):
+        self.assertEqual(regressionSums(None, 1.), {})
+        self.assertEqual(regressionSums(1., float('nan')), {})
+        self.assertEqual(regressionSums(float('inf'), 1.), {})
+        self.assertIsNone(fitRegression({}))
+        self.assertIsNone(fitRegression(self.totals([(1., 2.)])))
+        self.assertIsNone(fitRegression(self.totals([(3., 1.), (3., 2.), (3., 4.)])))
+        self.assertIsNone(fitRegression(self.totals([(1., 2.), (2., -1.)]), 'log'))
+
+    def testFlat(self):
+        self.assertEqual(fitRegression(self.totals([(1., 2.), (2., 2.), (3., 2.)])), (0, 2, 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
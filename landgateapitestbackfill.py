@@ -0,0 +1,272 @@
+""" LandgateAPITest Web App
+
+Campaign re-analysis (backfill) module
+
+Created by Aiden Price,
+Curtin University Masters of Geospatial Science candidate,
+Submitted June 2016"""
+
+# Standard python libraries.
+import json
+from datetime import datetime
+
+# Libraries available on Google cloud service.
+import webapp2
+
+# Google's appengine python libraries.
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+
+# Local model imports
+from landgateapitestmodel import TestMaster
+from landgateapitestmodel import TestEndpoint
+from landgateapitestmodel import Vector
+from landgateapitestmodel import BackfillStatus
+from landgateapitestmodel import BackfillShard
+
+# Local analysis imports
+from landgateapitest import getCampaignKey
+from landgateapitest import analyseTestMaster
+from landgateapitest import resetReferenceSuccessStats
+from landgateapitest import AnalysisEnum
+from landgateapitest import CustomEncoder
+
+# Local snapshot imports
+from landgateapitestsnapshot import resetVectorSnapshot
+
+# Constants and helper classes and functions
+
+BACKFILL_QUEUE_NAME = 'backfill'
+DEFAULT_SHARD_COUNT = 20
+MAX_MASTERS_PER_SHARD = 5000  # keeps each BackfillShard's key list well under the entity size limit.
+MASTERS_PER_TASK = 10  # TestMasters analysed by each task in a shard's chain.
+DELETE_BATCH_SIZE = 500  # Vector keys examined per preparation task.
+
+
+def addBackfillTask(url, name, params):
+    """Adds a named task to the backfill queue. Naming every task after
+    its place in the chain means a retried request can not start a chain
+    twice, the second add is refused and ignored."""
+    try:
+        taskqueue.Queue(BACKFILL_QUEUE_NAME).add(taskqueue.Task(url=url, method='GET', name=name, params=params))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def splitShards(listKeys, shardCount):
+    """Splits the sorted listKeys into shardCount contiguous ranges of
+    nearly equal length, more if any would exceed MAX_MASTERS_PER_SHARD."""
+    shardCount = max(1, shardCount, -(-len(listKeys) // MAX_MASTERS_PER_SHARD))
+    shardCount = min(shardCount, max(1, len(listKeys)))
+    return [listKeys[len(listKeys) * shard // shardCount:len(listKeys) * (shard + 1) // shardCount] for shard in range(shardCount)]
+
+
+def getShardKey(statusKey, index):
+    return ndb.Key(BackfillShard, '%d-%d' % (statusKey.id(), index))
+
+
+def getShards(status):
+    """Returns the BackfillShards of a backfill, by key so the result is
+    strongly consistent, or none before it has been split."""
+    listShards = ndb.get_multi([getShardKey(status.key, index + 1) for index in range(status.shardCount)])
+    return [shard for shard in listShards if shard is not None]
+
+
+def getBackfillProgress(status):
+    """Returns a dict of a backfill's progress, summed over its shards,
+    with its throughput in TestEndpoints analysed per second."""
+    listShards = getShards(status)
+
+    dictProgress = {}
+    dictProgress['statusID'] = status.key.urlsafe()
+    dictProgress['campaignName'] = status.campaignName
+    dictProgress['state'] = status.state
+    dictProgress['shardCount'] = status.shardCount
+    dictProgress['shardsComplete'] = sum(shard.complete for shard in listShards)
+    dictProgress['totalTestMasters'] = sum(len(shard.masterKeys) for shard in listShards)
+    dictProgress['countTestMasters'] = sum(shard.countTestMasters for shard in listShards)
+    dictProgress['countTestEndpoints'] = sum(shard.countTestEndpoints for shard in listShards)
+    dictProgress['countSuccessful'] = sum(shard.countSuccessful for shard in listShards)
+    dictProgress['started'] = status.started
+
+    dictProgress['endpointsPerSecond'] = None
+    if status.started is not None:
+        listFinished = [shard.finished for shard in listShards if shard.finished is not None]
+        if status.state == 'complete' and listFinished:
+            finished = max(listFinished)
+        else:
+            finished = datetime.utcnow()
+        elapsed = (finished - status.started).total_seconds()
+        if elapsed > 0:
+            dictProgress['endpointsPerSecond'] = dictProgress['countTestEndpoints'] / elapsed
+
+    return dictProgress
+
+
+class Backfill(webapp2.RequestHandler):
+    """Re-analyses every TestMaster of a campaign, after the references or
+    the analysis itself have changed, far faster than the analysis queue.
+    GET ?campaignName=&shards= starts a backfill, GET ?statusID= reports
+    its progress and throughput as JSON."""
+    def get(self):
+        try:
+            statusID = self.request.get('statusID')
+            if statusID:
+                status = ndb.Key(urlsafe=statusID).get()
+                if status is None:
+                    raise ValueError('No such backfill.')
+            else:
+                campaignName = self.request.get('campaignName')
+                status = BackfillStatus()
+                status.campaignName = campaignName
+                status.state = 'preparing'
+                status.shardCount = int(self.request.get('shards', DEFAULT_SHARD_COUNT))
+                status.put()
+
+                addBackfillTask('/backfillprepare', 'backfill-' + str(status.key.id()) + '-prepare-0',
+                                {'statusID': status.key.urlsafe(), 'cursor': 'None', 'page': 0})
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Missing or invalid parameter in request.\n' +
+                                'Please provide ?campaignName=&shards= or ?statusID=\n\n' +
+                                e.message + '\n\n')
+        else:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(getBackfillProgress(status), indent=4, cls=CustomEncoder))
+
+
+class BackfillPrepare(webapp2.RequestHandler):
+    """Readies a campaign for re-analysis. First deletes, a page at a time,
+    the Vectors stored under allocated ids before Vectors were named after
+    their TestEndpoint, which re-analysis would otherwise duplicate. Then
+    zeroes the reference success stats, deletes the Vector snapshot and
+    aggregates, whose rows the re-analysis writes afresh, splits
+    the TestMasters into BackfillShards and marks the backfill 'starting'.
+    Only then is a task chain started for each shard, and the backfill
+    marked 'running', so a retry after a partial start adds the missing
+    chains without resetting the shards already running."""
+    def get(self):
+        status = ndb.Key(urlsafe=self.request.get('statusID')).get()
+        if status is None or status.state not in ('preparing', 'starting'):
+            return
+
+        campaignKey = getCampaignKey(status.campaignName)
+
+        if status.state == 'preparing':
+            page = int(self.request.get('page'))
+
+            cursorString = self.request.get('cursor')
+            cursor = None
+            if cursorString != 'None':
+                cursor = Cursor(urlsafe=cursorString)
+
+            listVectorKeys, next_cursor, more = Vector.query(ancestor=campaignKey).fetch_page(DELETE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            ndb.delete_multi([key for key in listVectorKeys if key.integer_id() is not None])
+
+            if more:
+                addBackfillTask('/backfillprepare', 'backfill-' + str(status.key.id()) + '-prepare-' + str(page + 1),
+                                {'statusID': status.key.urlsafe(), 'cursor': next_cursor.urlsafe(), 'page': page + 1})
+                return
+
+            resetReferenceSuccessStats(status.campaignName)
+            resetVectorSnapshot(status.campaignName)
+
+            listMasterKeys = sorted(TestMaster.query(ancestor=campaignKey).fetch(keys_only=True))
+            listShards = []
+            for index, listKeys in enumerate(splitShards(listMasterKeys, status.shardCount)):
+                listShards.append(BackfillShard(key=getShardKey(status.key, index + 1), status=status.key, masterKeys=listKeys))
+            ndb.put_multi(listShards)
+
+            status.shardCount = len(listShards)
+            status.state = 'starting'
+            status.started = datetime.utcnow()
+            status.put()
+        else:
+            listShards = getShards(status)
+
+        for shard in listShards:
+            addBackfillTask('/backfillworker', getWorkerTaskName(shard, 0),
+                            {'shardKey': shard.key.urlsafe(), 'position': 0})
+
+        status.state = 'running'
+        status.put()
+
+
+def getWorkerTaskName(shard, position):
+    return 'backfill-' + shard.key.id() + '-' + str(position)
+
+
+def getBatchName(shard, masterKey):
+    """Returns the name of the batch re-analysing one TestMaster, the same
+    for every retry of it within this backfill."""
+    return 'backfill-' + shard.status.urlsafe() + '-' + masterKey.urlsafe()
+
+
+class BackfillWorker(webapp2.RequestHandler):
+    """Re-analyses the next MASTERS_PER_TASK TestMasters of a shard with the
+    batch analyser, saves the shard's new position and queues the next
+    link of its chain. Each TestMaster is analysed as a named batch, so a
+    retried link counts none of its Vectors twice. A task whose position
+    is behind the shard's, a retry of a link already done, only queues the
+    next link again, in case the retry is because that add failed."""
+    def get(self):
+        shardKey = ndb.Key(urlsafe=self.request.get('shardKey'))
+        shard = shardKey.get()
+        position = int(self.request.get('position'))
+        if shard is None or shard.position < position:
+            return
+
+        status = shard.status.get()
+        campaignKey = getCampaignKey(status.campaignName)
+
+        if shard.position == position and not shard.complete:
+            listMasterKeys = shard.masterKeys[position:position + MASTERS_PER_TASK]
+            listMasters = ndb.get_multi(listMasterKeys)
+            listFutures = [TestEndpoint.query(ancestor=masterKey).fetch_async() for masterKey in listMasterKeys]
+
+            countTestMasters = 0
+            countTestEndpoints = 0
+            countSuccessful = 0
+            for masterKey, testMaster, future in zip(listMasterKeys, listMasters, listFutures):
+                listTestEndpoints = future.get_result()
+                if testMaster is None or not listTestEndpoints:
+                    continue
+
+                listOutcomes = analyseTestMaster(status.campaignName, campaignKey, testMaster, listTestEndpoints, getBatchName(shard, masterKey))
+                countTestMasters += 1
+                countTestEndpoints += len(listOutcomes)
+                countSuccessful += listOutcomes.count(AnalysisEnum.SUCCESSFUL)
+
+            def txn():
+                shard = shardKey.get()
+                if shard.position == position:
+                    shard.countTestMasters += countTestMasters
+                    shard.countTestEndpoints += countTestEndpoints
+                    shard.countSuccessful += countSuccessful
+                    shard.position = position + len(listMasterKeys)
+                    if shard.position >= len(shard.masterKeys):
+                        shard.complete = True
+                        shard.finished = datetime.utcnow()
+                    shard.put()
+                return shard
+
+            shard = ndb.transaction(txn)
+
+        if not shard.complete:
+            addBackfillTask('/backfillworker', getWorkerTaskName(shard, shard.position),
+                            {'shardKey': shard.key.urlsafe(), 'position': shard.position})
+        elif all(otherShard.complete for otherShard in getShards(status)):
+            status.state = 'complete'
+            status.put()
+
+
+# WSGI app
+# Handles incoming requests according to supplied URL.
+app = webapp2.WSGIApplication([
+    ('/backfill', Backfill),
+    ('/backfillprepare', BackfillPrepare),
+    ('/backfillworker', BackfillWorker)
+], debug=True)
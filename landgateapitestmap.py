@@ -57,9 +57,9 @@ class MapPlotter(webapp2.RequestHandler):
                                 e.message + '\n\n')
         else:
             try:
-                listVectors = Vector.query(ancestor=campaignKey, projection=[Vector.preTestLocation.location, Vector.referenceCheckSuccess, Vector.onDeviceSuccess, Vector.referenceCheckValid]).fetch()
+                listVectors = Vector.query(ancestor=campaignKey, projection=[Vector.location, Vector.referenceCheckSuccess, Vector.onDeviceSuccess, Vector.referenceCheckValid]).fetch()
 
-                listAll = [(vector.preTestLocation.location.lat, vector.preTestLocation.location.lon, vector.referenceCheckSuccess, vector.onDeviceSuccess, vector.referenceCheckValid) for vector in listVectors]
+                listAll = [(vector.location.lat, vector.location.lon, vector.referenceCheckSuccess, vector.onDeviceSuccess, vector.referenceCheckValid) for vector in listVectors]
 
                 listFiltered = [vector for vector in listAll if vector[4]]
 
@@ -103,8 +103,8 @@ class StaticMapPlotter(webapp2.RequestHandler):
                                 e.message + '\n\n')
         else:
             try:
-                listVectors = Vector.query(ancestor=campaignKey, projection=[Vector.preTestLocation.location]).fetch()
-                listLatsAndLongs = [[vector.preTestLocation.location.lat, vector.preTestLocation.location.lon, 1.0] for vector in listVectors]
+                listVectors = Vector.query(ancestor=campaignKey, projection=[Vector.location]).fetch()
+                listLatsAndLongs = [[vector.location.lat, vector.location.lon, 1.0] for vector in listVectors]
 
                 outString = PRETEXT + str(listLatsAndLongs) + POSTTEXT
 
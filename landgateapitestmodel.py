@@ -1,8 +1,82 @@
 
+# Standard python libraries.
+import bz2
+import hashlib
+import zlib
+
 # Google's appengine python libraries.
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import polymodel
 
+COMPRESSION_THRESHOLD = 1024  # bytes, shorter values are stored uncompressed.
+DEFAULT_CODEC = 'zlib'
+
+# Every value a CompressedTextProperty stores starts with HEADER then a
+# marker byte naming the codec, RAW_MARKER meaning not compressed.
+HEADER = '\x00'
+RAW_MARKER = 'r'
+CODECS = {
+    'zlib': ('z', zlib.compress, zlib.decompress),
+    'bz2': ('b', bz2.compress, bz2.decompress),
+}
+
+
+def digestResponse(responseData):
+    """Returns the hex SHA-1 digest of a response body's UTF-8 bytes,
+    the key name under which the body is kept in the ResponseBlob store."""
+    if isinstance(responseData, unicode):
+        responseData = responseData.encode('utf-8')
+    return hashlib.sha1(responseData).hexdigest()
+
+
+class CompressedTextProperty(ndb.BlobProperty):
+    """A replacement for TextProperty that compresses values of threshold
+    bytes or more with the named codec, 'zlib' or 'bz2'.
+    Values written by a plain TextProperty never begin with a NUL byte, so
+    they are told apart from our HEADER and read back unchanged.
+    ndb only converts a value from its stored form when the property is
+    first read, so reads that never touch the body never decompress it."""
+    _attributes = ndb.BlobProperty._attributes + ['_threshold', '_codec']
+
+    def __init__(self, name=None, threshold=COMPRESSION_THRESHOLD, codec=DEFAULT_CODEC, **kwds):
+        if codec not in CODECS:
+            raise ValueError('Unknown compression codec ' + repr(codec))
+        super(CompressedTextProperty, self).__init__(name=name, **kwds)
+        self._threshold = threshold
+        self._codec = codec
+
+    def _validate(self, value):
+        if not isinstance(value, basestring):
+            raise datastore_errors.BadValueError('Expected string, got %r' % (value,))
+
+    def _to_base_type(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        if len(value) >= self._threshold:
+            marker, compress, decompress = CODECS[self._codec]
+            compressed = compress(value)
+            if len(compressed) < len(value):
+                return HEADER + marker + compressed
+
+        return HEADER + RAW_MARKER + value
+
+    def _from_base_type(self, value):
+        if value.startswith(HEADER) and len(value) > 1:
+            marker = value[1]
+            value = value[2:]
+            for codecMarker, compress, decompress in CODECS.values():
+                if marker == codecMarker:
+                    value = decompress(value)
+                    break
+
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+
+
 # Model classes
 
 class TestCampaign(ndb.Model):
@@ -46,10 +120,32 @@ class TestEndpoint(ResultObject):
     httpMethod = ndb.StringProperty()
     testedURL = ndb.StringProperty()
     responseCode = ndb.IntegerProperty()
-    responseData = ndb.TextProperty()
+    responseData = CompressedTextProperty()
+    responseDigest = ndb.StringProperty()
     errorResponse = ndb.StringProperty()
     analysed = ndb.IntegerProperty()
 
+    def getResponseData(self):
+        """Returns the response body.
+        Newer TestEndpoints hold only the digest of their body, which is
+        fetched from the ResponseBlob store on first access. Older ones
+        still carry the body in responseData."""
+        if self.responseDigest is None:
+            return self.responseData
+
+        blob = ndb.Key(ResponseBlob, self.responseDigest).get()
+        if blob is None:
+            return None
+        return blob.data
+
+
+class ResponseBlob(ndb.Model):
+    """A content addressed store of response bodies. Each unique body is
+    stored once, keyed by its digestResponse() value, however many
+    TestEndpoints received it. Map tiles and capabilities documents come
+    back byte identical thousands of times."""
+    data = CompressedTextProperty()
+
 """Previously we needed separate subclasses of each TestEndpoint response
 type as their responseData were stored in different properties
 (JsonProperty(), ImageProperty() and StringProperty()).
@@ -108,7 +204,22 @@ class ReferenceObject(ndb.Model):
     name = ndb.StringProperty()
     httpMethod  = ndb.StringProperty()
     returnType = ndb.StringProperty()
-    reference = ndb.TextProperty()
+    reference = CompressedTextProperty()
+    referenceDigest = ndb.StringProperty()
+
+    # The reference as normaliseResponse() leaves it, and its digest,
+    # computed once when stored rather than on every analysis. The
+    # normalised copy is None where it would repeat reference, and for
+    # Image references, to keep the entity within the 1 MB limit.
+    normalisedReference = CompressedTextProperty()
+    normalisedDigest = ndb.StringProperty()
+
+    # The imageFingerprint() of image references, a hex string.
+    fingerprint = ndb.StringProperty()
+
+    # The buildFeatureIndex() of JSON and GML references, featureID to
+    # attribute digest.
+    featureIndex = ndb.JsonProperty(compressed=True)
 
 
 class Vector(ndb.Model):
@@ -121,8 +232,11 @@ class Vector(ndb.Model):
     N.B. We should prefer to show improvement in signal or response time
     with positive numeric values and degradation with negative values.
     Hence subtracting the later pingTime from the prior, but conversely
-    subtracting the prior networkClass from the later."""
-    test = ndb.StructuredProperty(TestEndpoint)
+    subtracting the prior networkClass from the later.
+    The TestEndpoint and its six supporting tests are referred to by key
+    rather than copied in, only the values charted and mapped are kept,
+    so a Vector is a few hundred bytes whatever the size of the response."""
+    testKey = ndb.KeyProperty(indexed=False)
 
     name = ndb.StringProperty()
     startDateTime = ndb.DateTimeProperty()
@@ -140,12 +254,20 @@ class Vector(ndb.Model):
     referenceCheckSuccess = ndb.BooleanProperty()
     referenceCheckValid = ndb.BooleanProperty(default=True)
 
-    preTestLocation = ndb.StructuredProperty(LocationResult)
-    postTestLocation = ndb.StructuredProperty(LocationResult)
-    preTestNetwork = ndb.StructuredProperty(NetworkResult)
-    postTestNetwork = ndb.StructuredProperty(NetworkResult)
-    preTestPing = ndb.StructuredProperty(PingResult)
-    postTestPing = ndb.StructuredProperty(PingResult)
+    # Features of the response found unchanged in the reference, and not,
+    # for responses compared feature by feature.
+    referenceMatchedFeatures = ndb.IntegerProperty()
+    referenceMissingFeatures = ndb.IntegerProperty()
+
+    preTestLocationKey = ndb.KeyProperty(indexed=False)
+    postTestLocationKey = ndb.KeyProperty(indexed=False)
+    preTestNetworkKey = ndb.KeyProperty(indexed=False)
+    postTestNetworkKey = ndb.KeyProperty(indexed=False)
+    preTestPingKey = ndb.KeyProperty(indexed=False)
+    postTestPingKey = ndb.KeyProperty(indexed=False)
+
+    # The preTestLocation's location, where the test is mapped.
+    location = ndb.GeoPtProperty()
 
     distance = ndb.FloatProperty()
     speed = ndb.FloatProperty()
@@ -279,3 +401,116 @@ class CampaignStats(ndb.Model):
     OGC_BusStops_Small_POST_XML_ReferenceSuccess = ndb.IntegerProperty()
     OGC_Topo_Big_GET_Image_ReferenceSuccess = ndb.IntegerProperty()
     OGC_Topo_Small_GET_Image_ReferenceSuccess = ndb.IntegerProperty()
+
+
+class UploadSession(ndb.Model):
+    """A resumable upload of a large campaign dump, sent as chunkCount
+    numbered chunks of TestMasters and then committed. A child of the
+    campaign's TestCampaign key."""
+    campaignName = ndb.StringProperty()
+    chunkCount = ndb.IntegerProperty()
+    analyseBy = ndb.StringProperty()
+    committed = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class UploadChunk(ndb.Model):
+    """Marks one chunk of an UploadSession as durable. Keyed by the chunk
+    number under its session and written in the same transaction as the
+    chunk's CampaignStats update, once all of its entities are stored.
+    analysisTargets holds a [masterKey, listEndpointIDs] pair for each
+    TestMaster in the chunk, queued for analysis on commit."""
+    analysisTargets = ndb.JsonProperty()
+
+
+class UploadChunkClaim(ndb.Model):
+    """Claims one chunk of an UploadSession for the request storing it, so
+    an overlapping retry of the chunk is turned away. Keyed by the chunk
+    number under its session, like UploadChunk. token names the claiming
+    request, and a claim made over CHUNK_CLAIM_SECONDS ago is abandoned."""
+    token = ndb.StringProperty(indexed=False)
+    claimed = ndb.DateTimeProperty(indexed=False)
+
+
+class CampaignStatsShard(CampaignStats):
+    """One of several shards of a campaign's CampaignStats, each a root
+    entity keyed '<campaignName>-<shard>'. Uploads and analyses add their
+    counts to a random shard in a transaction, reads sum every shard."""
+    pass
+
+
+class BackfillStatus(ndb.Model):
+    """A re-analysis of every TestMaster in a campaign, split into
+    BackfillShards run in parallel. A root entity, so neither it nor its
+    shards share the campaign's entity group with uploads and analyses.
+    state is 'preparing', 'starting', 'running' or 'complete'."""
+    campaignName = ndb.StringProperty()
+    state = ndb.StringProperty()
+    shardCount = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    started = ndb.DateTimeProperty()
+
+
+class BackfillShard(ndb.Model):
+    """A contiguous range of a campaign's TestMaster keys, in key order,
+    re-analysed by a chain of tasks. position is the resume point, the
+    index in masterKeys of the next TestMaster to analyse. A root entity
+    named '<status id>-<n>', n from 1, updated only by its own chain so
+    never contended. status is the key of its BackfillStatus."""
+    status = ndb.KeyProperty(indexed=False)
+    masterKeys = ndb.KeyProperty(repeated=True, indexed=False)
+    position = ndb.IntegerProperty(default=0)
+    countTestMasters = ndb.IntegerProperty(default=0)
+    countTestEndpoints = ndb.IntegerProperty(default=0)
+    countSuccessful = ndb.IntegerProperty(default=0)
+    complete = ndb.BooleanProperty(default=False)
+    finished = ndb.DateTimeProperty()
+
+
+class VectorSnapshotSegment(ndb.Model):
+    """A run of a campaign's Vectors as columns, the charted values only,
+    for the graphs to read in place of querying every Vector. A child of
+    the campaign's key. columns holds each column of SNAPSHOT_LAYOUT's
+    little endian numpy arrays, count values long, back to back.
+    Category columns are codes into the segment's own vocabularies.
+    Rows of a Vector analysed again reappear in a later segment, by
+    created, which supersedes the earlier row of the same vectorID."""
+    created = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(indexed=False)
+    vectorIDs = ndb.JsonProperty(compressed=True)
+    vocabularies = ndb.JsonProperty(compressed=True)
+    columns = ndb.BlobProperty(compressed=True)
+
+
+class SnapshotRebuild(ndb.Model):
+    """A rebuild of a campaign's snapshot and Vector aggregates from its
+    Vectors, by a chain of tasks each reading one page. page is the number
+    of the next page to read and cursor where it starts, None for the
+    first. A child of the campaign's key, updated only by its own chain."""
+    page = ndb.IntegerProperty(default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    complete = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class VectorCountShard(ndb.Model):
+    """One of several shards of a campaign's Vector aggregates, each a root
+    entity keyed '<campaignName>-<shard>'. counts maps each dimension, a
+    Vector property drawn as a pie chart, to the number of valid Vectors
+    with each value, the values JSON encoded. sketches maps each series of
+    the box plots, such as the responseTime of successful tests by server,
+    to its sketchBucket() counts, and regressions each series of the
+    scatter charts to its regressionSums(). Each batch of analysed Vectors
+    is added to a random shard in one transaction, reads sum every shard."""
+    counts = ndb.JsonProperty(compressed=True)
+    sketches = ndb.JsonProperty(compressed=True)
+    regressions = ndb.JsonProperty(compressed=True)
+
+
+class AggregateBatch(ndb.Model):
+    """Marks one named batch of Vectors as added to its campaign's stats
+    and Vector aggregates, a root entity keyed '<campaignName>|<batch>'.
+    Written in the same transaction as the batch's counts, so a retried
+    batch finds it and adds nothing twice. Purged by created once no retry
+    can still be pending."""
+    created = ndb.DateTimeProperty(auto_now_add=True)
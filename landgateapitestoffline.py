@@ -0,0 +1,264 @@
+""" LandgateAPITest Web App
+
+Offline analysis module
+
+Created by Aiden Price,
+Curtin University Masters of Geospatial Science candidate,
+Submitted June 2016"""
+
+# Standard python libraries.
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple
+from operator import itemgetter
+
+# Local analysis imports
+from landgateapitestparser import iterJsonUpload
+from landgateapitestanalysis import TimeSeries
+from landgateapitestanalysis import measureChanges
+from landgateapitestanalysis import prepareReference
+from landgateapitestanalysis import checkPreparedReference
+
+# Constants and helper classes and functions
+
+"""Runs the Analyse() logic over a campaign exported to a local file,
+either an upload document or the output of Database.get(), both a JSON
+object with campaignName and a TestMasters list, or NDJSON with one
+TestMaster per line. The TestMasters are shared out across a process
+pool and their Vectors written as NDJSON, no datastore required.
+    python landgateapitestoffline.py campaign.json vectors.ndjson"""
+
+CHUNK_SIZE = 4  # TestMasters handed to a pool process at a time.
+
+Location = namedtuple('Location', ['lat', 'lon'])
+
+# Upload documents and Database.get() name a TestMaster's lists differently.
+LIST_KEYS = {'endpoints': ('endpointResults', 'TestEndpoints'),
+             'networks': ('networkResults', 'NetworkResults'),
+             'locations': ('locationResults', 'LocationResults'),
+             'pings': ('pingResults', 'PingResults')}
+
+# The prepared references of a pool process, set by initialiseWorker().
+REFERENCES = {}
+
+
+def digestText(text):
+    """Returns the hex SHA-1 digest of text's UTF-8 bytes, as
+    digestResponse() does."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def loadReferences(referenceFolderPath, referenceImagesPath):
+    """Reads and prepares every reference in the ReferenceObjects folder,
+    as StoreReferencesWorker does, into a dict keyed by (server, dataset,
+    name, httpMethod, returnType)."""
+    dictReferences = {}
+    for root, directories, filenames in os.walk(referenceFolderPath):
+        for filename in filenames:
+            filenameParts = os.path.splitext(filename)
+            if filenameParts[1].lower() != '.txt':
+                continue
+
+            properties = filenameParts[0].split("_")
+            returnType = properties[4]
+            with open(os.path.join(root, filename), 'r') as referenceFile:
+                reference = referenceFile.read()
+
+            imageData = None
+            referenceImagePath = os.path.join(referenceImagesPath, filenameParts[0] + '.png')
+            if returnType == 'Image' and os.path.exists(referenceImagePath):
+                with open(referenceImagePath, 'rb') as referenceImage:
+                    imageData = referenceImage.read()
+
+            dictReference = prepareReference(reference, returnType, imageData)
+            dictReference['referenceDigest'] = digestText(reference)
+            dictReferences[tuple(properties[:5])] = dictReference
+
+    return dictReferences
+
+
+def iterTestMasters(inputPath, inputFormat):
+    """Returns the export's campaignName, or None, and a generator over
+    its TestMasters, streamed rather than decoded in one piece."""
+    inputFile = open(inputPath, 'rb')
+    if inputFormat == 'ndjson':
+        return None, (json.loads(line) for line in inputFile if line.strip())
+
+    dictHeader, elements = iterJsonUpload(inputFile)
+    return dictHeader.get('campaignName'), elements
+
+
+def getList(TM, name):
+    for key in LIST_KEYS[name]:
+        if key in TM:
+            return TM[key] or []
+    return []
+
+
+def getLocation(LR):
+    """Upload documents give a latitude and longitude, Database.get() a
+    location of lat and lon."""
+    if 'location' in LR:
+        return Location(float(LR['location']['lat']), float(LR['location']['lon']))
+    return Location(float(LR.get('latitude')), float(LR.get('longitude')))
+
+
+def getTimeSeries(listResults):
+    """TimeSeries of result dicts, uploads give their datetimes as
+    timestamps and Database.get() as strings of them."""
+    for result in listResults:
+        result['datetime'] = float(result.get('datetime'))
+    return TimeSeries(listResults, key=itemgetter('datetime'))
+
+
+def initialiseWorker(dictReferences):
+    global REFERENCES
+    REFERENCES = dictReferences
+
+
+def analyseMaster(arguments):
+    """Builds the Vector dicts of every TestEndpoint of one TestMaster, as
+    analyseTestMaster() and buildVector() do, finding each endpoint's
+    neighbours by binary search. Returns (countEndpoints, listVectors)."""
+    campaignName, TM = arguments
+    listEndpoints = getList(TM, 'endpoints')
+    locations = getTimeSeries(getList(TM, 'locations'))
+    networks = getTimeSeries(getList(TM, 'networks'))
+    pings = getTimeSeries(getList(TM, 'pings'))
+
+    listVectors = []
+    for TE in listEndpoints:
+        start = float(TE.get('startDatetime'))
+        finish = float(TE.get('finishDatetime'))
+        preTestLocation, postTestLocation = locations.before(start), locations.after(finish)
+        preTestNetwork, postTestNetwork = networks.before(start), networks.after(finish)
+        preTestPing, postTestPing = pings.before(start), pings.after(finish)
+
+        # Without all six supporting tests the analysis is IMPOSSIBLE.
+        if not (preTestLocation and postTestLocation and preTestNetwork and postTestNetwork and preTestPing and postTestPing):
+            continue
+
+        vector = {}
+        vector['campaignName'] = campaignName
+        vector['masterID'] = TM.get('testID')
+        vector['testID'] = TE.get('testID')
+        vector['name'] = TE.get('testName')
+        vector['startDateTime'] = start
+        vector['finishDateTime'] = finish
+        vector['responseTime'] = finish - start
+        vector['server'] = TE.get('server')
+        vector['dataset'] = TE.get('dataset')
+        vector['httpMethod'] = TE.get('httpMethod')
+        vector['returnType'] = TE.get('returnType')
+        vector['responseCode'] = int(TE.get('responseCode'))
+        vector['onDeviceSuccess'] = bool(TE.get('success'))
+        vector['referenceCheckSuccess'] = False
+        vector['referenceMatchedFeatures'] = None
+        vector['referenceMissingFeatures'] = None
+
+        signature = (vector['server'], vector['dataset'], vector['name'], vector['httpMethod'], vector['returnType'])
+        reference = REFERENCES.get(signature)
+        responseData = TE.get('responseData') or ''
+        if reference is not None and responseData and digestText(responseData) == reference['referenceDigest']:
+            vector['referenceCheckSuccess'] = True
+            if reference['featureIndex'] is not None:
+                vector['referenceMatchedFeatures'] = len(reference['featureIndex'])
+                vector['referenceMissingFeatures'] = 0
+        elif reference is not None:
+            success, matched, missing = checkPreparedReference(responseData, vector['returnType'], reference['normalisedReference'],
+                                                               reference['normalisedDigest'], reference['fingerprint'], reference['featureIndex'])
+            vector['referenceCheckSuccess'] = success
+            vector['referenceMatchedFeatures'] = matched
+            vector['referenceMissingFeatures'] = missing
+
+        vector['deviceType'] = TM.get('deviceType')
+        vector['deviceID'] = TM.get('deviceID')
+        vector['iOSVersion'] = TM.get('iOSVersion')
+
+        vector['preTestLocationID'] = preTestLocation.get('testID')
+        vector['postTestLocationID'] = postTestLocation.get('testID')
+        vector['preTestNetworkID'] = preTestNetwork.get('testID')
+        vector['postTestNetworkID'] = postTestNetwork.get('testID')
+        vector['preTestPingID'] = preTestPing.get('testID')
+        vector['postTestPingID'] = postTestPing.get('testID')
+
+        location1 = getLocation(preTestLocation)
+        vector['location'] = {'lat': location1.lat, 'lon': location1.lon}
+
+        vector['distance'], vector['speed'], vector['pingChange'], vector['networkChange'] = measureChanges(
+            location1, getLocation(postTestLocation),
+            postTestLocation['datetime'] - preTestLocation['datetime'],
+            float(preTestPing.get('pingTime')), float(postTestPing.get('pingTime')),
+            preTestNetwork.get('connectionType'), postTestNetwork.get('connectionType'))
+
+        listVectors.append(vector)
+
+    return len(listEndpoints), listVectors
+
+
+def parseArguments(listArguments=None):
+    appPath = os.path.split(os.path.abspath(__file__))[0]
+    parser = argparse.ArgumentParser(description='Analyses an exported campaign into Vectors without the datastore.')
+    parser.add_argument('input', help='campaign export, a JSON document or NDJSON of TestMasters')
+    parser.add_argument('output', help='file to write the Vectors to, as NDJSON')
+    parser.add_argument('--format', choices=['json', 'ndjson'], help='input format, by default from its extension')
+    parser.add_argument('--campaignName', help='campaign name for exports that do not carry one')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='pool size, by default every core')
+    parser.add_argument('--references', default=os.path.join(appPath, 'ReferenceObjects'), help='ReferenceObjects folder')
+    parser.add_argument('--referenceImages', default=os.path.join(appPath, 'ReferenceImages'), help='ReferenceImages folder')
+    return parser.parse_args(listArguments)
+
+
+def main(listArguments=None):
+    arguments = parseArguments(listArguments)
+    inputFormat = arguments.format
+    if inputFormat is None:
+        inputFormat = 'ndjson' if os.path.splitext(arguments.input)[1].lower() in ('.ndjson', '.jsonl') else 'json'
+
+    startTime = time.time()
+    dictReferences = loadReferences(arguments.references, arguments.referenceImages)
+    referenceSeconds = time.time() - startTime
+
+    campaignName, elements = iterTestMasters(arguments.input, inputFormat)
+    campaignName = arguments.campaignName or campaignName
+
+    countMasters = 0
+    countEndpoints = 0
+    countVectors = 0
+    countSuccessful = 0
+
+    pool = multiprocessing.Pool(arguments.processes, initialiseWorker, (dictReferences,))
+    try:
+        with open(arguments.output, 'w') as outputFile:
+            work = ((TM.get('campaignName', campaignName), TM) for TM in elements)
+            for endpoints, listVectors in pool.imap_unordered(analyseMaster, work, CHUNK_SIZE):
+                countMasters += 1
+                countEndpoints += endpoints
+                for vector in listVectors:
+                    outputFile.write(json.dumps(vector) + '\n')
+                    countVectors += 1
+                    countSuccessful += vector['referenceCheckSuccess']
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    seconds = time.time() - startTime
+    sys.stderr.write('Prepared %d references in %.2f s.\n' % (len(dictReferences), referenceSeconds))
+    sys.stderr.write('Analysed %d TestMasters, %d TestEndpoints, into %d Vectors (%d reference checks passed) '
+                     'in %.2f s on %d processes, %.1f TestEndpoints/s.\n'
+                     % (countMasters, countEndpoints, countVectors, countSuccessful,
+                        seconds, arguments.processes, countEndpoints / max(seconds, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+""" LandgateAPITest Web App
+
+Upload parsing module
+
+Created by Aiden Price,
+Curtin University Masters of Geospatial Science candidate,
+Submitted June 2016"""
+
+# Standard python libraries.
+import json
+import struct
+import zlib
+
+# Constants and helper classes and functions
+
+CHUNK_SIZE = 64 * 1024  # bytes read from the request body at a time.
+
+WHITESPACE = ' \t\n\r'
+
+NUMBER_START = '-0123456789'
+
+# Characters that may continue a number, one followed by any of them may
+# have been cut short at the end of a read.
+NUMBER_CHARACTERS = '0123456789.eE+-'
+
+MSGPACK_CONTENT_TYPES = ('application/x-msgpack', 'application/msgpack', 'application/vnd.msgpack')
+
+# Content-Encodings we inflate on the fly, identity needing nothing.
+CONTENT_ENCODINGS = ('gzip', 'x-gzip', 'deflate', 'identity')
+
+# struct formats for the MessagePack type codes followed by a length
+# or holding a fixed size number.
+MSGPACK_BIN_LENGTHS = {0xc4: '>B', 0xc5: '>H', 0xc6: '>I'}
+MSGPACK_STR_LENGTHS = {0xd9: '>B', 0xda: '>H', 0xdb: '>I'}
+MSGPACK_NUMBERS = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+
+
+class JsonStreamReader(object):
+    """Reads JSON values one at a time from a file like object.
+    Only the unconsumed tail of the document is held in memory, so the
+    size of the buffer depends on the largest single value decoded rather
+    than on the size of the whole upload."""
+    def __init__(self, fileObj, chunkSize=CHUNK_SIZE):
+        self.fileObj = fileObj
+        self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder(strict=False)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read(self, size):
+        """Appends up to size bytes to the buffer, discarding the part of
+        the buffer that has already been consumed."""
+        if self.position:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        data = self.fileObj.read(size)
+        if data:
+            self.buffer += data
+        else:
+            self.eof = True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it,
+        or None at the end of the document."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if self.eof:
+                return None
+
+            self._read(self.chunkSize)
+
+    def expect(self, character):
+        """Consumes the next non-whitespace character, which must be the
+        one supplied."""
+        found = self.peek()
+        if found != character:
+            raise ValueError('Expected ' + repr(character) + ' but found ' +
+                             repr(found) + ' in uploaded JSON.')
+        self.position += 1
+
+    def decodeValue(self):
+        """Decodes and consumes the next complete JSON value.
+        A number ending at the end of the buffer, or followed by a number
+        character such as the '.' or 'e' of a number cut short by the end
+        of a read, may be truncated, so we read on until it is followed
+        by something else or by the end of the document.
+        Each failed attempt doubles the read size, keeping the total
+        decoding work linear in the size of the value."""
+        isNumber = self.peek() in NUMBER_START
+        readSize = self.chunkSize
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                if not isNumber or self.eof or (end < len(self.buffer) and self.buffer[end] not in NUMBER_CHARACTERS):
+                    self.position = end
+                    return value
+
+            self._read(readSize)
+            readSize = max(readSize, len(self.buffer))
+
+    def iterObject(self):
+        """Yields the (key, reader) pairs of a JSON object.
+        The caller must consume each member's value from the reader, either
+        with decodeValue() or iterArray(), before asking for the next key."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+
+        while True:
+            key = self.decodeValue()
+            self.expect(':')
+            yield key, self
+
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect('}')
+                return
+
+    def iterArray(self):
+        """Yields the decoded elements of a JSON array one at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+
+        while True:
+            yield self.decodeValue()
+
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect(']')
+                return
+
+
+class MsgPackStreamReader(object):
+    """Reads MessagePack values one at a time from a file like object,
+    with the same interface as JsonStreamReader.
+    MessagePack strings decode to unicode, while bin values decode to
+    bytearrays so callers can tell raw image bytes from text."""
+    def __init__(self, fileObj, chunkSize=CHUNK_SIZE):
+        self.fileObj = fileObj
+        self.chunkSize = chunkSize
+        self.buffer = ''
+        self.position = 0
+
+    def _take(self, size):
+        """Consumes and returns exactly size bytes."""
+        while len(self.buffer) - self.position < size:
+            data = self.fileObj.read(max(self.chunkSize, size))
+            if not data:
+                raise ValueError('Truncated MessagePack upload.')
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+
+        data = self.buffer[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def _unpack(self, format):
+        return struct.unpack(format, self._take(struct.calcsize(format)))[0]
+
+    def _readLength(self, code, fixBase, fixMask, code16, code32):
+        """Returns the length of a map or array from its type code."""
+        if fixBase <= code <= fixBase + fixMask:
+            return code & fixMask
+        elif code == code16:
+            return self._unpack('>H')
+        elif code == code32:
+            return self._unpack('>I')
+        raise ValueError('Unexpected MessagePack type 0x%02x in upload.' % code)
+
+    def decodeValue(self):
+        """Decodes and consumes the next complete MessagePack value."""
+        code = ord(self._take(1))
+
+        if code <= 0x7f:
+            return code
+        elif code >= 0xe0:
+            return code - 0x100
+        elif code <= 0x8f:
+            return self._decodeMap(code & 0x0f)
+        elif code <= 0x9f:
+            return self._decodeArray(code & 0x0f)
+        elif code <= 0xbf:
+            return self._take(code & 0x1f).decode('utf-8')
+        elif code == 0xc0:
+            return None
+        elif code == 0xc2:
+            return False
+        elif code == 0xc3:
+            return True
+        elif code in MSGPACK_BIN_LENGTHS:
+            return bytearray(self._take(self._unpack(MSGPACK_BIN_LENGTHS[code])))
+        elif code in MSGPACK_STR_LENGTHS:
+            return self._take(self._unpack(MSGPACK_STR_LENGTHS[code])).decode('utf-8')
+        elif code in MSGPACK_NUMBERS:
+            return self._unpack(MSGPACK_NUMBERS[code])
+        elif code == 0xdc:
+            return self._decodeArray(self._unpack('>H'))
+        elif code == 0xdd:
+            return self._decodeArray(self._unpack('>I'))
+        elif code == 0xde:
+            return self._decodeMap(self._unpack('>H'))
+        elif code == 0xdf:
+            return self._decodeMap(self._unpack('>I'))
+        raise ValueError('Unsupported MessagePack type 0x%02x in upload.' % code)
+
+    def _decodeKey(self):
+        """Decodes a map key, bin keys become plain strings so they hash."""
+        key = self.decodeValue()
+        if isinstance(key, bytearray):
+            key = str(key)
+        return key
+
+    def _decodeMap(self, length):
+        dictValue = {}
+        for index in xrange(length):
+            key = self._decodeKey()
+            dictValue[key] = self.decodeValue()
+        return dictValue
+
+    def _decodeArray(self, length):
+        return [self.decodeValue() for index in xrange(length)]
+
+    def iterObject(self):
+        """Yields the (key, reader) pairs of a map, see
+        JsonStreamReader.iterObject()."""
+        length = self._readLength(ord(self._take(1)), 0x80, 0x0f, 0xde, 0xdf)
+        for index in xrange(length):
+            yield self._decodeKey(), self
+
+    def iterArray(self):
+        """Yields the decoded elements of an array one at a time."""
+        length = self._readLength(ord(self._take(1)), 0x90, 0x0f, 0xdc, 0xdd)
+        for index in xrange(length):
+            yield self.decodeValue()
+
+
+class DecompressingReader(object):
+    """A file like wrapper that inflates a gzip or deflate encoded body as
+    it is read, so the parsers never see, nor hold, the whole inflated
+    upload at once. HTTP deflate is meant to be zlib wrapped but some
+    clients send raw deflate streams, so we check the header first."""
+    def __init__(self, fileObj, contentEncoding, chunkSize=CHUNK_SIZE):
+        self.fileObj = fileObj
+        self.contentEncoding = contentEncoding
+        self.chunkSize = chunkSize
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        """Rewinds to the start of the body, the only seek supported."""
+        if offset != 0 or whence != 0:
+            raise IOError('DecompressingReader can only rewind to the start.')
+
+        self.fileObj.seek(0)
+        self.decompressor = None
+        self.pending = ''
+        self.buffer = ''
+        self.eof = False
+
+    def _createDecompressor(self, header):
+        if self.contentEncoding in ('gzip', 'x-gzip'):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # A zlib header is a multiple of 31 with the deflate method in the
+        # low nibble of its first byte.
+        if len(header) >= 2 and ord(header[0]) & 0x0f == 8 and (ord(header[0]) * 256 + ord(header[1])) % 31 == 0:
+            return zlib.decompressobj(zlib.MAX_WBITS)
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        """Returns up to size inflated bytes, or all that remain if size
+        is negative. Never inflates much more than was asked for."""
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            if not self.pending:
+                self.pending = self.fileObj.read(self.chunkSize)
+                if not self.pending:
+                    if self.decompressor is not None:
+                        self.buffer += self.decompressor.flush()
+                    self.eof = True
+                    break
+
+            if self.decompressor is None:
+                # A short first read can split the two byte zlib header.
+                while len(self.pending) < 2:
+                    data = self.fileObj.read(self.chunkSize)
+                    if not data:
+                        break
+                    self.pending += data
+                self.decompressor = self._createDecompressor(self.pending)
+
+            maxLength = 0 if size < 0 else size - len(self.buffer)
+            self.buffer += self.decompressor.decompress(self.pending, maxLength)
+            self.pending = self.decompressor.unconsumed_tail
+
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def iterUpload(fileObj, contentType=None, contentEncoding=None, listKey='TestMasters'):
+    """Chooses the reader for an upload's Content-Type, MessagePack for
+    the binary types in MSGPACK_CONTENT_TYPES and JSON otherwise, and
+    walks the document as described in iterJsonUpload().
+    Bodies with a gzip or deflate Content-Encoding are inflated as a
+    stream on their way into the reader."""
+    encoding = (contentEncoding or 'identity').strip().lower()
+    if encoding not in CONTENT_ENCODINGS:
+        raise ValueError('Unsupported Content-Encoding ' + encoding + '.')
+    if encoding != 'identity':
+        fileObj = DecompressingReader(fileObj, encoding)
+
+    mediaType = (contentType or '').split(';')[0].strip().lower()
+    if mediaType in MSGPACK_CONTENT_TYPES:
+        return _iterUpload(fileObj, MsgPackStreamReader, listKey)
+    return _iterUpload(fileObj, JsonStreamReader, listKey)
+
+
+def iterJsonUpload(fileObj, listKey='TestMasters'):
+    """Walks an uploaded results document returning a dict of its
+    top level members, except listKey, along with a generator over the
+    elements of listKey.
+    Devices do not guarantee member order, so if listKey comes before
+    the other members (i.e. campaignName) the array is skipped one element
+    at a time to read them and the file is rewound to stream it again."""
+    return _iterUpload(fileObj, JsonStreamReader, listKey)
+
+
+def _iterUpload(fileObj, readerClass, listKey):
+    reader = readerClass(fileObj)
+    dictHeader = {}
+    members = reader.iterObject()
+
+    for key, value in members:
+        if key != listKey:
+            dictHeader[key] = value.decodeValue()
+            continue
+
+        if 'campaignName' in dictHeader:
+            # Every other member left is read lazily, after the list.
+            return dictHeader, _iterRemainder(reader.iterArray(), members, dictHeader)
+
+        for element in reader.iterArray():
+            pass
+
+        for key, value in members:
+            dictHeader[key] = value.decodeValue()
+
+        fileObj.seek(0)
+        return dictHeader, _iterListOnly(readerClass(fileObj), listKey)
+
+    return dictHeader, iter([])
+
+
+def _iterRemainder(elements, members, dictHeader):
+    """Yields the elements and then drains the rest of the document
+    into dictHeader so malformed trailing JSON still raises."""
+    for element in elements:
+        yield element
+
+    for key, value in members:
+        dictHeader[key] = value.decodeValue()
+
+
+def _iterListOnly(reader, listKey):
+    """Yields the elements of listKey on a second pass over the document,
+    skipping over every other member."""
+    for key, value in reader.iterObject():
+        if key == listKey:
+            for element in value.iterArray():
+                yield element
+        else:
+            value.decodeValue()
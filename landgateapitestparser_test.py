@@ -0,0 +1,103 @@
+import cStringIO
+import gzip
+import json
+import unittest
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from landgateapitestparser import iterUpload
+
+
+DOCUMENT = {
+    'campaignName': u'Trickle',
+    'testDevice': {'deviceID': 'device-1', 'batteryLevel': 0.5},
+    'TestMasters': [
+        {'testID': 123456789, 'latitude': -31.95, 'longitude': 115.86, 'altitude': 1.25e10},
+        {'testID': -7, 'latitude': -1.5e-3, 'longitude': 1e-07, 'altitude': 0},
+        {'testID': 42, 'TestEndpoints': [{'responseTime': 12.5, 'responseData': u'caf\xe9 "quoted"'}]},
+    ],
+    'timestamp': 1234.5,
+}
+
+
+class TrickleFile(object):
+    """Returns at most size bytes from each read, so values end up split
+    across reads at every possible offset."""
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        self.position = offset
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size:
+            size = self.size
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+def jsonBody(listFirst):
+    """Serialises DOCUMENT with TestMasters either first or last."""
+    listKeys = sorted(DOCUMENT, key=lambda key: (key == 'TestMasters') != listFirst)
+    return '{' + ', '.join(json.dumps(key) + ': ' + json.dumps(DOCUMENT[key]) for key in listKeys) + '}'
+
+
+def gzipBody(data):
+    fileObj = cStringIO.StringIO()
+    gzipFile = gzip.GzipFile(fileobj=fileObj, mode='wb')
+    gzipFile.write(data)
+    gzipFile.close()
+    return fileObj.getvalue()
+
+
+def rawDeflateBody(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class IterUploadTest(unittest.TestCase):
+    def assertParses(self, body, contentType=None, contentEncoding=None):
+        for size in range(1, len(body) + 1):
+            dictHeader, testMasters = iterUpload(TrickleFile(body, size), contentType, contentEncoding)
+            listTestMasters = list(testMasters)
+            self.assertEqual(listTestMasters, DOCUMENT['TestMasters'], 'read size %d' % size)
+            self.assertEqual(dictHeader, dict((key, value) for key, value in DOCUMENT.items() if key != 'TestMasters'), 'read size %d' % size)
+
+    def testJson(self):
+        for listFirst in (False, True):
+            self.assertParses(jsonBody(listFirst))
+
+    def testGzip(self):
+        for listFirst in (False, True):
+            self.assertParses(gzipBody(jsonBody(listFirst)), contentEncoding='gzip')
+
+    def testDeflate(self):
+        for listFirst in (False, True):
+            self.assertParses(zlib.compress(jsonBody(listFirst)), contentEncoding='deflate')
+            self.assertParses(rawDeflateBody(jsonBody(listFirst)), contentEncoding='deflate')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def testMsgPack(self):
+        self.assertParses(msgpack.packb(DOCUMENT, use_bin_type=True), 'application/x-msgpack')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def testMsgPackBin(self):
+        document = {'campaignName': u'Trickle', 'TestMasters': [{'responseData': bytearray('\x89PNG\r\n\x00\xff')}]}
+        body = msgpack.packb(document, use_bin_type=True)
+        for size in range(1, len(body) + 1):
+            dictHeader, testMasters = iterUpload(TrickleFile(body, size), 'application/msgpack')
+            listTestMasters = list(testMasters)
+            self.assertEqual(dictHeader, {'campaignName': u'Trickle'})
+            self.assertEqual(listTestMasters[0]['responseData'], bytearray('\x89PNG\r\n\x00\xff'))
+            self.assertIsInstance(listTestMasters[0]['responseData'], bytearray)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,626 @@
+""" LandgateAPITest Web App
+
+Vector snapshot module
+
+Created by Aiden Price,
+Curtin University Masters of Geospatial Science candidate,
+Submitted June 2016"""
+
+# Standard python libraries.
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+# Libraries available on Google cloud service.
+import webapp2
+import numpy
+
+# Google's appengine python libraries.
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+# Local model imports
+from landgateapitestmodel import TestCampaign
+from landgateapitestmodel import Vector
+from landgateapitestmodel import VectorSnapshotSegment
+from landgateapitestmodel import SnapshotRebuild
+from landgateapitestmodel import VectorCountShard
+from landgateapitestmodel import AggregateBatch
+
+# Local analysis imports
+from landgateapitestanalysis import sketchBucket
+from landgateapitestanalysis import regressionSums
+
+# Constants and helper classes and functions
+
+SNAPSHOT_QUEUE_NAME = 'default'
+SNAPSHOT_SEGMENT_ROWS = 5000  # rows per compacted segment, well under the entity size limit.
+SNAPSHOT_COMPACT_SEGMENTS = 50  # segments written between compactions.
+SNAPSHOT_REBUILD_BATCH_SIZE = 500  # Vectors read per task when rebuilding.
+SNAPSHOT_CACHE_SIZE = 4  # campaign snapshots kept per instance.
+SNAPSHOT_SEGMENTS_KEY = 'VectorSnapshot-segments-'
+VECTOR_COUNT_SHARD_COUNT = 20  # VectorCountShard entities per campaign.
+VECTOR_VERSION_KEY = 'VectorData-version-'
+AGGREGATE_BATCH_RETENTION_DAYS = 7  # AggregateBatch markers outlive every retry of their batch by far.
+AGGREGATE_BATCH_PURGE_SIZE = 500  # AggregateBatch keys deleted per round.
+AGGREGATE_BATCH_PURGE_SECONDS = 500  # each cron started purge stops after this.
+
+SNAPSHOT_FLOAT_COLUMNS = ('responseTime', 'distance', 'speed', 'pingChange', 'networkChange')
+SNAPSHOT_FLAG_COLUMNS = ('onDeviceSuccess', 'referenceCheckSuccess', 'referenceCheckValid')
+SNAPSHOT_CATEGORY_COLUMNS = ('server', 'httpMethod', 'name', 'returnType', 'responseCode', 'deviceType', 'iOSVersion', 'deviceID')
+
+# The Vector properties drawn as pie charts, counted as Vectors are analysed.
+VECTOR_COUNT_DIMENSIONS = ('server', 'httpMethod', 'name', 'returnType', 'responseCode', 'onDeviceSuccess', 'referenceCheckSuccess', 'deviceType', 'iOSVersion', 'deviceID')
+
+# The box plots' categories, the responseTime of successful tests is
+# sketched by each value of each.
+SKETCH_CATEGORY_DIMENSIONS = ('server', 'httpMethod', 'returnType', 'name')
+
+# The scatter charts' x and y properties, each fitted by test outcome,
+# and those also fitted for successful tests by each SKETCH_CATEGORY_DIMENSIONS.
+REGRESSION_PAIRS = (('speed', 'responseTime'), ('distance', 'responseTime'), ('networkChange', 'responseTime'), ('pingChange', 'responseTime'))
+REGRESSION_CATEGORY_PAIRS = (('distance', 'responseTime'),)
+
+# Each column's name and dtype, in the order they are stored.
+SNAPSHOT_LAYOUT = ([(name, '<f8') for name in SNAPSHOT_FLOAT_COLUMNS] +
+                   [(name, '?') for name in SNAPSHOT_FLAG_COLUMNS] +
+                   [(name, '<i4') for name in SNAPSHOT_CATEGORY_COLUMNS])
+
+
+def getVectorDataVersion(campaignName):
+    """Returns the campaign's data version, a memcache counter bumped by
+    bumpVectorDataVersionAsync() whenever Vectors are written.
+    A missing counter, never set or evicted, starts again from the time in
+    milliseconds so it never repeats a version already cached against."""
+    versionKey = VECTOR_VERSION_KEY + campaignName
+    version = memcache.get(versionKey)
+    if version is None:
+        memcache.add(versionKey, int(time.time() * 1000))
+        version = memcache.get(versionKey) or 0
+    return version
+
+
+def bumpVectorDataVersionAsync(campaignName):
+    return ndb.get_context().memcache_incr(VECTOR_VERSION_KEY + campaignName, initial_value=int(time.time() * 1000))
+
+
+class VectorSnapshot(object):
+    """A campaign's Vectors as numpy columns, one element per Vector.
+    Float and flag columns are read by name from columns, the category
+    columns are codes into the matching list in vocabularies."""
+    def __init__(self, count, dictColumns, dictVocabularies):
+        self.count = count
+        self.columns = dictColumns
+        self.vocabularies = dictVocabularies
+
+    def isCategory(self, name, value):
+        """Returns the mask of rows whose category column name is value."""
+        if value not in self.vocabularies[name]:
+            return numpy.zeros(self.count, dtype=bool)
+        return self.columns[name] == self.vocabularies[name].index(value)
+
+
+def buildSnapshotSegment(campaignKey, listVectors, created=None):
+    """Returns an unsaved VectorSnapshotSegment of listVectors' rows."""
+    dictColumns = {}
+    dictVocabularies = {}
+    for name in SNAPSHOT_FLOAT_COLUMNS:
+        dictColumns[name] = numpy.array([getattr(vector, name) for vector in listVectors], dtype=float)
+    for name in SNAPSHOT_FLAG_COLUMNS:
+        dictColumns[name] = numpy.array([bool(getattr(vector, name)) for vector in listVectors], dtype=bool)
+    for name in SNAPSHOT_CATEGORY_COLUMNS:
+        dictIndex = {}
+        dictColumns[name] = numpy.array([dictIndex.setdefault(getattr(vector, name), len(dictIndex)) for vector in listVectors], dtype=numpy.int32)
+        dictVocabularies[name] = sorted(dictIndex, key=dictIndex.get)
+
+    listIDs = [str(vector.key.id()) for vector in listVectors]
+    return segmentFromColumns(campaignKey, listIDs, dictColumns, dictVocabularies, created)
+
+
+def segmentFromColumns(campaignKey, listIDs, dictColumns, dictVocabularies, created=None):
+    columns = ''.join(numpy.ascontiguousarray(dictColumns[name], dtype=dtype).tostring() for name, dtype in SNAPSHOT_LAYOUT)
+    return VectorSnapshotSegment(parent=campaignKey, created=created or datetime.utcnow(), count=len(listIDs),
+                                 vectorIDs=listIDs, vocabularies=dictVocabularies, columns=columns)
+
+
+def readSegmentColumns(segment):
+    """Returns a dict of a segment's columns, as read only views onto
+    its stored bytes rather than copies."""
+    dictColumns = {}
+    offset = 0
+    for name, dtype in SNAPSHOT_LAYOUT:
+        dictColumns[name] = numpy.frombuffer(segment.columns, dtype=dtype, count=segment.count, offset=offset)
+        offset += dictColumns[name].nbytes
+    return dictColumns
+
+
+def mergeSegments(listSegments):
+    """Returns (listIDs, dictColumns, dictVocabularies) for the latest
+    row of every Vector in listSegments, recoding each segment's
+    categories into vocabularies shared by all of them."""
+    listSegments = sorted(listSegments, key=lambda segment: segment.created)
+    if len(listSegments) == 1:
+        segment = listSegments[0]
+        return segment.vectorIDs, readSegmentColumns(segment), segment.vocabularies
+
+    listIDs = []
+    dictParts = dict((name, []) for name, dtype in SNAPSHOT_LAYOUT)
+    dictVocabularies = dict((name, []) for name in SNAPSHOT_CATEGORY_COLUMNS)
+    dictIndexes = dict((name, {}) for name in SNAPSHOT_CATEGORY_COLUMNS)
+
+    for segment in listSegments:
+        listIDs.extend(segment.vectorIDs)
+        dictColumns = readSegmentColumns(segment)
+        for name, dtype in SNAPSHOT_LAYOUT:
+            if name in dictIndexes:
+                dictIndex = dictIndexes[name]
+                for value in segment.vocabularies[name]:
+                    if value not in dictIndex:
+                        dictIndex[value] = len(dictVocabularies[name])
+                        dictVocabularies[name].append(value)
+                recode = numpy.array([dictIndex[value] for value in segment.vocabularies[name]] or [0], dtype=numpy.int32)
+                dictParts[name].append(recode[dictColumns[name]])
+            else:
+                dictParts[name].append(dictColumns[name])
+
+    dictColumns = dict((name, numpy.concatenate(listParts)) for name, listParts in dictParts.items())
+
+    # Keep only the last row of each Vector analysed more than once.
+    arrayIDs = numpy.array(listIDs)
+    arrayUnique, arrayFromEnd = numpy.unique(arrayIDs[::-1], return_index=True)
+    if len(arrayUnique) < len(arrayIDs):
+        arrayKeep = numpy.sort(len(arrayIDs) - 1 - arrayFromEnd)
+        listIDs = arrayIDs[arrayKeep].tolist()
+        dictColumns = dict((name, column[arrayKeep]) for name, column in dictColumns.items())
+
+    return listIDs, dictColumns, dictVocabularies
+
+
+class SnapshotCache(object):
+    """The VectorSnapshots of the campaigns most recently graphed, in
+    instance memory, each valid for the data version it was loaded at."""
+    def __init__(self, size=SNAPSHOT_CACHE_SIZE):
+        self.size = size
+        self.dictEntries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, campaignName, version):
+        with self.lock:
+            entry = self.dictEntries.pop(campaignName, None)
+            if entry is None or entry[0] != version:
+                return None
+            self.dictEntries[campaignName] = entry
+            return entry[1]
+
+    def put(self, campaignName, version, snapshot):
+        with self.lock:
+            self.dictEntries.pop(campaignName, None)
+            self.dictEntries[campaignName] = (version, snapshot)
+            while len(self.dictEntries) > self.size:
+                self.dictEntries.popitem(last=False)
+
+
+SNAPSHOT_CACHE = SnapshotCache()
+
+
+def loadVectorSnapshot(campaignName, version=None):
+    """Returns the campaign's VectorSnapshot, from instance memory if it
+    is still the current version, otherwise from its segments."""
+    if version is None:
+        version = getVectorDataVersion(campaignName)
+
+    snapshot = SNAPSHOT_CACHE.get(campaignName, version)
+    if snapshot is None:
+        listSegments = VectorSnapshotSegment.query(ancestor=ndb.Key(TestCampaign, campaignName)).fetch()
+        if listSegments:
+            listIDs, dictColumns, dictVocabularies = mergeSegments(listSegments)
+        else:
+            listIDs = []
+            dictColumns = dict((name, numpy.zeros(0, dtype=dtype)) for name, dtype in SNAPSHOT_LAYOUT)
+            dictVocabularies = dict((name, []) for name in SNAPSHOT_CATEGORY_COLUMNS)
+        snapshot = VectorSnapshot(len(listIDs), dictColumns, dictVocabularies)
+        SNAPSHOT_CACHE.put(campaignName, version, snapshot)
+
+    return snapshot
+
+
+@ndb.tasklet
+def addSnapshotSegmentAsync(campaignName, listVectors):
+    """Appends listVectors to the campaign's snapshot as a new segment,
+    queueing a compaction every SNAPSHOT_COMPACT_SEGMENTS segments."""
+    yield buildSnapshotSegment(ndb.Key(TestCampaign, campaignName), listVectors).put_async()
+
+    countSegments = yield ndb.get_context().memcache_incr(SNAPSHOT_SEGMENTS_KEY + campaignName, initial_value=0)
+    if countSegments is not None and countSegments % SNAPSHOT_COMPACT_SEGMENTS == 0:
+        taskqueue.add(url='/compactsnapshot', method='GET', params={'campaignName': campaignName}, queue_name=SNAPSHOT_QUEUE_NAME)
+
+
+def getVectorCountShardKeys(campaignName):
+    return [ndb.Key(VectorCountShard, campaignName + '-' + str(shard)) for shard in range(VECTOR_COUNT_SHARD_COUNT)]
+
+
+def addCounts(dictCounts, dictDelta):
+    for name, count in dictDelta.items():
+        dictCounts[name] = dictCounts.get(name, 0) + count
+
+
+def vectorCountDelta(listVectors, sign=1, dictDelta=None):
+    """Returns the Vector counts of listVectors, each count sign, added to
+    dictDelta if given. Callers pass only the Vectors whose validity, in
+    referenceCheckValid, has just been established or changed."""
+    if dictDelta is None:
+        dictDelta = {}
+    for vector in listVectors:
+        for dimension in VECTOR_COUNT_DIMENSIONS:
+            dictValues = dictDelta.setdefault(dimension, {})
+            value = json.dumps(getattr(vector, dimension))
+            dictValues[value] = dictValues.get(value, 0) + sign
+    return dictDelta
+
+
+def addSeriesCounts(dictTotals, dictDelta):
+    for series, dictCounts in dictDelta.items():
+        addCounts(dictTotals.setdefault(series, {}), dictCounts)
+
+
+def getAggregateTotals(campaignName, aggregate, listSeries):
+    """Returns a dict of each of listSeries to its counts in one of the
+    VectorCountShard aggregates, 'counts', 'sketches' or 'regressions',
+    summed across the campaign's shards, empty if nothing is counted."""
+    dictTotals = dict((series, {}) for series in listSeries)
+    for shard in ndb.get_multi(getVectorCountShardKeys(campaignName)):
+        if shard is None:
+            continue
+        dictShard = getattr(shard, aggregate) or {}
+        for series in listSeries:
+            if series in dictShard:
+                addCounts(dictTotals[series], dictShard[series])
+    return dictTotals
+
+
+def getVectorCounts(campaignName):
+    """Returns the campaign's Vector counts summed across its shards, a
+    dict of each dimension to a dict of each value to its count."""
+    dictCounts = getAggregateTotals(campaignName, 'counts', VECTOR_COUNT_DIMENSIONS)
+    return dict((dimension, dict((json.loads(value), count) for value, count in dictValues.items()))
+                for dimension, dictValues in dictCounts.items())
+
+
+def sketchSeriesName(chartProperty, categoryProperty, category):
+    """Returns the name of the series sketching chartProperty for the
+    Vectors whose categoryProperty is category."""
+    return chartProperty + '|' + categoryProperty + '|' + str(category)
+
+
+def vectorSketchDelta(listVectors, sign=1, dictDelta=None):
+    """Returns the changes to the quantile sketches for listVectors, each
+    count sign, added to dictDelta if given, a dict of series to sketch.
+    Successful tests' responseTime is sketched by each of their categories,
+    and every test's distance by its outcome, as the box plots show them.
+    Like vectorCountDelta(), given only Vectors whose validity changed."""
+    if dictDelta is None:
+        dictDelta = {}
+
+    def add(series, value):
+        if value is not None:
+            dictSketch = dictDelta.setdefault(series, {})
+            bucket = sketchBucket(value)
+            dictSketch[bucket] = dictSketch.get(bucket, 0) + sign
+
+    for vector in listVectors:
+        if vector.onDeviceSuccess and vector.referenceCheckSuccess:
+            for categoryProperty in SKETCH_CATEGORY_DIMENSIONS:
+                add(sketchSeriesName('responseTime', categoryProperty, getattr(vector, categoryProperty)), vector.responseTime)
+            add(sketchSeriesName('distance', 'outcome', 'success'), vector.distance)
+        if not vector.onDeviceSuccess:
+            add(sketchSeriesName('distance', 'outcome', 'deviceFailure'), vector.distance)
+        if not vector.referenceCheckSuccess:
+            add(sketchSeriesName('distance', 'outcome', 'referenceFailure'), vector.distance)
+
+    return dictDelta
+
+
+def getVectorSketches(campaignName, listSeries):
+    """Returns a dict of each of listSeries to its quantile sketch."""
+    return getAggregateTotals(campaignName, 'sketches', listSeries)
+
+
+def regressionSeriesName(xProperty, yProperty, categoryProperty, category):
+    """Returns the name of the series fitting yProperty to xProperty for
+    the Vectors whose categoryProperty, or outcome, is category."""
+    return xProperty + '|' + yProperty + '|' + categoryProperty + '|' + str(category)
+
+
+def vectorRegressionDelta(listVectors, sign=1, dictDelta=None):
+    """Returns the changes to the regression sums for listVectors, each
+    point counted sign times, added to dictDelta if given, a dict of
+    series to sums. Every pair in REGRESSION_PAIRS is summed by outcome,
+    as scatterCharter() divides the tests, and those in
+    REGRESSION_CATEGORY_PAIRS by category for successful tests too.
+    Like vectorCountDelta(), given only Vectors whose validity changed."""
+    if dictDelta is None:
+        dictDelta = {}
+
+    for vector in listVectors:
+        success = vector.onDeviceSuccess and vector.referenceCheckSuccess
+        if success:
+            outcome = 'success'
+        elif not vector.onDeviceSuccess:
+            outcome = 'deviceFailure'
+        else:
+            outcome = 'referenceFailure'
+
+        for xProperty, yProperty in REGRESSION_PAIRS:
+            dictSums = regressionSums(getattr(vector, xProperty), getattr(vector, yProperty), sign)
+            if not dictSums:
+                continue
+            addCounts(dictDelta.setdefault(regressionSeriesName(xProperty, yProperty, 'outcome', outcome), {}), dictSums)
+            if success and (xProperty, yProperty) in REGRESSION_CATEGORY_PAIRS:
+                for categoryProperty in SKETCH_CATEGORY_DIMENSIONS:
+                    series = regressionSeriesName(xProperty, yProperty, categoryProperty, getattr(vector, categoryProperty))
+                    addCounts(dictDelta.setdefault(series, {}), dictSums)
+
+    return dictDelta
+
+
+def getVectorRegressions(campaignName, listSeries):
+    """Returns a dict of each of listSeries to its regression sums."""
+    return getAggregateTotals(campaignName, 'regressions', listSeries)
+
+
+def vectorAggregateDelta(listCounted=(), listDiscounted=()):
+    """Returns the changes to the campaign's Vector counts, sketches and
+    regression sums for listCounted, the Vectors that have become valid,
+    by referenceCheckValid, and listDiscounted, those that have stopped
+    being valid. A dict of each VectorCountShard aggregate to its delta,
+    empty if nothing changes."""
+    dictDelta = {}
+    dictDelta['counts'] = vectorCountDelta(listDiscounted, -1, vectorCountDelta(listCounted))
+    dictDelta['sketches'] = vectorSketchDelta(listDiscounted, -1, vectorSketchDelta(listCounted))
+    dictDelta['regressions'] = vectorRegressionDelta(listDiscounted, -1, vectorRegressionDelta(listCounted))
+    return dict((aggregate, delta) for aggregate, delta in dictDelta.items() if delta)
+
+
+def addVectorAggregates(campaignName, dictDelta):
+    """Adds dictDelta, from vectorAggregateDelta(), to one VectorCountShard
+    chosen at random. Called within a transaction, returns the shard for
+    the caller to put."""
+    shardKey = random.choice(getVectorCountShardKeys(campaignName))
+    shard = shardKey.get()
+    if shard is None:
+        shard = VectorCountShard(key=shardKey)
+    for aggregate, dictSeries in dictDelta.items():
+        dictTotals = getattr(shard, aggregate) or {}
+        addSeriesCounts(dictTotals, dictSeries)
+        setattr(shard, aggregate, dictTotals)
+    return shard
+
+
+def getAggregateBatchKey(campaignName, batchName):
+    return ndb.Key(AggregateBatch, campaignName + '|' + batchName)
+
+
+def addAggregatesAsync(campaignName, dictDelta, batchName=None, addStats=None):
+    """Adds dictDelta to one VectorCountShard in a transaction, along with
+    the entity returned by addStats, if given, a function adding the
+    batch's counts to a campaign stats shard within the transaction.
+    A named batch is marked done by an AggregateBatch in the same
+    transaction, and a batch already marked adds nothing, so a retried
+    task never counts its Vectors twice. Returns a future."""
+    batchKey = None
+    if batchName is not None:
+        batchKey = getAggregateBatchKey(campaignName, batchName)
+
+    def txn():
+        if batchKey is not None and batchKey.get() is not None:
+            return
+
+        listEntities = []
+        if dictDelta:
+            listEntities.append(addVectorAggregates(campaignName, dictDelta))
+        if addStats is not None:
+            listEntities.append(addStats())
+        if batchKey is not None:
+            listEntities.append(AggregateBatch(key=batchKey))
+        ndb.put_multi(listEntities)
+
+    return ndb.transaction_async(txn, xg=True)
+
+
+def resetVectorAggregates(campaignName):
+    """Deletes the campaign's Vector counts, sketches and regression sums,
+    before its Vectors are counted again by a re-analysis or rebuild."""
+    ndb.delete_multi(getVectorCountShardKeys(campaignName))
+
+
+def resetVectorSnapshot(campaignName):
+    """Deletes the campaign's snapshot segments and Vector aggregates and
+    bumps its data version, before every Vector is recorded again by a
+    re-analysis or rebuild."""
+    ndb.delete_multi(VectorSnapshotSegment.query(ancestor=ndb.Key(TestCampaign, campaignName)).fetch(keys_only=True))
+    resetVectorAggregates(campaignName)
+    memcache.delete(SNAPSHOT_SEGMENTS_KEY + campaignName)
+    bumpVectorDataVersionAsync(campaignName).get_result()
+
+
+@ndb.tasklet
+def recordVectorChangesAsync(campaignName, listVectors, listCounted=(), listDiscounted=(), batchName=None, addStats=None):
+    """Adds newly written Vectors to the campaign's snapshot, adds
+    listCounted to its Vector counts, sketches and regression sums and
+    takes listDiscounted out of them, and only then bumps its data
+    version, so no graph is cached against the new version without them.
+    Callers pass the Vectors that have become valid, by
+    referenceCheckValid, as listCounted and those that have stopped being
+    valid as listDiscounted. The aggregates, and any stats from addStats,
+    are added in one transaction, see addAggregatesAsync()."""
+    listFutures = []
+    if listVectors:
+        listFutures.append(addSnapshotSegmentAsync(campaignName, listVectors))
+
+    dictDelta = vectorAggregateDelta(listCounted, listDiscounted)
+    if dictDelta or addStats is not None:
+        listFutures.append(addAggregatesAsync(campaignName, dictDelta, batchName, addStats))
+
+    if listFutures:
+        yield listFutures
+        yield bumpVectorDataVersionAsync(campaignName)
+
+
+class PurgeAggregateBatches(webapp2.RequestHandler):
+    """Deletes the AggregateBatch markers older than
+    AGGREGATE_BATCH_RETENTION_DAYS, started every day by cron. A marker is
+    only needed while its batch may still be retried, task retries are
+    long over by then, and otherwise markers would grow without bound.
+    A purge cut short by its deadline is finished by the next."""
+    def get(self):
+        cutoff = datetime.utcnow() - timedelta(days=AGGREGATE_BATCH_RETENTION_DAYS)
+        deadline = time.time() + AGGREGATE_BATCH_PURGE_SECONDS
+        countDeleted = 0
+
+        while time.time() < deadline:
+            listKeys = AggregateBatch.query(AggregateBatch.created < cutoff).fetch(AGGREGATE_BATCH_PURGE_SIZE, keys_only=True)
+            if not listKeys:
+                break
+
+            ndb.delete_multi(listKeys)
+            countDeleted += len(listKeys)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(str(countDeleted) + ' aggregate batch markers purged.\n\n')
+
+
+class CompactSnapshot(webapp2.RequestHandler):
+    """Merges a campaign's snapshot segments into as few as will hold its
+    rows, SNAPSHOT_SEGMENT_ROWS apiece, dropping superseded rows.
+    The merged segments take the created time of the newest segment read,
+    so any written meanwhile still supersede them, and only the segments
+    read are deleted. Interrupted, the duplicate rows are dropped on load."""
+    def get(self):
+        try:
+            campaignName = self.request.get('campaignName')
+            campaignKey = ndb.Key(TestCampaign, campaignName)
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Missing or invalid parameter in request.\n' +
+                                'Please provide ?campaignName=\n\n' +
+                                e.message + '\n\n')
+        else:
+            listSegments = VectorSnapshotSegment.query(ancestor=campaignKey).fetch()
+            if len(listSegments) > 1:
+                created = max(segment.created for segment in listSegments)
+                listIDs, dictColumns, dictVocabularies = mergeSegments(listSegments)
+
+                listMerged = []
+                for start in range(0, len(listIDs), SNAPSHOT_SEGMENT_ROWS):
+                    stop = start + SNAPSHOT_SEGMENT_ROWS
+                    dictSlice = dict((name, column[start:stop]) for name, column in dictColumns.items())
+                    listMerged.append(segmentFromColumns(campaignKey, listIDs[start:stop], dictSlice, dictVocabularies, created))
+
+                ndb.put_multi(listMerged)
+                ndb.delete_multi([segment.key for segment in listSegments])
+
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write(str(len(listSegments)) + ' snapshot segments compacted.\n\n')
+
+
+def addSnapshotTask(url, name, params):
+    """Adds a named task to the snapshot queue, ignoring the refusal of a
+    name already used, so a retried link never forks its chain."""
+    try:
+        taskqueue.Queue(SNAPSHOT_QUEUE_NAME).add(taskqueue.Task(url=url, method='GET', name=name, params=params))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def getRebuildTaskName(rebuild, page):
+    return 'rebuildsnapshot-' + str(rebuild.key.id()) + '-' + str(page)
+
+
+class RebuildSnapshot(webapp2.RequestHandler):
+    """Deletes a campaign's snapshot, Vector counts, sketches and regression
+    sums and starts a chain of tasks building them again from its Vectors,
+    tracked by a SnapshotRebuild. Needed once for campaigns analysed
+    before either existed, or after Vectors are edited in place."""
+    def get(self):
+        try:
+            campaignName = self.request.get('campaignName')
+            campaignKey = ndb.Key(TestCampaign, campaignName)
+
+        except Exception as e:
+            self.response.set_status(555, message="Custom error response code.")
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Missing or invalid parameter in request.\n' +
+                                'Please provide ?campaignName=\n\n' +
+                                e.message + '\n\n')
+        else:
+            resetVectorSnapshot(campaignName)
+
+            rebuild = SnapshotRebuild(parent=campaignKey)
+            rebuild.put()
+
+            addSnapshotTask('/rebuildsnapshotworker', getRebuildTaskName(rebuild, 0),
+                            {'rebuildKey': rebuild.key.urlsafe(), 'page': 0})
+
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write('Snapshot rebuild started.\n\n')
+
+
+class RebuildSnapshotWorker(webapp2.RequestHandler):
+    """Records the next page of a campaign's Vectors, saves the rebuild's
+    cursor and queues the next link. Each page is recorded as a named
+    batch, so a retried link counts none of its Vectors twice. A task
+    whose page is behind the rebuild's, a retry of a link already done,
+    only queues the next link again, in case that add failed."""
+    def get(self):
+        rebuildKey = ndb.Key(urlsafe=self.request.get('rebuildKey'))
+        rebuild = rebuildKey.get()
+        page = int(self.request.get('page'))
+        if rebuild is None or rebuild.page < page:
+            return
+
+        campaignName = rebuildKey.parent().id()
+
+        if rebuild.page == page and not rebuild.complete:
+            cursor = None
+            if rebuild.cursor is not None:
+                cursor = Cursor(urlsafe=rebuild.cursor)
+
+            listVectors, next_cursor, more = Vector.query(ancestor=rebuildKey.parent()).fetch_page(SNAPSHOT_REBUILD_BATCH_SIZE, start_cursor=cursor)
+
+            listValid = [vector for vector in listVectors if vector.referenceCheckValid]
+            recordVectorChangesAsync(campaignName, listVectors, listValid, batchName='rebuild-' + rebuildKey.urlsafe() + '-' + str(page)).get_result()
+
+            def txn():
+                rebuild = rebuildKey.get()
+                if rebuild.page == page:
+                    rebuild.page = page + 1
+                    if more:
+                        rebuild.cursor = next_cursor.urlsafe()
+                    else:
+                        rebuild.complete = True
+                    rebuild.put()
+                return rebuild
+
+            rebuild = ndb.transaction(txn)
+
+        if not rebuild.complete:
+            addSnapshotTask('/rebuildsnapshotworker', getRebuildTaskName(rebuild, rebuild.page),
+                            {'rebuildKey': rebuildKey.urlsafe(), 'page': rebuild.page})
+
+
+# WSGI app
+# Handles incoming requests according to supplied URL.
+app = webapp2.WSGIApplication([
+    ('/compactsnapshot', CompactSnapshot),
+    ('/purgeaggregatebatches', PurgeAggregateBatches),
+    ('/rebuildsnapshot', RebuildSnapshot),
+    ('/rebuildsnapshotworker', RebuildSnapshotWorker)
+], debug=True)
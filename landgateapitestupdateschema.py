@@ -6,6 +6,9 @@ Created by Aiden Price,
 Curtin University Masters of Geospatial Science candidate,
 Submitted June 2016"""
 
+# Standard python libraries.
+import hashlib
+
 # Libraries available on Google cloud service.
 import webapp2
 
@@ -27,12 +30,40 @@ from landgateapitestmodel import ReferenceObject
 from landgateapitestmodel import Vector
 from landgateapitestmodel import CampaignStats
 
+# Local snapshot imports
+from landgateapitestsnapshot import recordVectorChangesAsync
+
+# Local analysis imports
+from landgateapitestanalysis import isReferenceCheckValid
+
 # Constants and helper classes and functions
 
 DEFAULT_CAMPAIGN_NAME = 'production_campaign'
 
 BATCH_SIZE = 50  # ideal batch size may vary based on entity size.
 
+# The properties in which Vectors once held copies of their TestEndpoint
+# and supporting tests, and the key properties that replace them.
+LEGACY_VECTOR_PROPERTIES = [
+    ('test', 'testKey'),
+    ('preTestLocation', 'preTestLocationKey'),
+    ('postTestLocation', 'postTestLocationKey'),
+    ('preTestNetwork', 'preTestNetworkKey'),
+    ('postTestNetwork', 'postTestNetworkKey'),
+    ('preTestPing', 'preTestPingKey'),
+    ('postTestPing', 'postTestPingKey'),
+]
+
+def getLegacyValue(vector, name):
+    """Returns the copy of a test embedded in a Vector stored under the
+    old schema, as an Expando, or None. ndb keeps such properties, unknown
+    to the model, on the instance alone."""
+    prop = vector._properties.get(name)
+    if prop is None:
+        return None
+    return prop._get_value(vector)
+
+
 class UpdateSchemaWorker(webapp2.RequestHandler):
     def get(self):
         cursorString = self.request.get('cursor')
@@ -43,18 +74,10 @@ class UpdateSchemaWorker(webapp2.RequestHandler):
 
         listVectors, next_cursor, more = Vector.query().fetch_page(BATCH_SIZE, start_cursor=cursor)
         to_put = []
+        setWasValid = set(vector.key for vector in listVectors if vector.referenceCheckValid)
 
         for vector in listVectors:
-            if any([
-            (vector.server == 'OGC' and vector.dataset == 'BusStops' and vector.name == 'GetCapabilities' and vector.httpMethod == 'GET' and vector.returnType == 'XML'),
-            (vector.server == 'OGC' and vector.dataset == 'BusStops' and vector.name == 'AttributeFilter' and vector.httpMethod == 'GET' and vector.returnType == 'JSON'),
-            (vector.server == 'OGC' and vector.dataset == 'BusStops' and vector.name == 'GetCapabilities' and vector.httpMethod == 'POST' and vector.returnType == 'XML'),
-            (vector.server == 'OGC' and vector.dataset == 'Topo' and vector.name == 'Big' and vector.httpMethod == 'GET' and vector.returnType == 'Image'),
-            (vector.server == 'OGC' and vector.dataset == 'Topo' and vector.name == 'Small' and vector.httpMethod == 'GET' and vector.returnType == 'Image'),
-            (vector.server == 'GME' and vector.dataset == 'BusStops' and vector.name == 'Small' and vector.httpMethod == 'GET' and vector.returnType == 'JSON'),
-            (vector.server == 'GME' and vector.dataset == 'AerialPhoto' and vector.name == 'WMSGetCapabilities' and vector.httpMethod == 'GET' and vector.returnType == 'XML'),
-            (vector.server == 'GME' and vector.dataset == 'AerialPhoto' and vector.name == 'WMTSGetCapabilities' and vector.httpMethod == 'GET' and vector.returnType == 'XML')
-            ]):
+            if not isReferenceCheckValid(vector.server, vector.dataset, vector.name, vector.httpMethod, vector.returnType):
                 vector.referenceCheckValid = False
                 print 'Changed flag! False!'
                 to_put.append(vector)
@@ -64,12 +87,83 @@ class UpdateSchemaWorker(webapp2.RequestHandler):
                 to_put.append(vector)
 
         if to_put:
+            # Carry the new flags into each campaign's snapshot, and
+            # count or discount the Vectors whose flag changed, before the
+            # flags are stored. A retry then finds the same changes, and
+            # the batch, named after them, stops them being counted twice.
+            dictCampaigns = {}
+            for vector in to_put:
+                dictCampaigns.setdefault(vector.key.parent().id(), []).append(vector)
+            listFutures = []
+            for campaignName, listCampaignVectors in dictCampaigns.items():
+                listNowValid = [vector for vector in listCampaignVectors if vector.referenceCheckValid and vector.key not in setWasValid]
+                listNowInvalid = [vector for vector in listCampaignVectors if not vector.referenceCheckValid and vector.key in setWasValid]
+                batchName = 'updateschema-' + hashlib.sha1(','.join([vector.key.urlsafe() for vector in listNowValid] + ['-'] +
+                                                                    [vector.key.urlsafe() for vector in listNowInvalid])).hexdigest()
+                listFutures.append(recordVectorChangesAsync(campaignName, listCampaignVectors, listNowValid, listNowInvalid, batchName))
+            ndb.Future.wait_all(listFutures)
+            for future in listFutures:
+                future.check_success()
+
             ndb.put_multi(to_put)
 
         if more:
             print next_cursor.urlsafe()
             taskqueue.add(url='/updateschemaworker', method='GET', params={'cursor':next_cursor.urlsafe()})
 
+class CompactVectorsWorker(webapp2.RequestHandler):
+    """Rewrites a batch of Vectors stored with copies of their TestEndpoint
+    and six supporting tests as compact Vectors referring to them by key,
+    then queues the next batch. The embedded copies carry no keys, so the
+    keys are found by testID, with concurrent keys only ancestor queries.
+    Vectors already compact are left alone, so the chain may be rerun."""
+    def get(self):
+        cursorString = self.request.get('cursor')
+
+        cursor = None
+        if cursorString != 'None':
+            cursor = Cursor(urlsafe=cursorString)
+
+        listVectors, next_cursor, more = Vector.query().fetch_page(BATCH_SIZE, start_cursor=cursor)
+        listLegacy = [vector for vector in listVectors if 'test' in vector._properties]
+
+        dictFutures = {}
+        for vector in listLegacy:
+            for legacyName, keyName in LEGACY_VECTOR_PROPERTIES:
+                testID = getattr(getLegacyValue(vector, legacyName), 'testID', None)
+                if testID and testID not in dictFutures:
+                    dictFutures[testID] = ResultObject.query(ResultObject.testID == testID, ancestor=vector.key.parent()).get_async(keys_only=True)
+
+        to_put = []
+
+        for vector in listLegacy:
+            compact = Vector(key=vector.key)
+            for prop in Vector._properties.values():
+                if prop._has_value(vector):
+                    prop._set_value(compact, prop._get_value(vector))
+
+            for legacyName, keyName in LEGACY_VECTOR_PROPERTIES:
+                testID = getattr(getLegacyValue(vector, legacyName), 'testID', None)
+                if testID:
+                    setattr(compact, keyName, dictFutures[testID].get_result())
+
+            compact.location = getattr(getLegacyValue(vector, 'preTestLocation'), 'location', None)
+            to_put.append(compact)
+
+        if to_put:
+            ndb.put_multi(to_put)
+            print 'Compacted ' + str(len(to_put)) + ' Vectors'
+
+        if more:
+            taskqueue.add(url='/compactvectorsworker', method='GET', params={'cursor':next_cursor.urlsafe()})
+
+class CompactVectors(webapp2.RequestHandler):
+    def get(self):
+        taskqueue.add(url='/compactvectorsworker', method='GET', params={'cursor':'None'})
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('Vector compaction started.\n\n')
+
 class UpdateSchema(webapp2.RequestHandler):
     def get(self):
         q = taskqueue.Queue('default')
@@ -82,5 +176,7 @@ class UpdateSchema(webapp2.RequestHandler):
 # Handles incoming requests according to supplied URL.
 app = webapp2.WSGIApplication([
     ('/updateschema', UpdateSchema),
-    ('/updateschemaworker', UpdateSchemaWorker)
+    ('/updateschemaworker', UpdateSchemaWorker),
+    ('/compactvectors', CompactVectors),
+    ('/compactvectorsworker', CompactVectorsWorker)
 ], debug=True)